@@ -0,0 +1,51 @@
+import importlib
+import threading
+
+# ------------------------
+# 学祭整理券の発行ライブラリ
+# 使うときに各モジュールを読み込む（pandas・PIL を CLI の起動時に読まないため）
+#   from gakusaiex import TicketService, open_store, load_events
+# 画面では preload("pandas") で、後で使う重いモジュールを裏のスレッドで読み込んでおける
+# ------------------------
+_EXPORTS = {
+    "TicketService": "service",
+    "check_student": "service",
+    "check_fields": "service",
+    "duplicate_message": "service",
+    "TicketTemplate": "templates",
+    "Event": "events",
+    "load_event": "events",
+    "load_events": "events",
+    "open_store": "store",
+    "DeskIssuer": "store",
+    "DuplicateTicketError": "store",
+    "StaleBlockError": "store",
+    "SMTPPool": "mail",
+    "MailOutbox": "mail",
+    "TokenBucket": "mail",
+    "Metrics": "metrics",
+    "GateChecker": "gate",
+    "HistoryArchive": "archive",
+}
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+# ログイン画面などを待たせずに、次の表示で使うモジュールを読み込んでおく
+def preload(*names):
+    thread = threading.Thread(
+        target=lambda: [importlib.import_module(name) for name in names], name="gakusaiex-preload", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_EXPORTS))
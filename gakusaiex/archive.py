@@ -0,0 +1,302 @@
+import os
+import io
+import csv
+import hashlib
+import sqlite3
+import threading
+import datetime
+from contextlib import contextmanager
+from .store import PAPER_EMAIL, normalize_email, normalize_student_id
+
+# ------------------------
+# 整理券の保管庫（年・イベントをまたいだ全体ログを1つの SQLite に貯める）
+# tickets_all.csv やストアの history はイベント（年）ごとに別のファイルで、調べるには全体を読むしかない。
+# 保管庫は:
+#   ・型を決めた表（STRICT）。整理券番号は整数、学籍番号・メールは正規化した文字列、発行日時は ISO 形式
+#   ・イベント・メール・学籍番号・発行日時の索引があり、条件に合う行だけを読む（query / lookup）
+#   ・読み込みはメモリマップ（PRAGMA mmap_size）で、ページキャッシュから直接読む
+#   ・ログごとに「どこまで取り込んだか」を覚えていて、sync は増えた行だけを足す（何度呼んでもよい）
+#   python -m gakusaiex archive sync --all                 （events/*.toml のログを取り込む）
+#   python -m gakusaiex archive import tickets_all_2024.csv --as live2024 --issued-on 2024-11-02
+#   python -m gakusaiex archive query --email a123456@yamaguchi-u.ac.jp
+# 取り込み元（source）:
+#   sqlite:<ログID>  SQLiteTicketStore の history（ログID はファイルを作ったときに決まる）
+#   csv:<指紋>       tickets_all.csv など（最初のデータ行から作るので、作り直したファイルは別の取り込み元になる）
+# CSV の行は整理券番号の読める行だけを数えるので、compact() で壊れた行が消えても位置はずれない
+# ------------------------
+ARCHIVE_FILE = "tickets_archive.db"
+MMAP_SIZE = 256 * 1024 * 1024
+CSV_BATCH_ROWS = 5000
+COLUMNS = ["イベント", "整理券番号", "学籍番号", "氏名", "メール", "発行日時"]
+DTYPES = {"イベント": "category", "整理券番号": "Int64", "学籍番号": "string", "氏名": "string", "メール": "string"}
+
+
+def _day(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value)
+
+
+# 期間の端。日付（"2025-11-02" も）の until はその日の終わりまで含める
+def _bound(value, until=False):
+    if isinstance(value, str) and len(value) == 10:
+        value = datetime.date.fromisoformat(value)
+    if until and isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return "issued_at < ?", (value + datetime.timedelta(days=1)).isoformat()
+    return ("issued_at <= ?" if until else "issued_at >= ?"), _day(value)
+
+
+def _number(value):
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+class HistoryArchive:
+    def __init__(self, path=ARCHIVE_FILE):
+        self.path = path
+        self._local = threading.local()
+        self._sync_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tickets (
+                id INTEGER PRIMARY KEY,
+                event TEXT NOT NULL,
+                source TEXT NOT NULL,
+                source_row INTEGER NOT NULL,
+                number INTEGER,
+                gakuseki TEXT,
+                name TEXT,
+                email TEXT,
+                issued_at TEXT,
+                UNIQUE (source, source_row)
+            ) STRICT;
+            CREATE INDEX IF NOT EXISTS tickets_email ON tickets (email) WHERE email IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS tickets_gakuseki ON tickets (gakuseki) WHERE gakuseki IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS tickets_event ON tickets (event, issued_at);
+            CREATE INDEX IF NOT EXISTS tickets_issued ON tickets (issued_at);
+            -- CSV の取り込み元は、次に読み始める位置も覚えておく（ファイルが置き換わっていたら最初から数え直す）
+            CREATE TABLE IF NOT EXISTS sources (
+                source TEXT PRIMARY KEY,
+                event TEXT NOT NULL,
+                path TEXT,
+                inode INTEGER,
+                offset INTEGER NOT NULL DEFAULT 0
+            ) STRICT;
+            """
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout = 30000")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    # 内容が変わったら変わる値（表示用のキャッシュのキーに使う）
+    def version(self):
+        return self._conn().execute("SELECT COALESCE(MAX(id), 0) FROM tickets").fetchone()[0]
+
+    def _archived(self, conn, source):
+        return conn.execute("SELECT COALESCE(MAX(source_row), 0) FROM tickets WHERE source = ?", (source,)).fetchone()[0]
+
+    # ------------------------
+    # 取り込み
+    # ------------------------
+    # ストアのログ（SQLite なら history、CSV なら全体ログ）の増えた分を取り込む。取り込んだ行数を返す
+    def sync(self, store, event):
+        if hasattr(store, "all_log"):
+            return self.import_csv(store.all_log.path, event)
+        source = self.source_of(store)
+        conn = self._conn()
+        with self._sync_lock:
+            # ストアのファイルを直接つないで1文で写す。BEGIN（IMMEDIATE ではない）なので
+            # ストアには書き込みのロックをかけず、取り込んでいる間も発行は止まらない
+            conn.execute("ATTACH DATABASE ? AS src", (store.path,))
+            try:
+                conn.execute("BEGIN")
+                try:
+                    added = conn.execute(
+                        "INSERT OR IGNORE INTO tickets (event, source, source_row, number, gakuseki, name, email, issued_at)"
+                        " SELECT ?, ?, id, number, gakuseki, name, email, issued_at FROM src.history WHERE id > ? ORDER BY id",
+                        (event, source, self._archived(conn, source)),
+                    ).rowcount
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                conn.execute("COMMIT")
+                return added
+            finally:
+                conn.execute("DETACH DATABASE src")
+
+    # 取り込み元の名前（lookup で今のログを除くのに使う）。まだ行のない CSV は None
+    def source_of(self, store):
+        if hasattr(store, "all_log"):
+            return _csv_source(store.all_log.path)
+        return f"sqlite:{store.log_id()}"
+
+    # 過去の tickets_all.csv（タブ区切りのダウンロードも可）を取り込む。発行日時のない行は issued_on にする
+    def import_csv(self, path, event, issued_on=None):
+        source = _csv_source(path)
+        if source is None:
+            return 0
+        issued_on = None if issued_on is None else _day(issued_on)
+        stat = os.stat(path)
+        with self._sync_lock, self._transaction() as conn:
+            known = conn.execute("SELECT inode, offset FROM sources WHERE source = ?", (source,)).fetchone()
+            archived = self._archived(conn, source)
+            # 同じファイルが伸びただけなら前回の続きから、置き換わっていたら最初から読んで取り込み済みの行を飛ばす
+            resume = known is not None and known[0] == stat.st_ino and known[1] <= stat.st_size
+            header, rows, offset = _read_csv(path, known[1] if resume else 0)
+            row = archived if resume else 0
+            batch = []
+            added = 0
+            for values in rows:
+                record = dict(zip(header, values))
+                number = _number(record.get("整理券番号"))
+                if number is None:
+                    continue
+                row += 1
+                if row <= archived:
+                    continue
+                email = record.get("メール") or None
+                batch.append((
+                    event, source, row, number, normalize_student_id(record.get("学籍番号")),
+                    record.get("氏名") or None, email if email == PAPER_EMAIL else normalize_email(email),
+                    record.get("発行日時") or issued_on,
+                ))
+                if len(batch) >= CSV_BATCH_ROWS:
+                    added += self._insert(conn, batch)
+                    batch = []
+            added += self._insert(conn, batch)
+            conn.execute(
+                "INSERT OR REPLACE INTO sources (source, event, path, inode, offset) VALUES (?, ?, ?, ?, ?)",
+                (source, event, os.path.abspath(path), stat.st_ino, offset),
+            )
+            return added
+
+    def _insert(self, conn, batch):
+        if not batch:
+            return 0
+        return conn.executemany(
+            "INSERT OR IGNORE INTO tickets (event, source, source_row, number, gakuseki, name, email, issued_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            batch,
+        ).rowcount
+
+    # ------------------------
+    # 検索（条件は SQL の WHERE にして索引で絞り込み、合う行だけを読む）
+    # events: イベント名（1つかリスト）  since / until: 発行日（until の日を含む）
+    # ------------------------
+    def _where(self, events=None, email=None, gakuseki=None, since=None, until=None, exclude_source=None):
+        clauses, params = [], []
+        if events is not None:
+            events = [events] if isinstance(events, str) else list(events)
+            clauses.append(f"event IN ({', '.join('?' * len(events))})")
+            params += events
+        if email:
+            clauses.append("email = ?")
+            params.append(normalize_email(email))
+        if gakuseki:
+            clauses.append("gakuseki = ?")
+            params.append(normalize_student_id(gakuseki))
+        for value, until in ((since, False), (until, True)):
+            if value is not None:
+                clause, param = _bound(value, until)
+                clauses.append(clause)
+                params.append(param)
+        if exclude_source is not None:
+            clauses.append("source != ?")
+            params.append(exclude_source)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def query(self, events=None, email=None, gakuseki=None, since=None, until=None, limit=None):
+        import pandas as pd
+
+        where, params = self._where(events, email, gakuseki, since, until)
+        sql = f"SELECT event, number, gakuseki, name, email, issued_at FROM tickets{where} ORDER BY id"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        df = pd.DataFrame(self._conn().execute(sql, params).fetchall(), columns=COLUMNS).astype(DTYPES)
+        df["発行日時"] = pd.to_datetime(df["発行日時"], errors="coerce")
+        return df
+
+    # 過去に整理券を受け取っているか。見つかれば ("email" or "gakuseki", 整理券番号, イベント)（いちばん新しいもの）
+    def lookup(self, email=None, gakuseki=None, events=None, exclude_source=None):
+        conn = self._conn()
+        for field, value in (("email", normalize_email(email)), ("gakuseki", normalize_student_id(gakuseki))):
+            if value is None:
+                continue
+            where, params = self._where(events, exclude_source=exclude_source)
+            where += (" AND " if where else " WHERE ") + f"{field} = ?"
+            found = conn.execute(
+                f"SELECT number, event FROM tickets{where} ORDER BY id DESC LIMIT 1", params + [value]
+            ).fetchone()
+            if found is not None:
+                return field, found[0], found[1]
+        return None
+
+    # 発行済みのメールと学籍番号（正規化済み）の集合。名簿の一括チェック・一括発行で行ごとに問い合わせないため
+    def keys(self, events=None, exclude_source=None):
+        where, params = self._where(events, exclude_source=exclude_source)
+        emails, ids = set(), set()
+        for email, gakuseki in self._conn().execute(f"SELECT email, gakuseki FROM tickets{where}", params):
+            if email is not None:
+                emails.add(email)
+            if gakuseki is not None:
+                ids.add(gakuseki)
+        return emails, ids
+
+    # [(イベント, 枚数, 最初の発行日時, 最後の発行日時), ...]
+    def summary(self):
+        return self._conn().execute(
+            "SELECT event, COUNT(*), MIN(issued_at), MAX(issued_at) FROM tickets GROUP BY event ORDER BY MIN(id)"
+        ).fetchall()
+
+
+# CSV の指紋（見出しと最初のデータ行から作る）。データ行がなければ None
+def _csv_source(path):
+    try:
+        with open(path, "rb") as f:
+            head = [f.readline(), f.readline()]
+    except FileNotFoundError:
+        return None
+    if not head[1].strip():
+        return None
+    return "csv:" + hashlib.sha1(b"".join(head)).hexdigest()[:16]
+
+
+# (見出し, 行, 読み終えた位置)。offset から読む（見出しは常にファイルの先頭から）。最後の改行までを読む
+def _read_csv(path, offset=0):
+    with open(path, "rb") as f:
+        first = f.readline()
+        if offset == 0:
+            offset = len(first)
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    text = first.decode("utf-8-sig")
+    delimiter = "\t" if text.count("\t") > text.count(",") else ","
+    header = next(csv.reader([text], delimiter=delimiter))
+    rows = csv.reader(io.StringIO(data[:end].decode("utf-8")), delimiter=delimiter)
+    return header, rows, offset + end
@@ -0,0 +1,719 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import socketserver
+from contextlib import contextmanager
+
+# ------------------------
+# 発行処理のベンチマーク
+# ticket_app.py / ticket_app2.py と同じ手順を、外部サービスの代わりに
+# ローカルのSMTPサーバー・偽の Google Sheets・一時ディレクトリに対して実行し、
+# 段階ごとの所要時間（p50 / p95 / p99）と 1秒あたりの発行数を JSON に保存する。
+#   python -m gakusaiex.bench --out bench.json
+#   python -m gakusaiex.bench --sizes 1,100 --log-rows 0,10000 --out new.json --compare old.json
+# 段階:
+#   lookup    重複チェック        issue     番号の割り当てと記録
+#   render    画像の描画          encode    画像のエンコード
+#   message   メール作成          enqueue   送信キューに積む
+#   smtp      SMTPでの送信        sheets    スプレッドシートへの書き込み（ticket_app2 のみ）
+# 起動時に1回だけの段階（template_decode / font_load）と、ログの読み込み（log_cold / log_warm）も測る。
+# テンプレート画像・フォントはアプリと同じく相対パスで探すので、リポジトリの直下で実行する。
+# --mime N でメールの組み立て・送信だけを旧方式（MIMEMultipart）と比べる（mime_compare）。
+# --pool N --workers 1,2,4,0 で画像生成のプロセスプールをワーカー数ごとに測る（pool_compare。0 は CPU の数）。
+# --startup N で画面の起動時間と再実行1回の時間を、新しいプロセスで N 回ずつ測る（app_startup）。
+# --regen N で N 枚を発行してログから作り直し、発行時と同じ画像になるかを確かめる（regen_check。違えば終了コード 1）。
+# --archive N で N 行の全体ログを CSV のまま調べる場合と保管庫（gakusaiex.archive）で調べる場合を比べる（archive_compare）。
+# ------------------------
+PIPELINES = ["app", "app2"]
+DEFAULT_SIZES = [1, 100, 1000, 10000]
+DEFAULT_LOG_ROWS = [0, 1000, 10000, 100000]
+
+
+# ------------------------
+# ローカルSMTPサーバー（受け取ったメールは捨てる）
+# ------------------------
+class _SMTPSink(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self._reply("220 localhost bench")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                self._reply("250-localhost")
+                self._reply("250 AUTH PLAIN LOGIN")
+            elif command == b"AUTH":
+                self._reply("235 OK")
+            elif command == b"DATA":
+                self._reply("354 end with <CRLF>.<CRLF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                self.server.received += 1
+                self._reply("250 OK")
+            elif command == b"QUIT":
+                self._reply("221 bye")
+                return
+            else:  # MAIL / RCPT / RSET / NOOP
+                self._reply("250 OK")
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), _SMTPSink)
+        self.received = 0
+        self._thread = threading.Thread(target=self.serve_forever, name="bench-smtp", daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+# ------------------------
+# 段階ごとの計測
+# ------------------------
+class StageTimer:
+    def __init__(self):
+        self.samples = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(name, []).append(time.perf_counter() - start)
+
+    def summary(self):
+        return {name: summarize(values) for name, values in self.samples.items()}
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))]
+
+
+def summarize(values):
+    ordered = sorted(values)
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        "n": len(ordered),
+        "mean_ms": ms(sum(ordered) / len(ordered)),
+        "p50_ms": ms(_percentile(ordered, 0.50)),
+        "p95_ms": ms(_percentile(ordered, 0.95)),
+        "p99_ms": ms(_percentile(ordered, 0.99)),
+        "max_ms": ms(ordered[-1]),
+    }
+
+
+# ------------------------
+# 1回分の実行
+# ------------------------
+def _prefill(store, rows):
+    if rows:
+        store.issue_many(
+            [{"gakuseki": f"9{i:09d}", "name": "prefill", "email": f"p{i:07d}@example.com"} for i in range(rows)]
+        )
+
+
+def _open(pipeline, store_kind, directory):
+    from .store import open_store, SQLiteTicketStore
+
+    if pipeline == "app2":
+        return SQLiteTicketStore(os.path.join(directory, "sheets_journal.db"))
+    return open_store(
+        store_kind,
+        os.path.join(directory, "tickets.db"),
+        os.path.join(directory, "tickets.csv"),
+        os.path.join(directory, "tickets_all.csv"),
+    )
+
+
+def run_once(pipeline, store_kind, tickets, log_rows, smtp_port, fmt="png", base_image=None, font_path=None,
+             sheets_latency=0.0, workdir=None):
+    from .renderer import BASE_IMAGE, FONT_PATH, load_base, load_font, clear_cache, get_renderer, encode_ticket
+    from .mail import SMTPPool, MailOutbox
+    from .events import load_event
+
+    base_image = base_image or BASE_IMAGE
+    font_path = font_path or FONT_PATH
+    template = load_event(os.path.join("events", "sheets.toml" if pipeline == "app2" else "live.toml")).template
+    directory = tempfile.mkdtemp(prefix="gakusaiex_bench_", dir=workdir)
+    timer = StageTimer()
+    try:
+        # 起動時（テンプレート画像のデコード・フォントの読み込み）
+        clear_cache()
+        with timer.stage("template_decode"):
+            load_base(base_image)
+        with timer.stage("font_load"):
+            for _, _, size in template.layout:
+                load_font(size, font_path)
+
+        store = _open(pipeline, store_kind, directory)
+        _prefill(store, log_rows)
+        with timer.stage("log_cold"):
+            _open(pipeline, store_kind, directory).history()
+        with timer.stage("log_warm"):
+            store.history()
+
+        replicator = None
+        if pipeline == "app2":
+            from .sheets import SheetsReplicator, FakeWorksheet
+
+            worksheet = FakeWorksheet(latency=sheets_latency)
+            replicator = SheetsReplicator(store, worksheet, batch_size=max(tickets, 1))
+            with timer.stage("sheets"):
+                replicator.reconcile()
+                replicator.sync_once()
+
+        pool = SMTPPool("127.0.0.1", smtp_port, use_ssl=False)
+        outbox = MailOutbox(os.path.join(directory, "outbox.db"), pool)
+        renderer = get_renderer([(xy, size) for xy, _, size in template.layout], base_image, font_path)
+        from .events import attachment_info
+
+        builder = template.builder("bench@example.com", *attachment_info(fmt, template.stem))
+
+        totals = []
+        start = time.perf_counter()
+        for i in range(tickets):
+            ticket_start = time.perf_counter()
+            fields = {"gakuseki": f"1{i:09d}", "name": "bench", "email": f"b{i:06d}@example.com"}
+            with timer.stage("lookup"):
+                store.lookup(email=fields["email"], gakuseki=fields["gakuseki"])
+            with timer.stage("issue"):
+                number = store.issue(**fields)
+            texts = template.texts(number, fields)
+            with timer.stage("render"):
+                image = renderer.render([text for _, text, _ in texts])
+            with timer.stage("encode"):
+                data = encode_ticket(image, fmt).getbuffer()
+            with timer.stage("message"):
+                raw = builder.build(number, fields, data)
+            with timer.stage("enqueue"):
+                outbox.enqueue(raw, ticket=number, sender="bench@example.com", recipient=fields["email"])
+            with timer.stage("smtp"):
+                outbox.drain()
+            if replicator is not None:
+                with timer.stage("sheets"):
+                    replicator.sync_once()
+            totals.append(time.perf_counter() - ticket_start)
+        elapsed = time.perf_counter() - start
+        pool.close()
+
+        stages = timer.summary()
+        return {
+            "pipeline": pipeline,
+            "store": "sqlite" if pipeline == "app2" else store_kind,
+            "format": fmt,
+            "tickets": tickets,
+            "log_rows": log_rows,
+            "tickets_per_sec": round(tickets / elapsed, 2) if tickets and elapsed else None,
+            "ticket": summarize(totals) if totals else None,
+            "stages": stages,
+            "sent": outbox.counts().get("sent", 0),
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# ------------------------
+# メールの組み立てと送信の比較
+#   message  MIMEMultipart を作って as_bytes で平らにし、sendmail で送る（以前の方式）
+#   builder  MessageBuilder でバイト列を直接組み立て、send_raw でソケットへ流す
+# 1通あたりの CPU 時間と、1通を組み立てて送るあいだに確保するメモリの最大（tracemalloc）を測る
+# ------------------------
+def mime_compare(count, smtp_port, fmt="png", event="live"):
+    import tracemalloc
+    from .events import load_event
+    from .mail import SMTPPool, _wire_bytes
+    from .renderer import get_renderer, encode_ticket, attachment_info
+
+    template = load_event(os.path.join("events", f"{event}.toml")).precompile().template
+    fields = {"gakuseki": "0123456789", "name": "山田 太郎", "email": "bench@example.com"}
+    texts = template.texts(1, fields)
+    renderer = get_renderer([(xy, size) for xy, _, size in texts])
+    data = encode_ticket(renderer.render([text for _, text, _ in texts]), fmt).getbuffer()
+    image_subtype, image_name = attachment_info(fmt, template.stem)
+    builder = template.builder("bench@example.com", image_subtype, image_name)
+    pool = SMTPPool("127.0.0.1", smtp_port, use_ssl=False)
+    paths = {
+        # 以前は getvalue() で画像をコピーしてから MIMEImage に渡していた
+        "message": (
+            lambda n: _wire_bytes(template.message("bench@example.com", n, fields, bytes(data), image_subtype, image_name)),
+            pool.sendmail,
+        ),
+        "builder": (lambda n: builder.build(n, fields, data), pool.send_raw),
+    }
+    result = {"attachment_kib": round(len(data) / 1024, 1)}
+    try:
+        for name, (build, send) in paths.items():
+            send("bench@example.com", ["bench@example.com"], build(0))  # 接続を張っておく
+            cpu = time.process_time()
+            messages = [build(n) for n in range(count)]
+            build_cpu = time.process_time() - cpu
+            cpu = time.process_time()
+            for raw in messages:
+                send("bench@example.com", ["bench@example.com"], raw)
+            send_cpu = time.process_time() - cpu
+            size = len(messages[0])
+            del messages
+            peak = 0
+            tracemalloc.start()
+            try:
+                for n in range(min(count, 20)):
+                    tracemalloc.reset_peak()
+                    base = tracemalloc.get_traced_memory()[0]
+                    send("bench@example.com", ["bench@example.com"], build(n))
+                    peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+            finally:
+                tracemalloc.stop()
+            result[name] = {
+                "build_cpu_ms": round(build_cpu * 1000 / count, 3),
+                "send_cpu_ms": round(send_cpu * 1000 / count, 3),
+                "peak_kib": round(peak / 1024, 1),
+                "message_kib": round(size / 1024, 1),
+            }
+    finally:
+        pool.close()
+    return result
+
+
+# ------------------------
+# 画像生成のプロセスプール
+#   inline   このプロセスで1枚ずつ描く（プールなし）
+#   workers  RenderPool の起動時間、まとめて描いたときの枚数/秒と inline との比、
+#            1枚ずつ頼んだときの往復時間（画面からの発行。inline との差が受け渡しの時間）
+# ------------------------
+def pool_compare(count, worker_counts, fmt="png", event="live"):
+    from .events import load_event
+    from .renderer import render_ticket_file
+    from .renderpool import RenderPool, event_preload
+
+    ev = load_event(os.path.join("events", f"{event}.toml")).precompile()
+    jobs = [
+        ev.template.texts(n, {"gakuseki": f"1{n:09d}", "name": "bench", "email": f"b{n:06d}@example.com"})
+        for n in range(1, count + 1)
+    ]
+    single = min(count, 50)
+    latencies = []
+    start = time.perf_counter()
+    for texts in jobs:
+        ticket_start = time.perf_counter()
+        render_ticket_file(texts, fmt, ev.base_image, ev.font).getvalue()
+        latencies.append(time.perf_counter() - ticket_start)
+    inline = time.perf_counter() - start
+    runs = [{
+        "workers": "inline", "startup_s": 0.0, "tickets_per_sec": round(count / inline, 2), "speedup": 1.0,
+        "single": summarize(latencies[:single]),
+    }]
+    for workers in worker_counts:
+        workers = workers or os.cpu_count() or 1
+        start = time.perf_counter()
+        pool = RenderPool(workers, event_preload([ev])).start()
+        startup = time.perf_counter() - start
+        try:
+            start = time.perf_counter()
+            pool.map(jobs, fmt, ev.base_image, ev.font)
+            elapsed = time.perf_counter() - start
+            latencies = []
+            for texts in jobs[:single]:
+                ticket_start = time.perf_counter()
+                pool.render(texts, fmt, ev.base_image, ev.font)
+                latencies.append(time.perf_counter() - ticket_start)
+        finally:
+            pool.close()
+        runs.append({
+            "workers": workers, "startup_s": round(startup, 3), "tickets_per_sec": round(count / elapsed, 2),
+            "speedup": round(inline / elapsed, 2), "single": summarize(latencies),
+        })
+    return runs
+
+
+# ------------------------
+# ログからの作り直し（再送）が発行時と同じ画像になるか
+# 入力はフォームで来る形（全角数字・ハイフン入りの学籍番号、大文字のメール）にして、ストアの正規化も通す。
+# 画像は送信キューに積んだメールの添付から取り出して比べる（キャッシュは使わず描き直す）
+# ------------------------
+def _attachments(outbox):
+    import email
+    import sqlite3
+    from email import policy
+
+    conn = sqlite3.connect(outbox.path)
+    try:
+        rows = conn.execute("SELECT ticket, message FROM outbox ORDER BY id").fetchall()
+    finally:
+        conn.close()
+    found = {}
+    for ticket, raw in rows:
+        message = email.message_from_bytes(raw, policy=policy.default)
+        found.setdefault(int(ticket), []).append(next(message.iter_attachments()).get_content())
+    return found
+
+
+def regen_check(count, smtp_port, fmt="png", event="live"):
+    from .events import load_event
+    from .mail import MailOutbox, SMTPPool
+    from .service import TicketService
+
+    event = load_event(os.path.join("events", f"{event}.toml")).precompile()
+    digits = str.maketrans("0123456789", "０１２３４５６７８９")
+    rows = [
+        {
+            "gakuseki": f"{i:010d}".translate(digits) if i % 3 == 0 else f"{i:05d}-{i:05d}",
+            "name": f"山田 太郎{i}",
+            "email": f"B{i:06d}@Example.com" if i % 2 else f"b{i:06d}@example.com",
+        }
+        for i in range(count)
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        store = _open("app", "sqlite", directory)
+        outbox = MailOutbox(os.path.join(directory, "outbox.db"), SMTPPool("127.0.0.1", smtp_port, use_ssl=False))
+        service = TicketService(
+            store, event.template, "bench@example.com", outbox, fmt, event.base_image, event.font, qr_secret="bench",
+        )
+        numbers = [service.issue(**fields) for fields in rows[:count // 2]]
+        numbers += service.bulk_issue(rows[count // 2:])[0]
+        service.resend_many(numbers)
+        images = _attachments(outbox)
+    mismatched = [number for number in numbers if len(set(images.get(number, []))) != 1 or len(images[number]) != 2]
+    return {"tickets": len(numbers), "mismatched": mismatched}
+
+
+# ------------------------
+# 全体ログの調べ方（CSV を pandas で全部読む / 保管庫で条件に合う行だけを読む）
+#   csv_read     tickets_all.csv を pd.read_csv で全部読む          csv_email  全部読んでメールで絞り込む
+#   import       CSV を保管庫に取り込む（最初の1回）                sync       1行増えたあとの取り込み
+#   email / gakuseki / day   保管庫の query（メール・学籍番号・発行日で絞り込む）
+#   lookup       過去の整理券の重複チェック1回（HistoryArchive.lookup）
+# ------------------------
+def archive_compare(rows, repeat=20):
+    import csv
+    import pandas as pd
+    from .archive import HistoryArchive
+
+    timer = StageTimer()
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, "tickets_all.csv")
+        with open(csv_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(["整理券番号", "学籍番号", "氏名", "メール", "発行日時"])
+            for i in range(rows):
+                day = f"20{20 + i * 5 // rows}-11-0{1 + i % 3} {9 + i % 8:02d}:00:00"
+                writer.writerow([i % 2000 + 1, f"{i:010d}", f"bench{i}", f"b{i:07d}@example.com", day])
+        picks = [(i * 7919) % rows for i in range(repeat)]
+        for _ in range(3):
+            with timer.stage("csv_read"):
+                pd.read_csv(csv_path, dtype={"学籍番号": str})
+        for i in picks[:3]:
+            with timer.stage("csv_email"):
+                df = pd.read_csv(csv_path, dtype={"学籍番号": str})
+                df[df["メール"] == f"b{i:07d}@example.com"]
+        archive = HistoryArchive(os.path.join(directory, "archive.db"))
+        with timer.stage("import"):
+            archive.import_csv(csv_path, "bench")
+        with open(csv_path, "a", encoding="utf-8", newline="") as f:
+            f.write(f"1,{rows:010d},bench,b{rows:07d}@example.com,2024-11-03 10:00:00\n")
+        with timer.stage("sync"):
+            archive.import_csv(csv_path, "bench")
+        for i in picks:
+            with timer.stage("email"):
+                archive.query(email=f"b{i:07d}@example.com")
+            with timer.stage("gakuseki"):
+                archive.query(gakuseki=f"{i:010d}")
+            with timer.stage("lookup"):
+                archive.lookup(email=f"b{i:07d}@example.com", gakuseki=f"{i:010d}")
+        for _ in range(3):
+            with timer.stage("day"):
+                archive.query(since="2022-11-02", until="2022-11-02")
+        sizes = {
+            "csv_mib": round(os.path.getsize(csv_path) / 2**20, 2),
+            "archive_mib": round(os.path.getsize(archive.path) / 2**20, 2),
+        }
+    return {"rows": rows, **sizes, "stages": timer.summary()}
+
+
+# ------------------------
+# 画面の起動時間と再実行の時間（Streamlit の AppTest で ticket_app.py / ticket_app2.py を動かす）
+#   import        streamlit の読み込み
+#   cold          新しいプロセスで最初にログイン画面を出すまで（アプリの読み込み・準備を含む）
+#   login_rerun   ログイン画面の再実行
+#   login         パスワードを入れてフォームの画面を出すまで
+#   form_rerun    フォームの画面の再実行（送信状況・ログの表示を含む）
+#   submit_first  最初の発行（入力チェック → 番号 → 画像 → メール → 送信キュー）
+#   submit        2回目以降の発行
+# ログイン画面が出てから、パスワードを入力するまで think 秒待つ（裏での読み込み・ワーカーの起動はこの間に進む）。
+# 1回ごとに新しいプロセス・一時ディレクトリで動かす（cold に import の時間を含めるため）。
+# SMTP はローカルのサーバー、ticket_app2 の Google Sheets は偽物（FakeWorksheet）を使う。
+# ------------------------
+STARTUP_APPS = {"app": "ticket_app.py", "app2": "ticket_app2.py"}
+STARTUP_RERUNS = 5
+STARTUP_SUBMITS = 5
+STARTUP_THINK = 2.0
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# gspread / oauth2client の代わり。シートは読み込まれたときに作る（pandas を先に読み込まないため）
+def _fake_google():
+    import types
+
+    def open_by_url(url):
+        from .sheets import FakeWorksheet
+
+        return types.SimpleNamespace(sheet1=FakeWorksheet())
+
+    gspread = types.ModuleType("gspread")
+    gspread.authorize = lambda creds: types.SimpleNamespace(open_by_url=open_by_url)
+    service_account = types.ModuleType("oauth2client.service_account")
+    service_account.ServiceAccountCredentials = types.SimpleNamespace(from_json_keyfile_dict=lambda info, scope: None)
+    oauth2client = types.ModuleType("oauth2client")
+    oauth2client.service_account = service_account
+    sys.modules.update({"gspread": gspread, "oauth2client": oauth2client, "oauth2client.service_account": service_account})
+
+
+def _startup_probe(pipeline, smtp_port, think=STARTUP_THINK):
+    timer = StageTimer()
+    with timer.stage("import"):
+        from streamlit.testing.v1 import AppTest, local_script_runner
+        from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+        from streamlit import delta_generator
+
+    # Streamlit のサーバーはコンパイルしたスクリプトを再実行のたびに使い回すが、
+    # AppTest は毎回コンパイルし直すので、サーバーと同じく1つを使い回す
+    script_cache = ScriptCache()
+    local_script_runner.ScriptCache = lambda: script_cache
+    # streamlit run で動かしていないときの警告（サーバーでは出ない）は、調べるのに時間がかかるので出さない
+    delta_generator._use_warning_has_been_displayed = True
+    at = AppTest.from_file(os.path.join(ROOT_DIR, STARTUP_APPS[pipeline]), default_timeout=120)
+    config = {
+        "email_from": "bench@example.com", "app_password": "bench", "admin_password": "bench",
+        "smtp_server": "127.0.0.1", "smtp_port": smtp_port, "smtp_ssl": False,
+    }
+    if pipeline == "app":
+        for key, value in config.items():
+            at.secrets[key] = value
+    else:
+        _fake_google()
+        at.secrets["config"] = {**config, "spreadsheet_url": "https://example.com/sheet"}
+        at.secrets["gcp_service_account"] = {}
+
+    def run(stage):
+        with timer.stage(stage):
+            at.run()
+        if at.exception:
+            raise RuntimeError(f"{STARTUP_APPS[pipeline]}: {at.exception[0].message}")
+
+    run("cold")
+    time.sleep(think)
+    for _ in range(STARTUP_RERUNS):
+        run("login_rerun")
+    at.text_input[0].input("bench")
+    run("login")
+    for _ in range(STARTUP_RERUNS):
+        run("form_rerun")
+    done = 0
+    while done <= STARTUP_SUBMITS:
+        number = f"{os.getpid() % 1000:03d}{done:07d}"
+        for label, value in (("学籍番号", number), ("氏名", "bench"), ("学内メール", f"b{number[-6:]}")):
+            next(t for t in at.text_input if t.label.startswith(label)).input(value)
+        next(b for b in at.button if b.label == "整理券を発行して送信").click()
+        run("submit" if done else "submit_first")
+        if any("照合がまだ" in e.value for e in at.error):
+            time.sleep(0.05)  # ticket_app2: スプレッドシートとの照合を待つ（この回は数えない）
+            timer.samples["submit" if done else "submit_first"].pop()
+            continue
+        if not at.success:
+            raise RuntimeError(f"{STARTUP_APPS[pipeline]}: 発行できない {[e.value for e in at.error]}")
+        done += 1
+    return {name: [round(v, 6) for v in values] for name, values in timer.samples.items()}
+
+
+# アプリは相対パスでイベントの設定・テンプレート画像を読むので、一時ディレクトリに写して動かす
+def app_startup(pipeline, runs, smtp_port, think=STARTUP_THINK):
+    samples = {}
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as directory:
+            shutil.copytree(os.path.join(ROOT_DIR, "events"), os.path.join(directory, "events"))
+            for name in ("template.png", "template.jpg"):
+                if os.path.exists(os.path.join(ROOT_DIR, name)):
+                    shutil.copy(os.path.join(ROOT_DIR, name), directory)
+            env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [ROOT_DIR, os.environ.get("PYTHONPATH")]))}
+            env.pop("GAKUSAIEX_EVENT", None)
+            done = subprocess.run(
+                [sys.executable, "-m", "gakusaiex.bench", "--startup-probe", pipeline, "--smtp-port", str(smtp_port),
+                 "--think", str(think)],
+                cwd=directory, env=env, capture_output=True, text=True,
+            )
+            if done.returncode != 0:
+                raise RuntimeError(f"{pipeline}: 計測に失敗しました\n{done.stderr}")
+            for name, values in json.loads(done.stdout.strip().splitlines()[-1]).items():
+                samples.setdefault(name, []).extend(values)
+    return {name: summarize(values) for name, values in samples.items()}
+
+
+# ------------------------
+# 結果の保存・比較
+# ------------------------
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _key(run):
+    return run["pipeline"], run["store"], run["format"], run["tickets"], run["log_rows"]
+
+
+def compare(old, new):
+    previous = {_key(run): run for run in old["runs"]}
+    lines = []
+    for run in new["runs"]:
+        before = previous.get(_key(run))
+        if before is None:
+            continue
+        label = "{}/{}/{} tickets={} log={}".format(*_key(run))
+        for stage, stats in sorted(run["stages"].items()):
+            if stage not in before["stages"]:
+                continue
+            old_ms, new_ms = before["stages"][stage]["p50_ms"], stats["p50_ms"]
+            ratio = new_ms / old_ms if old_ms else float("inf")
+            mark = "  ← 遅くなった" if ratio > 1.2 and new_ms - old_ms > 0.5 else ""
+            lines.append(f"{label:<40} {stage:<16} p50 {old_ms:>9.3f} → {new_ms:>9.3f} ms ({ratio:4.2f}x){mark}")
+    return lines
+
+
+def _ints(text):
+    return [int(x) for x in text.split(",") if x.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="整理券発行のベンチマーク")
+    parser.add_argument("--pipelines", default=",".join(PIPELINES), help="app（ticket_app.py）/ app2（ticket_app2.py）")
+    parser.add_argument("--stores", default="sqlite,csv", help="app で使うストア")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="1回に発行する枚数")
+    parser.add_argument("--log-rows", default=",".join(map(str, DEFAULT_LOG_ROWS)), help="事前にログに入れておく行数")
+    parser.add_argument("--format", default="png")
+    parser.add_argument("--base-image")
+    parser.add_argument("--font")
+    parser.add_argument("--sheets-latency", type=float, default=0.0, help="偽 Sheets の1回の呼び出しにかける秒数")
+    parser.add_argument("--out", help="結果の JSON の保存先")
+    parser.add_argument("--compare", help="比べる過去の結果の JSON")
+    parser.add_argument("--mime", type=int, help="メールの組み立て・送信だけを N 通ずつ旧方式と比べる")
+    parser.add_argument("--pool", type=int, help="画像生成のプロセスプールで N 枚描いてワーカー数ごとに比べる")
+    parser.add_argument("--workers", default="1,2,4,0", help="--pool のワーカー数（0 は CPU の数）")
+    parser.add_argument("--regen", type=int, help="N 枚を発行してログから作り直し、発行時と同じ画像になるかを確かめる")
+    parser.add_argument("--archive", type=int, help="N 行の全体ログを CSV と保管庫で調べて比べる")
+    parser.add_argument("--startup", type=int, help="画面の起動・再実行・発行の時間を新しいプロセスで N 回ずつ測る")
+    parser.add_argument("--think", type=float, default=STARTUP_THINK, help="--startup でログイン画面からパスワードを入力するまでの秒数")
+    parser.add_argument("--startup-probe", help=argparse.SUPPRESS)
+    parser.add_argument("--smtp-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.startup_probe:
+        print(json.dumps(_startup_probe(args.startup_probe, args.smtp_port, args.think)))
+        return 0
+
+    result = {
+        "meta": {
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "host": socket.gethostname(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "args": vars(args),
+        },
+        "runs": [],
+    }
+    with LocalSMTPServer() as smtp:
+        if args.mime:
+            mime = result["mime"] = mime_compare(args.mime, smtp.port, args.format)
+            print(f"添付 {mime['attachment_kib']} KiB")
+            for name in ("message", "builder"):
+                stats = mime[name]
+                print(
+                    f"{name:<8} 組み立て {stats['build_cpu_ms']:>7.3f} ms/通  送信 {stats['send_cpu_ms']:>7.3f} ms/通  "
+                    f"メモリ最大 {stats['peak_kib']:>8.1f} KiB（メール {stats['message_kib']} KiB）",
+                    flush=True,
+                )
+        if args.pool:
+            result["pool"] = pool_compare(args.pool, _ints(args.workers), args.format)
+            for run in result["pool"]:
+                print(
+                    f"workers={run['workers']:<6} 起動 {run['startup_s']:>6.2f} s  {run['tickets_per_sec']:>8.1f} 枚/秒"
+                    f"（{run['speedup']:.2f}x）  1枚ずつ p50 {run['single']['p50_ms']:>7.2f} ms",
+                    flush=True,
+                )
+        if args.regen:
+            regen = result["regen"] = regen_check(args.regen, smtp.port, args.format)
+            mismatched = regen["mismatched"]
+            print(f"{regen['tickets']} 枚を作り直して比べました: " + (f"違う画像 {mismatched}" if mismatched else "すべて同じ画像"))
+        if args.archive:
+            archive = result["archive"] = archive_compare(args.archive)
+            print(f"{archive['rows']} 行  CSV {archive['csv_mib']} MiB  保管庫 {archive['archive_mib']} MiB")
+            for name, stats in archive["stages"].items():
+                print(f"{name:<10} p50 {stats['p50_ms']:>10.3f} ms  p95 {stats['p95_ms']:>10.3f} ms", flush=True)
+        if args.startup:
+            startup = result["startup"] = {}
+            for pipeline in args.pipelines.split(","):
+                startup[pipeline] = app_startup(pipeline, args.startup, smtp.port, args.think)
+                print(
+                    f"{pipeline:<4} " + "  ".join(
+                        f"{name} {stats['p50_ms']:.0f} ms" for name, stats in startup[pipeline].items()
+                    ),
+                    flush=True,
+                )
+        for pipeline in [] if args.mime or args.pool or args.startup or args.archive or args.regen else args.pipelines.split(","):
+            stores = args.stores.split(",") if pipeline == "app" else ["sqlite"]
+            for store_kind in stores:
+                for log_rows in _ints(args.log_rows):
+                    for tickets in _ints(args.sizes):
+                        run = run_once(
+                            pipeline, store_kind, tickets, log_rows, smtp.port, args.format,
+                            args.base_image, args.font, args.sheets_latency,
+                        )
+                        result["runs"].append(run)
+                        ticket = run["ticket"] or {}
+                        print(
+                            f"{pipeline:<4} {run['store']:<6} log={log_rows:>6} tickets={tickets:>5}  "
+                            f"{run['tickets_per_sec'] or 0:>8.1f} 件/秒  "
+                            f"p50 {ticket.get('p50_ms', 0):>8.2f} ms  p95 {ticket.get('p95_ms', 0):>8.2f} ms",
+                            flush=True,
+                        )
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            for line in compare(json.load(f), result):
+                print(line)
+    return 1 if args.regen and result["regen"]["mismatched"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
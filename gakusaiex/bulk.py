@@ -0,0 +1,92 @@
+import os
+import pandas as pd
+from .renderer import render_ticket_file, BASE_IMAGE, FONT_PATH, DEFAULT_FORMAT
+from .renderpool import RenderPool
+from .store import normalize_email, normalize_student_id
+from .service import EMAIL_DOMAIN
+
+# ------------------------
+# 名簿の読み込み
+# 必要な列: 学籍番号, 氏名, メールID（学内メールの＠より前）
+# 学籍番号の先頭の0が消えないよう、すべて文字列として読む
+# ------------------------
+ROSTER_COLUMNS = ["学籍番号", "氏名", "メールID"]
+
+
+def read_roster(file, filename=None):
+    filename = filename or getattr(file, "name", "")
+    if filename.lower().endswith((".xlsx", ".xls")):
+        roster = pd.read_excel(file, dtype=str)
+    else:
+        roster = pd.read_csv(file, dtype=str)
+    roster.columns = [str(c).strip() for c in roster.columns]
+    missing = [c for c in ROSTER_COLUMNS if c not in roster.columns]
+    if missing:
+        raise ValueError(f"名簿に必要な列がありません: {', '.join(missing)}")
+    return roster[ROSTER_COLUMNS].fillna("")
+
+
+# ------------------------
+# 入力チェック（フォームと同じ条件を列単位でまとめて判定）
+# issued_emails / issued_ids: すでに整理券を発行したメールアドレス・学籍番号
+# ------------------------
+# past_emails / past_ids: 保管庫の過去のイベント（past_events）で発行済みのもの（TicketService.past_keys()）
+def validate_roster(roster, issued_emails=(), issued_ids=(), domain=EMAIL_DOMAIN, past_emails=(), past_ids=()):
+    result = roster.copy()
+    gakuseki = result["学籍番号"].astype(str).str.normalize("NFKC").str.replace(r"[\s-]", "", regex=True)
+    name = result["氏名"].astype(str).str.strip()
+    email_id = result["メールID"].astype(str).str.normalize("NFKC").str.strip()
+    result["学籍番号"] = gakuseki
+    result["氏名"] = name
+    result["メールID"] = email_id
+    result["メール"] = email_id + "@" + domain
+
+    # ストアの索引と同じ正規化でそろえてから照合する
+    issued = set(map(normalize_email, issued_emails))
+    issued_id_set = set(map(normalize_student_id, issued_ids))
+    past = set(map(normalize_email, past_emails))
+    past_id_set = set(map(normalize_student_id, past_ids))
+    email_key = result["メール"].str.lower()
+
+    checks = [
+        (~gakuseki.str.fullmatch(r"[0-9]{10}"), "学籍番号は10桁の数字で入力してください"),
+        (~email_id.str.fullmatch(r"[A-Za-z0-9]{7}"), "メールIDは英数字7桁で入力してください"),
+        (name == "", "氏名を入力してください"),
+        (email_key.isin(issued), "このメールにはすでに整理券が発行されています"),
+        (gakuseki.isin(issued_id_set), "この学籍番号にはすでに整理券が発行されています"),
+        (email_key.isin(past), "このメールには過去のイベントで整理券が発行されています"),
+        (gakuseki.isin(past_id_set), "この学籍番号には過去のイベントで整理券が発行されています"),
+        (email_key.duplicated(keep="first"), "名簿内でメールが重複しています"),
+        (gakuseki.duplicated(keep="first"), "名簿内で学籍番号が重複しています"),
+    ]
+    error = pd.Series("", index=result.index)
+    for mask, message in checks:
+        error = error.mask(mask & (error == ""), message)
+    result["エラー"] = error
+    return result
+
+
+# ------------------------
+# 画像の並列生成（プロセスプール）
+# pool: 常駐の RenderPool（gakusaiex.renderpool）。なければこの呼び出しの間だけプールを起動する
+# 枚数が少ないとプールの起動の方が長くかかるので、その場合はこのプロセスで描く
+# jobs: [[((x, y), 文字列, フォントサイズ), ...], ...]
+# qrs: jobs と同じ順の QR コード（((x, y), 大きさ, 文字列) か None）
+# ------------------------
+def render_many(
+    jobs, fmt=DEFAULT_FORMAT, base_path=BASE_IMAGE, font_path=FONT_PATH, workers=None, on_progress=None, qrs=None, pool=None,
+):
+    jobs = list(jobs)
+    qrs = qrs or [None] * len(jobs)
+    if pool is not None:
+        return pool.map(jobs, fmt, base_path, font_path, qrs, on_progress)
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(jobs) < 2 * workers:
+        results = []
+        for texts, qr in zip(jobs, qrs):
+            results.append(render_ticket_file(texts, fmt, base_path, font_path, qr).getvalue())
+            if on_progress:
+                on_progress(len(results), len(jobs))
+        return results
+    with RenderPool(workers) as pool:
+        return pool.map(jobs, fmt, base_path, font_path, qrs, on_progress)
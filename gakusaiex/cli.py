@@ -0,0 +1,319 @@
+import os
+import sys
+import time
+import argparse
+
+# ------------------------
+# コマンドラインから整理券を発行・再送する（Streamlit を起動しない）
+#   python -m gakusaiex issue --gakuseki 0123456789 --name 山田太郎 --email-id a123456
+#   python -m gakusaiex --event guest issue --name 山田太郎 --email taro@example.com
+#   python -m gakusaiex resend 12 15
+#   python -m gakusaiex resend --failed
+#   python -m gakusaiex resend --undelivered --from 100 --to 200   （未送信・送信失敗の整理券を作り直して再送）
+#   python -m gakusaiex lookup --email a123456@yamaguchi-u.ac.jp
+#   python -m gakusaiex gate --log tickets_copy.db   （受付で QR コードを読み取って照合する。オフラインで動く）
+#   python -m gakusaiex archive sync --all   （各イベントのログを保管庫に取り込む。gakusaiex.archive）
+#   python -m gakusaiex archive query --email a123456@yamaguchi-u.ac.jp --since 2024-04-01 --out found.tsv
+# 送信元アカウントはアプリと同じ .streamlit/secrets.toml か、環境変数
+# GAKUSAIEX_EMAIL_FROM / GAKUSAIEX_APP_PASSWORD から読む（QR コードの署名の鍵は ticket_secret / GAKUSAIEX_TICKET_SECRET）。
+# テンプレート・画像・ログの保存先はイベントの設定（events/<名前>.toml）から。オプションで上書きできる。
+# 重いモジュール（pandas・PIL）はコマンドの中で読み込む。
+# ------------------------
+SECRETS_FILE = os.path.join(".streamlit", "secrets.toml")
+SEND_WAIT = 60.0
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog="gakusaiex", description="学祭整理券の発行・再送")
+    parser.add_argument("--event", "--template", dest="event", default="live", help="イベント（events/<名前>.toml）")
+    parser.add_argument("--events", default="events", help="イベントの設定のディレクトリ")
+    parser.add_argument("--store", choices=["sqlite", "csv"])
+    parser.add_argument("--db", help="SQLite のファイル")
+    parser.add_argument("--csv", help="CSV ストアのログ")
+    parser.add_argument("--all-csv", help="CSV ストアの全体ログ")
+    parser.add_argument("--outbox", help="送信キューのファイル")
+    parser.add_argument("--archive", help="整理券の保管庫のファイル")
+    parser.add_argument("--format", help="画像形式 png / png8 / jpeg / webp")
+    parser.add_argument("--base-image", help="整理券のテンプレート画像")
+    parser.add_argument("--font", help="フォントファイル")
+    parser.add_argument("--secrets", default=SECRETS_FILE)
+    parser.add_argument("--smtp-host", default="smtp.gmail.com")
+    parser.add_argument("--smtp-port", type=int, default=465)
+    parser.add_argument("--no-ssl", action="store_true", help="平文SMTPで接続する（ローカル検証用）")
+    parser.add_argument("--per-minute", type=int, help="アカウントごとの1分あたりの送信数の上限")
+    parser.add_argument("--per-day", type=int, help="アカウントごとの1日あたりの送信数の上限")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    issue = commands.add_parser("issue", help="整理券を1枚発行する")
+    issue.add_argument("--gakuseki", default="", help="学籍番号（10桁）")
+    issue.add_argument("--name", required=True)
+    mail = issue.add_mutually_exclusive_group(required=True)
+    mail.add_argument("--email-id", help="学内メールID（英数字7桁）")
+    mail.add_argument("--email", help="メールアドレス")
+    mail.add_argument("--paper", action="store_true", help="紙で渡す（メールを送らない）")
+    issue.add_argument("--out", help="整理券画像の保存先")
+    issue.add_argument("--queue-only", action="store_true", help="送信キューに積むだけで送らない")
+
+    resend = commands.add_parser("resend", help="発行済みの整理券をもう一度送る")
+    resend.add_argument("numbers", nargs="*", type=int, help="整理券番号")
+    resend.add_argument("--failed", action="store_true", help="送信失敗になったメールをすべて再送する")
+    resend.add_argument("--undelivered", action="store_true", help="未送信・送信失敗の整理券をログから作り直して再送する")
+    resend.add_argument("--from", dest="start", type=int, help="--undelivered の整理券番号の範囲（から）")
+    resend.add_argument("--to", dest="end", type=int, help="--undelivered の整理券番号の範囲（まで）")
+    resend.add_argument("--include-queued", action="store_true", help="--undelivered で送信待ちのものも作り直す")
+    resend.add_argument("--cache", default="ticket_cache", help="再送する画像のキャッシュ")
+    resend.add_argument("--workers", type=int, default=0, help="画像を描くワーカープロセスの数（省略時は枚数が多ければ CPU の数）")
+    resend.add_argument("--queue-only", action="store_true", help="送信キューに積むだけで送らない")
+
+    lookup = commands.add_parser("lookup", help="発行済みかどうかを調べる")
+    lookup.add_argument("--email")
+    lookup.add_argument("--gakuseki")
+
+    gate = commands.add_parser("gate", help="受付で整理券の QR コードを照合して入場を記録する")
+    gate.add_argument("--log", help="ログの控え（tickets.db のコピーかタブ区切りのログ。省略時はイベントのログ）")
+    gate.add_argument("--admissions", default="gate.db", help="入場記録のファイル")
+    gate.add_argument("--allow-manual", action="store_true", help="番号の手入力を受け付ける（署名なし。学生証で本人を確かめる）")
+
+    archive = commands.add_parser("archive", help="これまでの整理券の保管庫（取り込み・検索）")
+    actions = archive.add_subparsers(dest="action", required=True)
+    sync = actions.add_parser("sync", help="イベントのログの増えた行を保管庫に取り込む")
+    sync.add_argument("--all", action="store_true", help="events/*.toml のすべてのイベント")
+    load = actions.add_parser("import", help="過去の全体ログ（CSV・タブ区切り）を取り込む")
+    load.add_argument("file")
+    load.add_argument("--as", dest="label", required=True, help="保管庫でのイベント名（例: live2024）")
+    load.add_argument("--issued-on", help="発行日時のない行の日付（YYYY-MM-DD）")
+    query = actions.add_parser("query", help="保管庫から条件に合う整理券を探す")
+    query.add_argument("--email")
+    query.add_argument("--gakuseki")
+    query.add_argument("--in", dest="labels", action="append", help="イベント名（何度でも指定できる）")
+    query.add_argument("--since", help="発行日（から）YYYY-MM-DD")
+    query.add_argument("--until", help="発行日（まで）YYYY-MM-DD")
+    query.add_argument("--limit", type=int)
+    query.add_argument("--out", help="結果の保存先（タブ区切り。省略時は画面に出す）")
+    actions.add_parser("stats", help="イベントごとの枚数と発行日時の範囲")
+    return parser
+
+
+def _secrets(path):
+    values = {}
+    if os.path.exists(path):
+        import tomllib
+
+        with open(path, "rb") as f:
+            data = tomllib.load(f)
+        values.update(data.get("config", {}))
+        values.update({k: v for k, v in data.items() if not isinstance(v, dict)})
+    values["email_from"] = os.environ.get("GAKUSAIEX_EMAIL_FROM", values.get("email_from"))
+    values["app_password"] = os.environ.get("GAKUSAIEX_APP_PASSWORD", values.get("app_password"))
+    values["ticket_secret"] = os.environ.get("GAKUSAIEX_TICKET_SECRET", values.get("ticket_secret"))
+    values.setdefault("senders", [])
+    return values
+
+
+def _event(args):
+    from .events import load_event
+
+    path = os.path.join(args.events, f"{args.event}.toml")
+    if not os.path.exists(path):
+        raise SystemExit(f"イベントの設定がありません: {path}")
+    return load_event(path)
+
+
+# args のストアの指定（--store・--db など）があればイベントの設定より優先する
+def _store(event, args=None):
+    from .store import open_store
+
+    log = {**event.log, **{k: getattr(args, k) for k in ("store", "db", "csv", "all_csv") if getattr(args, k, None)}}
+    return open_store(log["store"], log["db"], log["csv"], log["all_csv"], log["columns"])
+
+
+def _service(args, with_mail=True):
+    from .archive import HistoryArchive
+    from .service import TicketService
+
+    event = _event(args)
+    log = event.log
+    store = _store(event, args)
+    secrets = _secrets(args.secrets)
+    outbox = None
+    if with_mail:
+        from .mail import MailOutbox, GMAIL_PER_MINUTE, GMAIL_PER_DAY, sender_pools
+
+        if not secrets.get("email_from"):
+            raise SystemExit("送信元アドレスがありません（secrets.toml の email_from か GAKUSAIEX_EMAIL_FROM）")
+        password = secrets.get("app_password")
+        # パスワードがなければログインしない（ローカルの検証用SMTPなど）
+        accounts = [(secrets["email_from"] if password else None, password)]
+        accounts += [(s["email_from"], s["app_password"]) for s in secrets["senders"]]
+        pools = sender_pools(
+            args.smtp_host, args.smtp_port, accounts,
+            args.per_minute or int(secrets.get("mail_per_minute", GMAIL_PER_MINUTE)),
+            args.per_day or int(secrets.get("mail_per_day", GMAIL_PER_DAY)),
+            use_ssl=not args.no_ssl,
+        )
+        outbox = MailOutbox(args.outbox or log["outbox"], pools)
+    return TicketService(
+        store, event.template, secrets.get("email_from"), outbox, args.format or event.fmt,
+        args.base_image or event.base_image, args.font or event.font,
+        qr_secret=secrets.get("ticket_secret"),
+        archive=HistoryArchive(args.archive or log["archive"]) if event.form["past_events"] else None,
+        past_events=event.form["past_events"],
+    )
+
+
+def _send(service, tickets, queue_only):
+    if service.outbox is None or queue_only:
+        return 0
+    # 送信数の上限で待たされる分は待って送る（長く待つものは送信キューに残して終わる）
+    while (wait := service.outbox.drain()) is not None and wait <= SEND_WAIT:
+        if all(service.outbox.status_of(number) != "queued" for number in tickets):
+            break
+        time.sleep(wait)
+    failed = 0
+    for number in tickets:
+        status = service.outbox.status_of(number)
+        print(f"整理券番号 {number}: {status}")
+        failed += status != "sent"
+    for pool in service.outbox.pools:
+        pool.close()
+    return 1 if failed else 0
+
+
+def _issue(args):
+    from .service import check_fields, duplicate_message
+    from .store import PAPER_EMAIL, DuplicateTicketError
+
+    # 学籍番号は省略できる（一般の来場者）。入力された項目はフォームと同じ条件で確かめる
+    error = check_fields(args.name, args.gakuseki or None, args.email_id, args.email)
+    if error:
+        print(error, file=sys.stderr)
+        return 1
+    if args.paper:
+        email = PAPER_EMAIL
+    elif args.email_id:
+        email = f"{args.email_id}@{_event(args).form['email_domain']}"
+    else:
+        email = args.email
+    service = _service(args, with_mail=not args.paper)
+    found = service.lookup(email=email, gakuseki=args.gakuseki or None)
+    if found is not None:
+        print(duplicate_message(found), file=sys.stderr)
+        return 1
+    fields = {"gakuseki": args.gakuseki or None, "name": args.name, "email": email}
+    try:
+        number = service.issue(**fields)
+    except DuplicateTicketError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(f"整理券番号 {number} を発行しました")
+    if args.out:
+        with open(args.out, "wb") as f:
+            f.write(service.render(number, fields))
+    return _send(service, [number], args.queue_only)
+
+
+def _resend(args):
+    from .renderer import ImageCache
+    from .renderpool import RenderPool
+
+    if not args.numbers and not args.failed and not args.undelivered:
+        print("整理券番号か --failed / --undelivered を指定してください", file=sys.stderr)
+        return 1
+    service = _service(args)
+    service.image_cache = ImageCache(args.cache)
+    tickets = list(args.numbers)
+    if args.undelivered:
+        tickets += [n for n in service.undelivered(args.start, args.end, args.include_queued) if n not in tickets]
+        print(f"{len(tickets)} 件を再送します")
+    if args.workers:
+        service.render_pool = RenderPool(args.workers).start()
+    try:
+        results = service.resend_many(tickets)
+    finally:
+        if service.render_pool is not None:
+            service.render_pool.close()
+    errors = {number: result for number, result in results.items() if isinstance(result, str)}
+    for message in errors.values():
+        print(message, file=sys.stderr)
+    if args.failed:
+        print(f"{service.outbox.retry_failed()} 件を再送キューに戻しました")
+    status = _send(service, [n for n in tickets if n not in errors], args.queue_only)
+    return 1 if errors else status
+
+
+def _lookup(args):
+    from .service import duplicate_message
+
+    found = _service(args, with_mail=False).lookup(email=args.email, gakuseki=args.gakuseki)
+    if found is None:
+        print("未発行です")
+        return 1
+    print(duplicate_message(found))
+    return 0
+
+
+# スキャナ（キーボードとして1行ずつ入力される）か手入力で読み取った文字列を1行ずつ照合する
+def _gate(args):
+    from .gate import GateChecker, GATE_LABELS
+
+    secret = _secrets(args.secrets).get("ticket_secret")
+    if not secret:
+        raise SystemExit("署名の鍵がありません（secrets.toml の ticket_secret か GAKUSAIEX_TICKET_SECRET）")
+    checker = GateChecker(secret, args.log or _event(args).log["db"], args.admissions, allow_manual=args.allow_manual)
+    print(f"整理券 {len(checker)} 件・入場済み {checker.admitted_count()} 件　QR コードを読み取ってください（終了は Ctrl+D）")
+    try:
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            result, number, gakuseki, name, at = checker.check(line)
+            mark = "○" if result in ("admitted", "manual") else "×"
+            detail = "" if number is None else f"　整理券番号 {number}　学籍番号 {gakuseki or '-'}　{name or ''}"
+            if result == "already":
+                detail += f"　（{time.strftime('%H:%M:%S', time.localtime(at))} に入場）"
+            print(f"{mark} {GATE_LABELS[result]}{detail}", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"入場済み {checker.admitted_count()} 件")
+        checker.close()
+    return 0
+
+
+# --all のときは各イベントを自分のログ・保管庫で取り込む（ストアの上書きオプションは --event のイベントだけ）
+def _archive(args):
+    from .archive import HistoryArchive
+
+    if args.action == "sync":
+        if args.all:
+            from .events import load_events
+
+            events = [(event, None) for event in load_events(args.events, precompile=False).values()]
+        else:
+            events = [(_event(args), args)]
+        for event, overrides in events:
+            store = _store(event, overrides)
+            added = HistoryArchive(args.archive or event.log["archive"]).sync(store, event.name)
+            print(f"{event.name}: {added} 件を取り込みました")
+        return 0
+    archive = HistoryArchive(args.archive or _event(args).log["archive"])
+    if args.action == "import":
+        if not os.path.exists(args.file):
+            raise SystemExit(f"ファイルがありません: {args.file}")
+        print(f"{archive.import_csv(args.file, args.label, args.issued_on)} 件を取り込みました")
+        return 0
+    if args.action == "stats":
+        for event, count, first, last in archive.summary():
+            print(f"{event}\t{count}\t{first or '-'}\t{last or '-'}")
+        return 0
+    df = archive.query(args.labels, args.email, args.gakuseki, args.since, args.until, args.limit)
+    if args.out:
+        df.to_csv(args.out, sep="\t", index=False)
+        print(f"{len(df)} 件を {args.out} に保存しました")
+    else:
+        df.to_csv(sys.stdout, sep="\t", index=False)
+    return 0 if len(df) else 1
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    return {"issue": _issue, "resend": _resend, "lookup": _lookup, "gate": _gate, "archive": _archive}[args.command](args)
@@ -0,0 +1,162 @@
+import os
+import tomllib
+from .templates import TicketTemplate
+
+# ------------------------
+# イベント（整理券を配る催し）ごとの設定
+# events/<名前>.toml に1イベントずつ書く（例は events/live.toml・events/guest.toml）:
+#   title       画面のタイトル
+#   base_image  テンプレート画像        font   フォントファイル      format  画像形式
+#   [form]      入力欄（fields）・メールのドメイン・紙で渡すか・名簿から一括発行するか
+#   [log]       ログ・送信キューの保存先（イベントを同時に動かすときは別のファイルにする）
+#   [mail]      メールの件名・本文・差出人名・添付ファイル名
+#   [[layout]]  整理券画像に書く文字（位置・書式・大きさ）
+#   [qr]        受付で読み取る QR コードの位置と大きさ
+# 設定の読み込みと画像・フォント・数字グリフの準備は起動時に1回だけ行い、発行のたびには読まない。
+# ------------------------
+EVENTS_DIR = "events"
+
+# ------------------------
+# 整理券画像の既定値と画像形式
+# PIL を読み込まずに使えるよう renderer ではなくここに置く（照会・送信だけの処理では PIL を読まない）
+# ------------------------
+BASE_IMAGE = "template.png"
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+
+# 形式ごとのメール添付の MIME サブタイプと拡張子
+TICKET_FORMATS = {
+    "png": {"subtype": "png", "ext": "png"},
+    "png8": {"subtype": "png", "ext": "png"},
+    "jpeg": {"subtype": "jpeg", "ext": "jpg"},
+    "webp": {"subtype": "webp", "ext": "webp"},
+}
+DEFAULT_FORMAT = "png"
+
+
+def attachment_info(fmt=DEFAULT_FORMAT, stem="整理券"):
+    info = TICKET_FORMATS[fmt]
+    return info["subtype"], f"{stem}.{info['ext']}"
+
+# 入力欄:
+#   gakuseki  学籍番号（10桁）  name  氏名
+#   email_id  学内メールID（＠より前の7桁。ドメインは email_domain）
+#   email     メールアドレス（＠より前＋ドメインの選択。domains の最後が「その他」なら全体を入力できる）
+FORM_FIELDS = ("gakuseki", "name", "email_id", "email")
+
+DEFAULT_FORM = {
+    "fields": ["gakuseki", "name", "email_id"],
+    "email_domain": "yamaguchi-u.ac.jp",
+    "domains": [],
+    "paper": False,  # 「紙で受け取る」を選べる（メールを送らない）
+    "bulk": False,  # 名簿（CSV / Excel）から一括発行できる（gakuseki・name・email_id のとき）
+    "past_events": [],  # 保管庫（log.archive）のこのイベントで発行済みなら重複にする（例: ["2024学祭", "2025学祭"]）
+}
+
+DEFAULT_LOG = {
+    "store": "sqlite",  # sqlite / csv
+    "db": "tickets.db",
+    "csv": "tickets.csv",
+    "all_csv": "tickets_all.csv",
+    "outbox": "outbox.db",
+    "archive": "tickets_archive.db",  # これまでの整理券の保管庫（gakusaiex.archive。イベント間で共有してよい）
+    "columns": ["整理券番号", "学籍番号", "氏名", "メール"],
+}
+
+
+class EventConfigError(ValueError):
+    pass
+
+
+class Event:
+    def __init__(self, name, title, template, base_image, font, fmt="png", form=None, log=None):
+        self.name = name
+        self.title = title
+        self.template = template
+        self.base_image = base_image
+        self.font = font
+        self.fmt = fmt
+        self.form = {**DEFAULT_FORM, **(form or {})}
+        self.log = {**DEFAULT_LOG, **(log or {})}
+        self.renderer = None
+
+    def __repr__(self):
+        return f"Event({self.name!r})"
+
+    # 起動時の準備と設定の確認。画像からはみ出す文字・書式の誤りはここで EventConfigError にする
+    def precompile(self):
+        from .renderer import get_renderer
+
+        unknown = [f for f in self.form["fields"] if f not in FORM_FIELDS]
+        if unknown:
+            raise EventConfigError(f"{self.name}: 知らない入力欄 {unknown}")
+        fields = set(self.form["fields"])
+        if "name" not in fields or ("email_id" in fields) == ("email" in fields):
+            raise EventConfigError(f"{self.name}: 入力欄には name と、email_id か email のどちらかが必要")
+        if ("email_id" in fields or self.form["bulk"]) and fields != {"gakuseki", "name", "email_id"}:
+            raise EventConfigError(f"{self.name}: email_id・一括発行は gakuseki・name・email_id の入力欄で使う")
+        past = self.form["past_events"]
+        if not (isinstance(past, list) and all(isinstance(label, str) for label in past)):
+            raise EventConfigError(f"{self.name}: past_events はイベント名の文字列のリストで書く")
+        try:
+            self.template.check()
+        except (KeyError, IndexError, ValueError) as e:
+            raise EventConfigError(f"{self.name}: 件名・本文・文字の書式が正しくない（{e}）") from e
+        renderer = get_renderer([(xy, size) for xy, _, size in self.template.layout], self.base_image, self.font)
+        try:
+            base = renderer.prepare()
+        except OSError as e:
+            raise EventConfigError(f"{self.name}: テンプレート画像・フォントを読み込めない（{e}）") from e
+        boxes = [xy for xy, _, _ in self.template.layout]
+        if self.template.qr is not None:
+            (x, y), size = self.template.qr
+            boxes.append((x + size - 1, y + size - 1))
+        for x, y in boxes:
+            if not (0 <= x < base.width and 0 <= y < base.height):
+                raise EventConfigError(f"{self.name}: 位置 ({x}, {y}) がテンプレート画像（{base.width}x{base.height}）の外")
+        self.renderer = renderer
+        return self
+
+
+def _pair(value, where):
+    if not (isinstance(value, list) and len(value) == 2 and all(isinstance(v, int) for v in value)):
+        raise EventConfigError(f"{where}: 位置は [x, y] で書く")
+    return tuple(value)
+
+
+def load_event(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    with open(path, "rb") as f:
+        try:
+            data = tomllib.load(f)
+        except tomllib.TOMLDecodeError as e:
+            raise EventConfigError(f"{path}: {e}") from e
+    mail = data.get("mail", {})
+    if "subject" not in mail or "body" not in mail or not data.get("layout"):
+        raise EventConfigError(f"{path}: [mail] の subject・body と [[layout]] が必要")
+    layout = [(_pair(item["xy"], path), item["text"], int(item["size"])) for item in data["layout"]]
+    qr = data.get("qr")
+    template = TicketTemplate(
+        subject=mail["subject"],
+        body=mail["body"],
+        texts=layout,
+        sender_name=mail.get("sender_name"),
+        stem=mail.get("stem", "整理券"),
+        qr=(_pair(qr["xy"], path), int(qr["size"])) if qr else None,
+    )
+    return Event(
+        data.get("name", name), data.get("title", name), template,
+        data.get("base_image", BASE_IMAGE), data.get("font", FONT_PATH), data.get("format", DEFAULT_FORMAT),
+        data.get("form"), data.get("log"),
+    )
+
+
+# {名前: Event}（ファイル名の順）。precompile=True なら画像・フォントの準備までしておく
+def load_events(directory=EVENTS_DIR, precompile=True):
+    events = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".toml"):
+            event = load_event(os.path.join(directory, filename))
+            events[event.name] = event.precompile() if precompile else event
+    if not events:
+        raise EventConfigError(f"{directory} にイベントの設定（*.toml）がありません")
+    return events
@@ -0,0 +1,147 @@
+import base64
+import csv
+import hashlib
+import hmac
+import os
+import sqlite3
+import time
+
+# ------------------------
+# 受付（入場口）での整理券の照合
+# 整理券の QR コードには 整理券番号・学籍番号と、その署名（HMAC-SHA256）を入れる:
+#   GX1:12:0123456789:ABCDEFGHIJKLMNOP
+# 署名の鍵は secrets の ticket_secret。鍵を知らなければ番号を書き換えた整理券は作れない。
+# 照合はネットワークなしで動く（ログの控え＋入場記録のSQLiteだけ）:
+#   python -m gakusaiex gate --log tickets_copy.db
+# ログの控えは tickets.db のコピーか、ログ画面からダウンロードしたタブ区切りのファイル。
+# 入場記録は端末ごとなので、入場口が複数あるときは同じ端末（同じ gate.db）で受け付ける。
+# 番号の手入力（QR コードのない紙の整理券）は署名を確かめられないので、allow_manual=True（--allow-manual）のときだけ受け付ける。
+# ------------------------
+PREFIX = "GX1"
+SIGNATURE_BYTES = 10  # base32 で16文字。QR コードの英数字モードに収まる
+
+GATE_LABELS = {
+    "admitted": "入場OK",
+    "manual": "入場OK（署名なし：学生証で確認してください）",
+    "already": "入場済み",
+    "unknown": "発行されていない整理券",
+    "mismatch": "学籍番号がログと一致しない",
+    "invalid": "読み取れない・署名が正しくない",
+}
+
+
+class InvalidTicket(ValueError):
+    pass
+
+
+def _signature(secret, number, gakuseki):
+    digest = hmac.new(secret.encode(), f"{number}:{gakuseki or ''}".encode(), hashlib.sha256).digest()
+    return base64.b32encode(digest[:SIGNATURE_BYTES]).decode().rstrip("=")
+
+
+# QR コードに入れる文字列
+def sign(secret, number, gakuseki=None):
+    return f"{PREFIX}:{int(number)}:{gakuseki or ''}:{_signature(secret, int(number), gakuseki)}"
+
+
+# 読み取った文字列を確かめて (整理券番号, 学籍番号) を返す
+def verify(secret, payload):
+    parts = payload.strip().split(":")
+    if len(parts) != 4 or parts[0].upper() != PREFIX or not parts[1].isdigit():
+        raise InvalidTicket(payload)
+    number, gakuseki, signature = int(parts[1]), parts[2] or None, parts[3].upper()
+    if not hmac.compare_digest(signature, _signature(secret, number, gakuseki)):
+        raise InvalidTicket(payload)
+    return number, gakuseki
+
+
+# ------------------------
+# ログの控えの読み込み（整理券番号 -> (学籍番号, 氏名)）
+# ------------------------
+def _blank(value):
+    return None if value in (None, "") else str(value)
+
+
+def load_tickets(path):
+    if path.endswith(".db"):
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            return {number: (_blank(gakuseki), name) for number, gakuseki, name in conn.execute(
+                "SELECT number, gakuseki, name FROM tickets"
+            )}
+        finally:
+            conn.close()
+    with open(path, encoding="utf-8", newline="") as f:
+        header = f.readline()
+        f.seek(0)
+        reader = csv.DictReader(f, delimiter="\t" if "\t" in header else ",")
+        return {
+            int(row["整理券番号"]): (_blank(row.get("学籍番号")), row.get("氏名"))
+            for row in reader if (row.get("整理券番号") or "").strip().isdigit()
+        }
+
+
+# ------------------------
+# 照合と入場記録
+# check() は (結果, 整理券番号, 学籍番号, 氏名, 入場時刻) を返す。結果は GATE_LABELS のキー
+# 整理券は辞書、入場済みかどうかは集合で引くので、1件あたりの照合は O(1)
+# ログの控えが差し替えられたら（更新時刻が変わったら）読み込み直す
+# ------------------------
+class GateChecker:
+    def __init__(self, secret, log_path, admissions_path="gate.db", allow_manual=False):
+        self.secret = secret
+        self.log_path = log_path
+        self.allow_manual = allow_manual
+        self._log_mtime = None
+        self._tickets = {}
+        self._conn = sqlite3.connect(admissions_path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS admissions (number INTEGER PRIMARY KEY, gakuseki TEXT, admitted_at REAL NOT NULL, via TEXT)"
+        )
+        self._admitted = {number: at for number, at in self._conn.execute("SELECT number, admitted_at FROM admissions")}
+        self._refresh()
+
+    def _refresh(self):
+        mtime = os.stat(self.log_path).st_mtime_ns
+        if mtime != self._log_mtime:
+            self._tickets = load_tickets(self.log_path)
+            self._log_mtime = mtime
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def admitted_count(self):
+        return len(self._admitted)
+
+    def check(self, scanned):
+        scanned = scanned.strip()
+        self._refresh()
+        if self.allow_manual and scanned.isdigit():
+            # QR コードのない整理券は番号を手入力する（学生証で本人を確かめる）
+            number, gakuseki, via = int(scanned), None, "manual"
+        else:
+            try:
+                number, gakuseki = verify(self.secret, scanned)
+            except InvalidTicket:
+                return "invalid", None, None, None, None
+            via = "qr"
+        ticket = self._tickets.get(number)
+        if ticket is None:
+            return "unknown", number, gakuseki, None, None
+        if via == "qr" and ticket[0] != gakuseki:
+            return "mismatch", number, gakuseki, ticket[1], None
+        gakuseki, name = ticket
+        if number in self._admitted:
+            return "already", number, gakuseki, name, self._admitted[number]
+        now = time.time()
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO admissions (number, gakuseki, admitted_at, via) VALUES (?, ?, ?, ?)",
+                (number, gakuseki, now, via),
+            )
+        self._admitted[number] = now
+        return ("admitted" if via == "qr" else "manual"), number, gakuseki, name, now
+
+    def close(self):
+        self._conn.close()
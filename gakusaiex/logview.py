@@ -0,0 +1,108 @@
+import threading
+import pandas as pd
+import streamlit as st
+
+# ------------------------
+# 整理券ログの検索・絞り込み
+# number_range: (最小, 最大)  dates: (開始日, 終了日)  ※どちらも None なら絞り込まない
+# 発行日時の列があるログ（SQLite）だけ日付で絞り込める
+# ------------------------
+PAGE_SIZES = [50, 100, 500]
+
+
+def filter_log(df, text="", number_range=None, email="", dates=None):
+    mask = pd.Series(True, index=df.index)
+    if number_range and "整理券番号" in df.columns:
+        low, high = number_range
+        numbers = pd.to_numeric(df["整理券番号"], errors="coerce")
+        if low is not None:
+            mask &= numbers >= low
+        if high is not None:
+            mask &= numbers <= high
+    if email and "メール" in df.columns:
+        mask &= df["メール"].astype(str).str.contains(email.strip(), case=False, regex=False, na=False)
+    if dates and "発行日時" in df.columns:
+        start, end = dates
+        day = pd.to_datetime(df["発行日時"], errors="coerce").dt.date
+        mask &= (day >= start) & (day <= end)
+    text = (text or "").strip()
+    if text:
+        hit = pd.Series(False, index=df.index)
+        for column in df.columns:
+            hit |= df[column].astype(str).str.contains(text, case=False, regex=False, na=False)
+        mask &= hit
+    return df if mask.all() else df[mask]
+
+
+def page_of(df, page, page_size):
+    pages = max(1, -(-len(df) // page_size))
+    page = min(max(int(page), 1), pages)
+    return df.iloc[(page - 1) * page_size:page * page_size], pages
+
+
+# ------------------------
+# タブ区切りの書き出し
+# 行をまとめて少しずつ文字列にするので、大きなログでも一度に巨大な文字列を作らない。
+# 書き出した結果はログの版（store.version()）が変わるまで使い回す。
+# 書き出しの控えはプロセス全体で共有する。版はストアごとの値なので、key はイベント（ストア）ごとに変える。
+# ------------------------
+def iter_tsv(df, chunk_rows=5000):
+    if df.empty:
+        yield df.to_csv(sep="\t", index=False, lineterminator="\n").encode("utf-8")
+        return
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        yield chunk.to_csv(sep="\t", index=False, header=start == 0, lineterminator="\n").encode("utf-8")
+
+
+_exports = {}  # key -> (version, bytes)
+_exports_lock = threading.Lock()
+
+
+def export_tsv(key, version, df):
+    with _exports_lock:
+        cached = _exports.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    data = b"".join(iter_tsv(df))
+    with _exports_lock:
+        _exports[key] = (version, data)
+    return data
+
+
+# ------------------------
+# ログの表示（ページ分け）とダウンロード
+# 表示するのは1ページ分だけ。書き出しはダウンロードボタンが押されたときに行う。
+# ------------------------
+def log_viewer(df, version, key, show_label, download_label, file_name):
+    if st.checkbox(show_label, key=f"{key}_show"):
+        with st.expander("検索・絞り込み"):
+            text = st.text_input("キーワード", key=f"{key}_text")
+            email = st.text_input("メール（部分一致）", key=f"{key}_email")
+            col1, col2 = st.columns(2)
+            low = col1.number_input("整理券番号（から）", min_value=0, value=None, step=1, key=f"{key}_low")
+            high = col2.number_input("整理券番号（まで）", min_value=0, value=None, step=1, key=f"{key}_high")
+            dates = None
+            if "発行日時" in df.columns:
+                picked = st.date_input("発行日（期間）", value=(), key=f"{key}_dates")
+                if len(picked) == 2:
+                    dates = tuple(picked)
+        view = filter_log(df, text, (low, high), email, dates)
+        col1, col2 = st.columns(2)
+        page_size = col1.selectbox("1ページの件数", PAGE_SIZES, key=f"{key}_size")
+        pages = max(1, -(-len(view) // page_size))
+        page = col2.number_input(f"ページ（全 {pages}）", min_value=1, value=1, step=1, key=f"{key}_page")
+        rows, pages = page_of(view, page, page_size)
+        if len(view):
+            first = (min(page, pages) - 1) * page_size + 1
+            st.caption(f"{len(view)} 件中 {first}〜{first + len(rows) - 1} 件目")
+        st.dataframe(rows)
+
+    if not df.empty:
+        st.download_button(
+            label=download_label,
+            data=lambda: export_tsv(key, version, df),
+            file_name=file_name,
+            mime="text/plain",
+            key=f"{key}_download",
+        )
@@ -0,0 +1,558 @@
+import random
+import re
+import smtplib
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from email.header import decode_header, make_header
+from email.utils import formataddr, parseaddr
+
+# ------------------------
+# SMTP接続プール
+# ログイン済みのセッションを使い回し、毎回の TLS ハンドシェイク＋ログインを省く。
+# 使う前に NOOP で生存確認し、切れていれば張り直す。
+# ローカル検証用に use_ssl=False で平文SMTP（aiosmtpd 等）にも接続できる。
+# 接続・ログイン・送信の所要時間は metrics（gakusaiex.metrics.Metrics）に記録する。
+# limiter（TokenBucket）を渡すと、送信キューはこのアカウントの送信数の上限を守って送る。
+# ------------------------
+class SMTPPool:
+    def __init__(self, host, port, user=None, password=None, size=1, use_ssl=True, timeout=30, metrics=None, limiter=None):
+        from .metrics import Metrics
+
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.size = size
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.metrics = metrics or Metrics()
+        self.limiter = limiter
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        with self.metrics.stage("smtp_connect"):
+            if self.use_ssl:
+                server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+            else:
+                server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.user:
+                with self.metrics.stage("smtp_login"):
+                    server.login(self.user, self.password)
+        except Exception:
+            _close(server)
+            raise
+        return server
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                server = self._idle.pop() if self._idle else None
+            if server is None:
+                return self._connect()
+            if _alive(server):
+                return server
+            _close(server)
+
+    def _checkin(self, server):
+        with self._lock:
+            self._idle.append(server)
+
+    @contextmanager
+    def session(self):
+        self._slots.acquire()
+        try:
+            server = self._checkout()
+            try:
+                yield server
+            except smtplib.SMTPServerDisconnected:
+                _close(server)
+                raise
+            except smtplib.SMTPException:
+                # 4xx / 5xx の応答（宛先の拒否など）。接続は使えるのでプールに戻す
+                # （SMTPException は OSError のサブクラスなので、OSError より先に分ける）
+                self._checkin(server)
+                raise
+            except OSError:
+                _close(server)
+                raise
+            except Exception:
+                self._checkin(server)
+                raise
+            else:
+                self._checkin(server)
+        finally:
+            self._slots.release()
+
+    # NOOP 直後に切られた場合などは、新しい接続で一度だけやり直す。
+    # ただし DATA を送り始めた後の切断はやり直さない（相手が受け取っていれば二重に届く）。
+    # send は DATA の直前に started に印を付ける。smtplib の sendmail / send_message は
+    # いつ DATA を送ったか分からないので、最初から印を付けてやり直さない
+    def _send(self, send):
+        started = []
+        try:
+            with self.session() as server, self.metrics.stage("smtp_send"):
+                return send(server, started)
+        except smtplib.SMTPServerDisconnected:
+            if started:
+                raise
+            self.metrics.count("smtp_reconnect")
+            with self.session() as server, self.metrics.stage("smtp_send"):
+                return send(server, [])
+
+    def send_message(self, msg):
+        return self._send(lambda server, started: started.append(True) or server.send_message(msg))
+
+    def sendmail(self, from_addr, to_addrs, raw):
+        return self._send(lambda server, started: started.append(True) or server.sendmail(from_addr, to_addrs, raw))
+
+    # 組み立て済みのバイト列をコピーせずにソケットへ流す（_stream_data）
+    def send_raw(self, from_addr, to_addrs, raw):
+        return self._send(lambda server, started: _stream_data(server, from_addr, to_addrs, raw, started))
+
+    def close(self):
+        with self._lock:
+            servers = list(self._idle)
+            self._idle.clear()
+        for server in servers:
+            try:
+                server.quit()
+            except Exception:
+                _close(server)
+
+
+# ------------------------
+# 送信数の制限（アカウントごとのトークンバケット）
+# Gmail は1分あたり・1日あたりの送信数を超えると送れなくなり、続けるとアカウントが止められる。
+# トークンは per_minute の速さで溜まり（最大 burst 個）、1通送るごとに1個使う。
+# 1日の上限は直近24時間に送った通数で数える（送信キューが起動時に送信記録から数え直す）。
+# 送りすぎのエラーが返ってきたら pause() でしばらく休ませる。
+# ------------------------
+GMAIL_PER_MINUTE = 20
+GMAIL_PER_DAY = 500
+DAY = 24 * 60 * 60
+
+
+class TokenBucket:
+    def __init__(self, per_minute=GMAIL_PER_MINUTE, per_day=GMAIL_PER_DAY, burst=None):
+        self.rate = per_minute / 60.0
+        self.burst = burst or max(1, per_minute // 4)
+        self.per_day = per_day
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._sent = deque()  # 直近24時間に送った時刻
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    # 送信キューの記録から足し込む（イベントごとの送信キューが同じアカウントを使うとき、それぞれの分を合わせる）
+    def seed(self, sent_times):
+        since = time.time() - DAY
+        with self._lock:
+            self._sent = deque(sorted([*self._sent, *(t for t in sent_times if t > since)]))
+
+    # 1通分のトークンを取る。取れたら 0、取れなければ次に取れるまでの秒数を返す
+    def take(self):
+        with self._lock:
+            now, wall = time.monotonic(), time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            while self._sent and self._sent[0] <= wall - DAY:
+                self._sent.popleft()
+            if wall < self._paused_until:
+                return self._paused_until - wall
+            if self.per_day and len(self._sent) >= self.per_day:
+                return self._sent[0] + DAY - wall
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+            self._sent.append(wall)
+            return 0.0
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+            self._tokens = 0.0
+
+    def sent_today(self):
+        since = time.time() - DAY
+        with self._lock:
+            return sum(1 for t in self._sent if t > since)
+
+
+# accounts: [(送信元アドレス, アプリパスワード), ...]。アカウントごとに接続プールと送信数の上限を持つ
+def sender_pools(host, port, accounts, per_minute=GMAIL_PER_MINUTE, per_day=GMAIL_PER_DAY, metrics=None, **kwargs):
+    return [
+        SMTPPool(host, port, user, password, metrics=metrics, limiter=TokenBucket(per_minute, per_day), **kwargs)
+        for user, password in accounts
+    ]
+
+
+# ------------------------
+# 送信エラーの分類
+#   transient  接続切れ・4xx など一時的なもの。間隔をあけて再送する
+#   throttled  送りすぎ（421、4.7.0、Gmail の 5.4.5 など）。そのアカウントを休ませて再送する（試行回数に数えない）
+#   account    ログインできない・送信元を拒否された。そのアカウントを休ませて、他のアカウントで再送する
+#   permanent  宛先が存在しないなど、それ以外の 5xx。再送しても届かないのですぐ送信失敗にする
+# ------------------------
+THROTTLE_PAUSE = 120.0
+QUOTA_PAUSE = 60 * 60.0
+ACCOUNT_PAUSE = 10 * 60.0
+_THROTTLE_MARKERS = ("4.7.0", "4.7.28", "4.2.1", "5.4.5", "rate", "quota", "too many", "try again later")
+
+
+def _response(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused) and error.recipients:
+        return next(iter(error.recipients.values()))
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code, error.smtp_error
+    return None, b""
+
+
+def classify_error(error):
+    if isinstance(error, (smtplib.SMTPAuthenticationError, smtplib.SMTPSenderRefused)):
+        return "account"
+    code, text = _response(error)
+    if code is None:
+        return "transient"
+    text = (text.decode("utf-8", "replace") if isinstance(text, bytes) else str(text)).lower()
+    if code == 421 or any(marker in text for marker in _THROTTLE_MARKERS):
+        return "throttled"
+    if code in (530, 534, 535):
+        return "account"
+    return "transient" if code < 500 else "permanent"
+
+
+# 別のアカウントで送るときは From を送信に使うアカウントに書き換え、返信は元の送信元に届くようにする
+# 差出人名（日本語は符号化されて折り返されている）は残し、From ヘッダー全体を作り直す
+_FROM_HEADER = re.compile(rb"^From:[^\r\n]*(?:\r\n[ \t][^\r\n]*)*", re.IGNORECASE | re.MULTILINE)
+
+
+def _from_header(header, account):
+    from .templates import WIRE_POLICY
+
+    value = re.sub(rb"\r\n(?=[ \t])", b"", header)[len(b"From:"):].decode("ascii", "replace").strip()
+    name, _ = parseaddr(str(make_header(decode_header(value))))
+    return WIRE_POLICY.fold("From", formataddr((name, account)) if name else account).rstrip("\r\n").encode("ascii")
+
+
+def _with_sender(raw, original, account):
+    head, sep, body = raw.partition(b"\r\n\r\n")
+    head = _FROM_HEADER.sub(lambda m: _from_header(m.group(0), account), head, count=1)
+    if not re.search(rb"^Reply-To:", head, re.IGNORECASE | re.MULTILINE):
+        head = b"Reply-To: " + original.encode() + b"\r\n" + head
+    return head + sep + body
+
+
+# SMTP に流すときの形（改行は CRLF）。sendmail は bytes の改行を直さないのでここで揃える
+def _wire_bytes(msg):
+    return msg.as_bytes(policy=msg.policy.clone(linesep="\r\n"))
+
+
+# ------------------------
+# DATA の本体をソケットへ少しずつ書く
+# smtplib の sendmail は行頭の "." を二重にするためにメール全体をコピーし、末尾の改行を足すのにもう一度コピーする。
+# 行頭に "." がなく改行が CRLF のバイト列（templates.MessageBuilder の出力）ならそのまま流してよい
+# ------------------------
+STREAM_CHUNK = 64 * 1024
+
+
+def _rset(server):
+    try:
+        server.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+# started: DATA を送る直前に印を付けるリスト（SMTPPool._send がやり直してよいかの判断に使う）
+def _stream_data(server, from_addr, to_addrs, raw, started=None):
+    started = [] if started is None else started
+    if raw[:1] == b"." or b"\r\n." in raw:
+        started.append(True)
+        return server.sendmail(from_addr, to_addrs, bytes(raw))
+    server.ehlo_or_helo_if_needed()
+    code, resp = server.mail(from_addr)
+    if code != 250:
+        _rset(server)
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    refused = {}
+    for addr in to_addrs:
+        code, resp = server.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    if len(refused) == len(to_addrs):
+        _rset(server)
+        raise smtplib.SMTPRecipientsRefused(refused)
+    started.append(True)
+    code, resp = server.docmd("DATA")
+    if code != 354:
+        _rset(server)
+        raise smtplib.SMTPDataError(code, resp)
+    if server.sock is None:
+        raise smtplib.SMTPServerDisconnected("please run connect() first")
+    view = memoryview(raw)
+    for i in range(0, len(view), STREAM_CHUNK):
+        server.sock.sendall(view[i:i + STREAM_CHUNK])
+    server.sock.sendall(b".\r\n" if raw.endswith(b"\r\n") else b"\r\n.\r\n")
+    code, resp = server.getreply()
+    if code != 250:
+        _rset(server)
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+def _alive(server):
+    try:
+        return server.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+def _close(server):
+    try:
+        server.close()
+    except Exception:
+        pass
+
+
+# ------------------------
+# 送信待ちメールの永続キュー（outbox）
+# 整理券の発行はメールをキューに積むだけで終わり、送信はバックグラウンドの
+# ワーカーが行う。失敗したら間隔を伸ばしながら（ゆらぎを入れて）再送し、上限回数で failed にする。
+# 宛先不明など再送しても届かないエラーはすぐ failed にする（classify_error）。
+# DATA を送った後に接続が切れたメールも再送する（相手が受け取っていた場合は二重に届く。届かないよりよい）。
+# pool に SMTPPool のリストを渡すと、送信数の上限に余裕のあるアカウントから順に使う。
+# 状態: queued（送信待ち） / sent（送信済み） / failed（送信失敗）
+# 送信済みのメールは本文（添付の画像を含む）を消して記録だけ残す。再送は整理券をログから作り直すので本文は使わない。
+# 空いたページは次のメールに使い回し、起動時にファイルを縮める（auto_vacuum は新しく作ったファイルだけ）
+# ------------------------
+STATUS_LABELS = {"queued": "送信待ち", "sent": "送信済み", "failed": "送信失敗"}
+
+
+class MailOutbox:
+    def __init__(self, path, pool, max_attempts=5, base_delay=2.0, max_delay=300.0):
+        self.path = path
+        self.pools = list(pool) if isinstance(pool, (list, tuple)) else [pool]
+        self.pool = self.pools[0]
+        self._next_pool = 0
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        with self._connect() as conn:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ticket TEXT,
+                    sender TEXT NOT NULL,
+                    recipient TEXT NOT NULL,
+                    message BLOB NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    last_error TEXT,
+                    account TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            if "account" not in {row["name"] for row in conn.execute("PRAGMA table_info(outbox)")}:
+                conn.execute("ALTER TABLE outbox ADD COLUMN account TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt)")
+            # 本文を消す前のファイルで送信済みになっているもの
+            conn.execute("UPDATE outbox SET message = X'' WHERE status = 'sent' AND length(message) > 0")
+            conn.executescript("PRAGMA incremental_vacuum;")  # execute() では1ページしか空けない
+            # 直近24時間に各アカウントで送った通数（1日の上限）を数え直す
+            for pool in self.pools:
+                if pool.limiter is not None:
+                    pool.limiter.seed(
+                        row[0] for row in conn.execute(
+                            "SELECT updated_at FROM outbox WHERE status = 'sent' AND account IS ? AND updated_at > ?",
+                            (pool.user, time.time() - DAY),
+                        )
+                    )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    # msg: email.message.Message か、組み立て済みのバイト列（templates.MessageBuilder。sender・recipient を渡す）
+    def enqueue(self, msg, ticket=None, sender=None, recipient=None):
+        if isinstance(msg, (bytes, bytearray)):
+            raw = msg
+        else:
+            sender = sender or parseaddr(msg["From"])[1]
+            recipient = recipient or parseaddr(msg["To"])[1]
+            raw = _wire_bytes(msg)
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                "INSERT INTO outbox (ticket, sender, recipient, message, next_attempt, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (None if ticket is None else str(ticket), sender, recipient, raw, now, now, now),
+            )
+            outbox_id = cur.lastrowid
+        self._wake.set()
+        return outbox_id
+
+    # ------------------------
+    # バックグラウンド送信
+    # ------------------------
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="mail-outbox", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            wait = self.drain()
+            self._wake.wait(wait)
+            self._wake.clear()
+
+    # 待ち時間の後半にゆらぎを入れ、一斉に再送しないようにする
+    def _delay(self, attempts):
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    # 送信数の上限に余裕のあるアカウントを順番に選ぶ。なければ (None, 次に送れるまでの秒数)
+    def _pick(self):
+        wait = None
+        for i in range(len(self.pools)):
+            pool = self.pools[(self._next_pool + i) % len(self.pools)]
+            delay = 0.0 if pool.limiter is None else pool.limiter.take()
+            if delay == 0.0:
+                self._next_pool = (self._next_pool + i + 1) % len(self.pools)
+                return pool, 0.0
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    # 期限の来たメールを送り、次に確認するまでの秒数を返す
+    def drain(self, limit=50):
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, sender, recipient, message, attempts FROM outbox"
+                " WHERE status = 'queued' AND next_attempt <= ? ORDER BY id LIMIT ?",
+                (now, limit),
+            ).fetchall()
+        throttled = None
+        for row in rows:
+            if self._stop.is_set():
+                break
+            pool, throttled = self._pick()
+            if pool is None:
+                break
+            sender, message = row["sender"], row["message"]
+            if pool.user and pool.user != sender:
+                sender, message = pool.user, _with_sender(message, row["sender"], pool.user)
+            try:
+                pool.send_raw(sender, [row["recipient"]], message)
+            except Exception as e:
+                self._mark_failure(row["id"], row["attempts"], e, pool)
+            else:
+                self._mark(row["id"], "sent", row["attempts"] + 1, None, account=pool.user)
+        with self._connect() as conn:
+            nxt = conn.execute("SELECT MIN(next_attempt) FROM outbox WHERE status = 'queued'").fetchone()[0]
+        if nxt is None:
+            return None
+        wait = max(nxt - time.time(), 0.0)
+        return wait if not throttled else max(wait, throttled)
+
+    def _mark(self, outbox_id, status, attempts, error, next_attempt=None, account=None):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, last_error = ?, next_attempt = COALESCE(?, next_attempt),"
+                " account = COALESCE(?, account), updated_at = ? WHERE id = ?",
+                (status, attempts, error, next_attempt, account, now, outbox_id),
+            )
+            if status == "sent":
+                conn.execute("UPDATE outbox SET message = X'' WHERE id = ?", (outbox_id,))
+
+    def _mark_failure(self, outbox_id, attempts, error, pool):
+        kind = classify_error(error)
+        metrics = pool.metrics
+        if kind in ("throttled", "account"):
+            # アカウント側の問題なのでメールはそのまま待たせ、試行回数にも数えない
+            pause = ACCOUNT_PAUSE if kind == "account" else QUOTA_PAUSE if "5.4.5" in str(error) else THROTTLE_PAUSE
+            if pool.limiter is not None:
+                # 休ませるのはアカウント。メールは他のアカウントが空いていればすぐ送る
+                pool.limiter.pause(pause)
+                pause = random.uniform(0, 1)
+            metrics.count("mail_throttled" if kind == "throttled" else "smtp_account_error")
+            self._mark(outbox_id, "queued", attempts, f"{pool.user or ''}: {error}", time.time() + pause)
+            return
+        attempts += 1
+        if kind == "permanent" or attempts >= self.max_attempts:
+            metrics.count("mail_failed")
+            self._mark(outbox_id, "failed", attempts, str(error))
+        else:
+            metrics.count("mail_retry")
+            self._mark(outbox_id, "queued", attempts, str(error), time.time() + self._delay(attempts))
+
+    # ------------------------
+    # 状態確認・再送
+    # ------------------------
+    def statuses(self, limit=None):
+        sql = (
+            "SELECT id, ticket, recipient, status, attempts, last_error, created_at, updated_at"
+            " FROM outbox ORDER BY id DESC"
+        )
+        params = ()
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = (limit,)
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(sql, params)]
+
+    def status_of(self, ticket):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT status FROM outbox WHERE ticket = ? ORDER BY id DESC LIMIT 1", (str(ticket),)
+            ).fetchone()
+        return None if row is None else row["status"]
+
+    # 整理券番号ごとの最新の状態 {整理券番号: 状態}
+    def latest_statuses(self):
+        with self._connect() as conn:
+            return {
+                int(row["ticket"]): row["status"] for row in conn.execute(
+                    "SELECT ticket, status FROM outbox WHERE id IN (SELECT MAX(id) FROM outbox WHERE ticket IS NOT NULL GROUP BY ticket)"
+                )
+            }
+
+    def counts(self):
+        with self._connect() as conn:
+            return {row["status"]: row["n"] for row in conn.execute("SELECT status, COUNT(*) AS n FROM outbox GROUP BY status")}
+
+    def retry_failed(self):
+        now = time.time()
+        with self._connect() as conn:
+            n = conn.execute(
+                "UPDATE outbox SET status = 'queued', attempts = 0, next_attempt = ?, updated_at = ? WHERE status = 'failed'",
+                (now, now),
+            ).rowcount
+        self._wake.set()
+        return n
@@ -0,0 +1,154 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# ------------------------
+# 発行処理の段階ごとの所要時間（プロセス内のリングバッファ）
+# 直近 size 件だけを持つので、受付が何時間続いてもメモリは増えない。
+# 段階:
+#   validate      入力チェック・重複チェック    log_write     番号の割り当てとログ保存
+#   render        画像の描画（RenderPool ではエンコードも含む）  encode  画像のエンコード
+#   bulk_render   一括発行・まとめての再送の画像の描画
+#   message       メールの組み立て              enqueue       送信キューに積む
+#   smtp_connect  SMTPサーバーへの接続          smtp_login    SMTPのログイン
+#   smtp_send     SMTPでの送信
+# 回数だけ数えるもの:
+#   issued        発行枚数                      smtp_reconnect 切断されて張り直した回数
+#   mail_retry    送信失敗→再送待ちにした回数   mail_failed   再送の上限に達して失敗にした回数
+# ------------------------
+STAGE_LABELS = {
+    "validate": "入力チェック",
+    "log_write": "ログ保存",
+    "render": "画像の描画",
+    "bulk_render": "画像の描画（一括）",
+    "encode": "画像のエンコード",
+    "message": "メールの組み立て",
+    "enqueue": "送信キュー",
+    "smtp_connect": "SMTP接続",
+    "smtp_login": "SMTPログイン",
+    "smtp_send": "SMTP送信",
+}
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))]
+
+
+class Metrics:
+    def __init__(self, size=5000):
+        self._samples = deque(maxlen=size)  # (時刻, 段階, 秒, 成功したか)
+        self._events = deque(maxlen=size)  # (時刻, 名前, 回数)
+        self._totals = {}  # 起動からの累計（Prometheus の counter 用）
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    # ------------------------
+    # 記録
+    # ------------------------
+    def record(self, stage, seconds, ok=True):
+        with self._lock:
+            self._samples.append((time.time(), stage, seconds, ok))
+            count, total, errors = self._totals.get(stage, (0, 0.0, 0))
+            self._totals[stage] = (count + 1, total + seconds, errors + (not ok))
+
+    # 例外で抜けたら失敗として記録する（例外はそのまま投げ直す）
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.record(name, time.perf_counter() - start, ok)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._events.append((time.time(), name, n))
+            self._totals[name] = self._totals.get(name, 0) + n
+
+    # ------------------------
+    # 集計（直近 window 秒）
+    # ------------------------
+    def _since(self, window):
+        since = time.time() - window if window else 0
+        with self._lock:
+            samples = [s for s in self._samples if s[0] >= since]
+            events = [e for e in self._events if e[0] >= since]
+        return samples, events
+
+    # {"stages": {段階: {n, errors, p50_ms, p95_ms, max_ms}}, "counts": {名前: 回数}, "per_minute": 発行枚数/分}
+    def summary(self, window=300):
+        samples, events = self._since(window)
+        by_stage = {}
+        for _, stage, seconds, ok in samples:
+            by_stage.setdefault(stage, ([], [0]))
+            by_stage[stage][0].append(seconds)
+            by_stage[stage][1][0] += not ok
+        stages = {}
+        for stage, (values, errors) in by_stage.items():
+            values.sort()
+            stages[stage] = {
+                "n": len(values),
+                "errors": errors[0],
+                "p50_ms": round(_percentile(values, 0.50) * 1000, 1),
+                "p95_ms": round(_percentile(values, 0.95) * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1),
+            }
+        counts = {}
+        for _, name, n in events:
+            counts[name] = counts.get(name, 0) + n
+        # 起動直後は経過時間で割るが、1分未満で割ると値が跳ねるので最低1分とする
+        span = max(min(window, time.time() - self.started) if window else time.time() - self.started, 60)
+        return {
+            "stages": stages,
+            "counts": counts,
+            "per_minute": round(counts.get("issued", 0) * 60 / span, 1),
+        }
+
+    # ------------------------
+    # 書き出し
+    # ------------------------
+    # Prometheus のテキスト形式。分位点はリングバッファの中身から、_count / _sum / counter は起動からの累計
+    def prometheus(self, window=300, prefix="gakusaiex"):
+        summary = self.summary(window)
+        with self._lock:
+            totals = dict(self._totals)
+        lines = [
+            f"# HELP {prefix}_stage_seconds Issuance stage latency (quantiles over the last {window}s).",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for stage, stats in sorted(summary["stages"].items()):
+            for q, key in ((0.5, "p50_ms"), (0.95, "p95_ms")):
+                lines.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="{q}"}} {stats[key] / 1000:.6f}')
+        for stage, value in sorted(totals.items()):
+            if isinstance(value, tuple):
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {value[0]}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {value[1]:.6f}')
+        lines += [
+            f"# HELP {prefix}_stage_errors_total Issuance stages that raised.",
+            f"# TYPE {prefix}_stage_errors_total counter",
+        ]
+        for stage, value in sorted(totals.items()):
+            if isinstance(value, tuple):
+                lines.append(f'{prefix}_stage_errors_total{{stage="{stage}"}} {value[2]}')
+        lines += [
+            f"# HELP {prefix}_events_total Issued tickets, SMTP reconnects and mail retries/failures.",
+            f"# TYPE {prefix}_events_total counter",
+        ]
+        for name, value in sorted(totals.items()):
+            if not isinstance(value, tuple):
+                lines.append(f'{prefix}_events_total{{event="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    # 1行1件の JSON（リングバッファの中身をそのまま）
+    def jsonl(self):
+        with self._lock:
+            samples = list(self._samples)
+            events = list(self._events)
+        rows = [{"time": t, "stage": stage, "seconds": round(seconds, 6), "ok": ok} for t, stage, seconds, ok in samples]
+        rows += [{"time": t, "event": name, "count": n} for t, name, n in events]
+        rows.sort(key=lambda row: row["time"])
+        return "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
@@ -0,0 +1,308 @@
+import os
+import io
+import sys
+import hashlib
+import time
+import threading
+from PIL import Image, ImageDraw, ImageFont
+# 既定のテンプレート・フォントと画像形式は PIL を使わない events にある（ここからも import できる）
+from .events import BASE_IMAGE, FONT_PATH, TICKET_FORMATS, DEFAULT_FORMAT, attachment_info
+
+# ------------------------
+# テンプレート・フォントのキャッシュ（プロセス全体で共有）
+# ファイルの更新時刻が変わったら読み込み直す
+# ------------------------
+_lock = threading.Lock()
+_base_cache = {}  # path -> (mtime, Image)
+_font_cache = {}  # (path, size) -> (mtime, FreeTypeFont)
+
+
+def _mtime(path):
+    return os.stat(path).st_mtime_ns
+
+
+def load_base(path=BASE_IMAGE):
+    mtime = _mtime(path)
+    cached = _base_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with _lock:
+        cached = _base_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with Image.open(path) as src:
+            image = src.convert("RGB")
+        image.load()
+        _base_cache[path] = (mtime, image)
+        return image
+
+
+def load_font(size, path=FONT_PATH):
+    mtime = _mtime(path)
+    key = (path, size)
+    cached = _font_cache.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with _lock:
+        cached = _font_cache.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        font = ImageFont.truetype(path, size)
+        _font_cache[key] = (mtime, font)
+        return font
+
+
+def clear_cache():
+    with _lock:
+        _base_cache.clear()
+        _font_cache.clear()
+        _renderers.clear()
+
+
+# ------------------------
+# 整理券画像の生成
+# texts: [((x, y), 文字列, フォントサイズ), ...]
+# ------------------------
+def render_ticket(texts, base_path=BASE_IMAGE, font_path=FONT_PATH):
+    image = load_base(base_path).copy()
+    draw = ImageDraw.Draw(image)
+    for xy, text, size in texts:
+        draw.text(xy, text, font=load_font(size, font_path), fill="black")
+    return image
+
+
+# ------------------------
+# 出力形式（メール添付用のエンコード設定）
+# png  : 圧縮レベルを下げた通常PNG（既定）
+# png8 : 64色パレットに減色したPNG（小さい・QRや数字はそのまま読める）
+# jpeg : 4:4:4 サンプリングのJPEG（エンコードが最速）
+# webp : WebP（最小サイズ）
+# ------------------------
+
+
+def encode_ticket(image, fmt=DEFAULT_FORMAT, buffer=None):
+    if fmt not in TICKET_FORMATS:
+        raise ValueError(f"未対応の画像形式です: {fmt}")
+    if buffer is None:
+        buffer = io.BytesIO()
+    if fmt == "png":
+        image.save(buffer, format="PNG", compress_level=1)
+    elif fmt == "png8":
+        image.quantize(colors=64, method=Image.Quantize.FASTOCTREE).save(buffer, format="PNG", compress_level=6)
+    elif fmt == "jpeg":
+        image.save(buffer, format="JPEG", quality=90, subsampling=0)
+    elif fmt == "webp":
+        image.save(buffer, format="WEBP", quality=85, method=2)
+    buffer.seek(0)
+    return buffer
+
+
+# ------------------------
+# 数字グリフの事前描画（0〜9 を一度だけラスタライズして使い回す）
+# ------------------------
+class GlyphStrip:
+    def __init__(self, font, chars="0123456789"):
+        self.glyphs = {}
+        for ch in chars:
+            left, top, right, bottom = font.getbbox(ch)
+            mask = Image.new("L", (max(right - left, 1), max(bottom - top, 1)), 0)
+            ImageDraw.Draw(mask).text((-left, -top), ch, font=font, fill=255)
+            self.glyphs[ch] = (mask, left, top, font.getlength(ch))
+
+    def covers(self, text):
+        return all(ch in self.glyphs for ch in text)
+
+    def draw(self, image, xy, text, fill="black"):
+        x, y = xy
+        for ch in text:
+            mask, left, top, advance = self.glyphs[ch]
+            image.paste(fill, (round(x) + left, y + top), mask)
+            x += advance
+
+
+# ------------------------
+# QRコード（受付で読み取る署名入りの文字列。gate.py を参照）
+# モジュール単位で整数倍に拡大し、size 以下で一番大きく描く
+# ------------------------
+def qr_image(payload, size):
+    import segno
+
+    rows = [bytes(0 if dark else 255 for dark in row) for row in segno.make(payload, error="m", micro=False).matrix_iter(border=2)]
+    n = len(rows)
+    scale = max(1, size // n)
+    return Image.frombytes("L", (n, n), b"".join(rows)).resize((n * scale, n * scale), Image.NEAREST).convert("RGB")
+
+
+# ------------------------
+# 差分描画
+# テンプレートは固定なので、番号・学籍番号などの文字部分の矩形だけを
+# 小さなタイルに描いて、スレッドごとの作業用キャンバスに貼り付ける。
+# 前回の文字が残らないよう、前回の矩形もテンプレートから復元する。
+# ------------------------
+def _union(a, b):
+    if a is None:
+        return b
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+class DirtyRegionRenderer:
+    # layout: [((x, y), フォントサイズ), ...]
+    def __init__(self, layout, base_path=BASE_IMAGE, font_path=FONT_PATH):
+        self.layout = tuple(layout)
+        self.base_path = base_path
+        self.font_path = font_path
+        self._strips = {}
+        self._local = threading.local()
+
+    def _strip(self, size):
+        font = load_font(size, self.font_path)
+        strip = self._strips.get(size)
+        if strip is None or strip[0] is not font:
+            strip = (font, GlyphStrip(font))
+            self._strips[size] = strip
+        return strip[1]
+
+    # テンプレート画像・フォント・数字グリフを先に読み込んでおく（最初の発行を待たせない）
+    def prepare(self):
+        base = load_base(self.base_path)
+        for _, size in self.layout:
+            self._strip(size)
+        _file_digest(self.base_path)
+        _file_digest(self.font_path)
+        return base
+
+    def _canvas(self):
+        base = load_base(self.base_path)
+        local = self._local
+        if getattr(local, "base", None) is not base:
+            # 初回 or テンプレートが更新された
+            local.base = base
+            local.canvas = base.copy()
+            local.dirty = [None] * len(self.layout)
+            local.qr_box = None
+        return base, local
+
+    # 返す画像はスレッドごとに使い回すので、次の render までにエンコードすること
+    # qr: ((x, y), 一辺の大きさ, 埋め込む文字列)。前回の QR コードは消してから貼る
+    def render(self, values, qr=None):
+        base, local = self._canvas()
+        canvas = local.canvas
+        if local.qr_box is not None:
+            canvas.paste(base.crop(local.qr_box), local.qr_box[:2])
+            local.qr_box = None
+        for i, ((xy, size), text) in enumerate(zip(self.layout, values)):
+            text = str(text)
+            font = load_font(size, self.font_path)
+            box = font.getbbox(text) if text else (0, 0, 0, 0)
+            box = (xy[0] + box[0], xy[1] + box[1], xy[0] + box[2], xy[1] + box[3])
+            region = _union(local.dirty[i], box)
+            region = (max(region[0], 0), max(region[1], 0), min(region[2], base.width), min(region[3], base.height))
+            if region[2] <= region[0] or region[3] <= region[1]:
+                local.dirty[i] = None
+                continue
+            tile = base.crop(region)
+            origin = (xy[0] - region[0], xy[1] - region[1])
+            strip = self._strip(size)
+            if strip.covers(text):
+                strip.draw(tile, origin, text)
+            else:
+                ImageDraw.Draw(tile).text(origin, text, font=font, fill="black")
+            canvas.paste(tile, region[:2])
+            local.dirty[i] = box
+        if qr is not None:
+            xy, size, payload = qr
+            code = qr_image(payload, size)
+            canvas.paste(code, xy)
+            local.qr_box = (xy[0], xy[1], xy[0] + code.width, xy[1] + code.height)
+        return canvas
+
+    def render_file(self, values, fmt=DEFAULT_FORMAT, qr=None):
+        return encode_ticket(self.render(values, qr), fmt)
+
+
+_renderers = {}
+
+
+def get_renderer(layout, base_path=BASE_IMAGE, font_path=FONT_PATH):
+    key = (tuple(layout), base_path, font_path)
+    renderer = _renderers.get(key)
+    if renderer is None:
+        with _lock:
+            renderer = _renderers.setdefault(key, DirtyRegionRenderer(layout, base_path, font_path))
+    return renderer
+
+
+def render_ticket_file(texts, fmt=DEFAULT_FORMAT, base_path=BASE_IMAGE, font_path=FONT_PATH, qr=None):
+    renderer = get_renderer([(xy, size) for xy, _, size in texts], base_path, font_path)
+    return renderer.render_file([text for _, text, _ in texts], fmt, qr)
+
+
+# ------------------------
+# 描画済み画像のキャッシュ（再送用）
+# 描画は決定的（同じ入力なら同じバイト列）なので、入力の内容のハッシュをキーにして
+# エンコード済みの画像をファイルに置く。同じ整理券を何度再送しても描画は1回で済む。
+# キーにはテンプレート画像・フォントの中身のハッシュも入るので、差し替えれば描き直す。
+# ディレクトリはいつ消してもよい。
+# ------------------------
+_digests = {}  # path -> (mtime, sha256)
+
+
+def _file_digest(path):
+    mtime = _mtime(path)
+    cached = _digests.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, "rb") as f:
+            cached = (mtime, hashlib.file_digest(f, "sha256").hexdigest())
+        _digests[path] = cached
+    return cached[1]
+
+
+def render_key(texts, fmt=DEFAULT_FORMAT, base_path=BASE_IMAGE, font_path=FONT_PATH, qr=None):
+    inputs = (list(texts), fmt, qr, _file_digest(base_path), _file_digest(font_path))
+    return hashlib.sha256(repr(inputs).encode()).hexdigest()
+
+
+class ImageCache:
+    def __init__(self, directory="ticket_cache"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        tmp = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+
+
+# ------------------------
+# 各形式のサイズ・エンコード時間を比較
+# ------------------------
+def encode_report(image, formats=None, repeat=5):
+    report = []
+    for fmt in formats or TICKET_FORMATS:
+        times = []
+        size = 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            size = len(encode_ticket(image, fmt).getbuffer())
+            times.append(time.perf_counter() - start)
+        report.append({"format": fmt, "bytes": size, "encode_ms": round(min(times) * 1000, 2)})
+    return report
+
+
+if __name__ == "__main__":
+    # python -m gakusaiex.renderer [template.png]
+    base = sys.argv[1] if len(sys.argv) > 1 else BASE_IMAGE
+    sample = render_ticket([((680, 300), "123", 90), ((660, 500), "1234567890", 36)], base)
+    for row in encode_report(sample):
+        print(f"{row['format']:>5}  {row['bytes']:>8} bytes  {row['encode_ms']:>7} ms")
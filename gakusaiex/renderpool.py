@@ -0,0 +1,140 @@
+import os
+import sys
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from .renderer import get_renderer, render_ticket_file, BASE_IMAGE, FONT_PATH, DEFAULT_FORMAT
+
+# ------------------------
+# 画像生成のプロセスプール（常駐）
+# ワーカーは起動時にテンプレート画像・フォント・数字グリフを読み込んでおき（preload）、
+# 描画ジョブ（文字の配置・画像形式・QR コード）を受け取ってエンコード済みのバイト列を返す。
+# 画面からの発行・一括発行・再送のどれもここで描くので、描画が Streamlit のスレッドを止めず、全コアを使える。
+# 結果はバイト列のまま返す。整理券1枚は数百KBで、受け渡しにかかる時間は描画の1%に満たないので
+# 共有メモリは使わない（python -m gakusaiex.bench --pool で確かめられる）。
+# ワーカーは pandas などを読み込まない（このモジュールと renderer だけ）。
+# Streamlit はスレッドを多数抱えているので fork ではなく spawn で起動する
+# preload: [(layout, テンプレート画像, フォント), ...]  layout は [((x, y), フォントサイズ), ...]
+# ------------------------
+START_TIMEOUT = 120
+
+_spawn_lock = threading.Lock()
+
+
+# Streamlit はアプリのスクリプトを __main__ として実行するので、そのまま spawn すると
+# ワーカーがアプリのスクリプトを読み込み直して（送信キューやこのプールまで）起動してしまう。
+# ワーカーは __main__ を使わないので、起動する間だけ __main__ の場所を隠す
+@contextmanager
+def _hidden_main():
+    with _spawn_lock:
+        main = sys.modules.get("__main__")
+        saved = dict(main.__dict__) if main is not None else {}
+        if main is not None:
+            main.__dict__.pop("__file__", None)
+            main.__spec__ = None
+        try:
+            yield
+        finally:
+            if main is not None:
+                for key in ("__file__", "__spec__"):
+                    if key in saved:
+                        setattr(main, key, saved[key])
+
+
+# 全ワーカーがそろうまで待つ（待っている間は空いていないので、submit のたびに次のワーカーが起動される）
+def _init_worker(preload, barrier):
+    for layout, base_path, font_path in preload:
+        get_renderer(layout, base_path, font_path).prepare()
+    barrier.wait(START_TIMEOUT)
+
+
+def _ready():
+    return os.getpid()
+
+
+def _render_job(args):
+    texts, fmt, base_path, font_path, qr = args
+    return render_ticket_file(texts, fmt, base_path, font_path, qr).getvalue()
+
+
+def event_preload(events):
+    return [
+        ([(xy, size) for xy, _, size in event.template.layout], event.base_image, event.font)
+        for event in events
+    ]
+
+
+class RenderPool:
+    def __init__(self, workers=None, preload=()):
+        self.workers = workers or os.cpu_count() or 1
+        self.preload = [(tuple((tuple(xy), size) for xy, size in layout), base, font) for layout, base, font in preload]
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ワーカーは最初に全部起動して準備を終わらせておく（最初の発行を待たせない。後から起動されることもない）
+    def _get(self):
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context("spawn")
+                executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=context,
+                    initializer=_init_worker, initargs=(self.preload, context.Barrier(self.workers)),
+                )
+                with _hidden_main():
+                    ready = [executor.submit(_ready) for _ in range(self.workers)]
+                wait(ready)
+                self._executor = executor
+            return self._executor
+
+    # wait=False なら起動を裏のスレッドで進めてすぐに返る（最初の描画は準備ができるまで待つ）
+    def start(self, wait=True):
+        if wait:
+            self._get()
+        else:
+            threading.Thread(target=self._get, name="render-pool-start", daemon=True).start()
+        return self
+
+    # ワーカーが落ちてプールが使えなくなったら（BrokenProcessPool）、作り直して1回だけやり直す
+    def _call(self, fn):
+        executor = self._get()
+        try:
+            return fn(executor)
+        except BrokenProcessPool:
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            return fn(self._get())
+
+    def render(self, texts, fmt=DEFAULT_FORMAT, base_path=BASE_IMAGE, font_path=FONT_PATH, qr=None):
+        return self._call(lambda executor: executor.submit(_render_job, (texts, fmt, base_path, font_path, qr)).result())
+
+    # jobs: [[((x, y), 文字列, フォントサイズ), ...], ...]  qrs: jobs と同じ順の QR コード（なければ None）
+    def map(self, jobs, fmt=DEFAULT_FORMAT, base_path=BASE_IMAGE, font_path=FONT_PATH, qrs=None, on_progress=None):
+        jobs = list(jobs)
+        args = [(texts, fmt, base_path, font_path, qr) for texts, qr in zip(jobs, qrs or [None] * len(jobs))]
+        chunksize = max(1, len(args) // (self.workers * 4))
+
+        def run(executor):
+            results = []
+            for data in executor.map(_render_job, args, chunksize=chunksize):
+                results.append(data)
+                if on_progress:
+                    on_progress(len(results), len(args))
+            return results
+
+        return self._call(run)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,299 @@
+import re
+from .store import PAPER_EMAIL, COLUMN_FIELDS, FIELD_LABELS, DuplicateTicketError, normalize_fields
+
+# ------------------------
+# 整理券の発行処理（Streamlit に依存しない）
+# 画面・CLI のどちらからも同じ手順で発行する:
+#   番号の割り当てと記録（ストア） → 画像生成 → メール作成 → 送信キューに積む
+# 画像生成（PIL）と一括発行（pandas）は使うときに読み込む
+# 各段階の所要時間は metrics（gakusaiex.metrics.Metrics）に記録する
+# ------------------------
+EMAIL_DOMAIN = "yamaguchi-u.ac.jp"
+
+
+# フォームの入力チェック（名簿の一括チェックと同じ条件）。問題があればメッセージを返す
+def check_student(gakuseki, name, email_id):
+    return check_fields(name, gakuseki, email_id)
+
+
+# None の項目は確かめない（CLI のように、入力される項目が決まっていないとき）
+def check_fields(name, gakuseki=None, email_id=None, email=None):
+    if gakuseki is not None and (len(gakuseki) != 10 or not gakuseki.isdigit()):
+        return "学籍番号は10桁の数字で入力してください"
+    if email_id is not None and not re.fullmatch(r"[A-Za-z0-9]{7}", email_id):
+        return "メールIDは英数字7桁で入力してください"
+    if email is not None and not re.fullmatch(r"[^@\s]+@[^@\s]+\.[^@\s]+", email):
+        return "メールアドレスを正しく入力してください"
+    if not name.strip():
+        return "氏名を入力してください"
+    return None
+
+
+# found: ストアの (項目, 整理券番号) か、保管庫の (項目, 整理券番号, イベント)
+def duplicate_message(found):
+    if len(found) > 2:
+        return f"この{FIELD_LABELS[found[0]]}には{found[2]}で整理券（整理券番号 {found[1]}）が発行されています"
+    return f"この{FIELD_LABELS[found[0]]}にはすでに整理券（整理券番号 {found[1]}）が発行されています"
+
+
+class TicketService:
+    def __init__(
+        self, store, template, sender, outbox=None, fmt="png", base_image=None, font_path=None, metrics=None,
+        qr_secret=None, image_cache=None, render_pool=None, archive=None, past_events=(),
+    ):
+        from .events import BASE_IMAGE, FONT_PATH
+        from .metrics import Metrics
+
+        self.store = store
+        self.template = template
+        self.sender = sender
+        self.outbox = outbox
+        self.fmt = fmt
+        self.base_image = base_image or BASE_IMAGE
+        self.font_path = font_path or FONT_PATH
+        self.qr_secret = qr_secret
+        self.image_cache = image_cache  # 再送で使う描画済み画像のキャッシュ（renderer.ImageCache）
+        self.render_pool = render_pool  # 描画をワーカープロセスで行う RenderPool（なければこのスレッドで描く）
+        self.archive = archive  # これまでの整理券の保管庫（archive.HistoryArchive）
+        self.past_events = list(past_events)  # 保管庫のこのイベントで発行済みなら重複にする
+        self._builder = None
+        # 送信キューがあれば SMTP の記録とまとめる
+        self.metrics = metrics or (outbox.pool.metrics if outbox is not None else Metrics())
+
+    # ------------------------
+    # 画像・メール
+    # ------------------------
+    # 受付で読み取る QR コード（テンプレートに位置があり、署名の鍵があるときだけ）
+    def _qr(self, number, fields):
+        if self.template.qr is None or not self.qr_secret:
+            return None
+        from .gate import sign
+
+        xy, size = self.template.qr
+        return xy, size, sign(self.qr_secret, number, fields.get("gakuseki"))
+
+    # cached=True ならキャッシュにある画像を使い、なければ描いてキャッシュに置く（再送用）
+    # 返すのはエンコードしたバッファそのもの（bytes か memoryview。コピーはしない）
+    def render(self, number, fields, cached=False):
+        from .renderer import get_renderer, encode_ticket, render_key
+
+        texts = self.template.texts(number, fields)
+        qr = self._qr(number, fields)
+        key = None
+        if cached and self.image_cache is not None:
+            key = render_key(texts, self.fmt, self.base_image, self.font_path, qr)
+            data = self.image_cache.get(key)
+            if data is not None:
+                self.metrics.count("render_cache_hit")
+                return data
+        if self.render_pool is not None:
+            with self.metrics.stage("render"):
+                data = self.render_pool.render(texts, self.fmt, self.base_image, self.font_path, qr)
+        else:
+            renderer = get_renderer([(xy, size) for xy, _, size in texts], self.base_image, self.font_path)
+            with self.metrics.stage("render"):
+                image = renderer.render([text for _, text, _ in texts], qr)
+            with self.metrics.stage("encode"):
+                data = encode_ticket(image, self.fmt).getbuffer()
+        if key is not None:
+            self.image_cache.put(key, data)
+        return data
+
+    def message(self, number, fields, image_data):
+        from .events import attachment_info
+
+        image_subtype, image_name = attachment_info(self.fmt, self.template.stem)
+        return self.template.message(self.sender, number, fields, image_data, image_subtype, image_name)
+
+    # 送信キューに積むメールはヘッダー・区切りを使い回して直接バイト列に組み立てる（templates.MessageBuilder）
+    def builder(self):
+        if self._builder is None:
+            from .events import attachment_info
+
+            self._builder = self.template.builder(self.sender, *attachment_info(self.fmt, self.template.stem))
+        return self._builder
+
+    def _mailable(self, fields):
+        return self.outbox is not None and fields.get("email") not in (None, "", PAPER_EMAIL)
+
+    def _enqueue(self, number, fields, image_data):
+        if not self._mailable(fields):
+            return None
+        with self.metrics.stage("message"):
+            raw = self.builder().build(number, fields, image_data)
+        with self.metrics.stage("enqueue"):
+            return self.outbox.enqueue(raw, ticket=number, sender=self.sender, recipient=fields["email"])
+
+    # ------------------------
+    # 発行
+    # issuer: 番号をまとめて予約して発行する場合の DeskIssuer（省略時はストアから直接）
+    # ------------------------
+    # このイベントのストアを先に調べ、なければ保管庫の past_events を調べる
+    # （保管庫に取り込んだこのストアの行は除く。リセット前の行を重複にしないため）
+    def lookup(self, email=None, gakuseki=None):
+        found = self.store.lookup(email=email, gakuseki=gakuseki)
+        if found is None and self.archive is not None and self.past_events:
+            found = self.archive.lookup(
+                email=email, gakuseki=gakuseki, events=self.past_events, exclude_source=self.archive.source_of(self.store),
+            )
+        return found
+
+    # 保管庫の past_events で発行済みのメール・学籍番号の集合（名簿の一括チェック用。past_events がなければ空）
+    def past_keys(self):
+        if self.archive is None or not self.past_events:
+            return set(), set()
+        return self.archive.keys(self.past_events, self.archive.source_of(self.store))
+
+    # 事前の lookup を通らない発行（CLI・一括発行・別の画面との競合）でも past_events の重複は発行しない
+    def _check_past(self, rows):
+        if self.archive is None or not self.past_events:
+            return
+        if len(rows) == 1:
+            fields = rows[0]
+            found = self.archive.lookup(
+                fields.get("email"), fields.get("gakuseki"), self.past_events, self.archive.source_of(self.store),
+            )
+            if found is not None:
+                raise DuplicateTicketError(found[0], fields.get(found[0]), found[2])
+            return
+        emails, ids = self.past_keys()
+        for fields in rows:
+            if fields.get("email") in emails:
+                raise DuplicateTicketError("email", fields["email"], "過去のイベント")
+            if fields.get("gakuseki") in ids:
+                raise DuplicateTicketError("gakuseki", fields["gakuseki"], "過去のイベント")
+
+    # 画像・QR コード・メールはストアに記録するのと同じ形（normalize_fields。全角数字は半角に）で作る。
+    # 受付の照合と、ログからの作り直し（再送）が発行時と同じ値になるように
+    def issue(self, issuer=None, **fields):
+        fields = normalize_fields(fields)
+        self._check_past([fields])
+        with self.metrics.stage("log_write"):
+            number = (issuer or self.store).issue(**fields)
+        self.metrics.count("issued")
+        self._enqueue(number, fields, self.render(number, fields))
+        return number
+
+    # rows: [{"gakuseki": ..., "name": ..., "email": ...}, ...]
+    # メールは送信キューに積み、送信数の上限（SMTPPool の limiter）を守りながら順に送る。
+    # (整理券番号のリスト, 各行の結果) を返す
+    def bulk_issue(self, rows, issuer=None, on_render=None, on_send=None):
+        from .bulk import render_many
+
+        rows = [normalize_fields(fields) for fields in rows]
+        self._check_past(rows)
+        with self.metrics.stage("log_write"):
+            numbers = (issuer or self.store).issue_many(rows)
+        self.metrics.count("issued", len(numbers))
+        with self.metrics.stage("bulk_render"):
+            images = render_many(
+                [self.template.texts(n, fields) for n, fields in zip(numbers, rows)],
+                self.fmt, self.base_image, self.font_path, on_progress=on_render,
+                qrs=[self._qr(n, fields) for n, fields in zip(numbers, rows)], pool=self.render_pool,
+            )
+        if self.outbox is None:
+            return numbers, ["送信なし"] * len(numbers)
+        results = []
+        for i, (number, fields, data) in enumerate(zip(numbers, rows, images)):
+            results.append("送信待ち" if self._enqueue(number, fields, data) is not None else "送信なし")
+            if on_send:
+                on_send(i + 1, len(numbers))
+        return numbers, results
+
+    # ------------------------
+    # 再送（発行済みの内容から画像とメールを作り直して送信キューに積む）
+    # 描画は決定的なので、作り直した画像は発行時に送ったものとバイト単位で同じになる（python -m gakusaiex.bench --regen で確かめる）
+    # ------------------------
+    # {整理券番号: {"gakuseki": ..., "name": ..., "email": ...}}（numbers を省略するとすべて）
+    def tickets(self, numbers=None):
+        import pandas as pd
+
+        df = self.store.frame()
+        if "整理券番号" not in df.columns:
+            return {}
+        if numbers is not None:
+            df = df[df["整理券番号"].isin([int(n) for n in numbers])]
+        columns = [c for c in df.columns if c in COLUMN_FIELDS and c != "整理券番号"]
+        return {
+            int(number): {COLUMN_FIELDS[c]: (None if pd.isna(v) else v) for c, v in zip(columns, values)}
+            for number, *values in df[["整理券番号"] + columns].itertuples(index=False)
+        }
+
+    def ticket(self, number):
+        return self.tickets([number]).get(int(number))
+
+    def resend(self, number):
+        fields = self.ticket(number)
+        if fields is None:
+            raise KeyError(f"整理券番号 {number} は発行されていません")
+        if not self._mailable(fields):
+            raise ValueError(f"整理券番号 {number} はメールで送る整理券ではありません")
+        return self._enqueue(int(number), fields, self.render(int(number), fields, cached=True))
+
+    # メールで送る整理券のうち、まだ届いていないもの（送信失敗・送信キューにない）の番号
+    # include_queued=True なら送信待ちのものも含める
+    def undelivered(self, start=None, end=None, include_queued=False):
+        statuses = self.outbox.latest_statuses() if self.outbox is not None else {}
+        skip = {"sent"} if include_queued else {"sent", "queued"}
+        return sorted(
+            number for number, fields in self.tickets().items()
+            if (start is None or number >= start) and (end is None or number <= end)
+            and fields.get("email") not in (None, "", PAPER_EMAIL) and statuses.get(number) not in skip
+        )
+
+    # キャッシュにない画像だけをまとめて描く（render_pool があれば全コアで）
+    def _render_cached(self, items):
+        from .bulk import render_many
+        from .renderer import render_key
+
+        texts = [self.template.texts(number, fields) for number, fields in items]
+        qrs = [self._qr(number, fields) for number, fields in items]
+        keys = [None] * len(items)
+        images = [None] * len(items)
+        if self.image_cache is not None:
+            keys = [render_key(t, self.fmt, self.base_image, self.font_path, qr) for t, qr in zip(texts, qrs)]
+            images = [self.image_cache.get(key) for key in keys]
+            if hits := sum(data is not None for data in images):
+                self.metrics.count("render_cache_hit", hits)
+        missing = [i for i, data in enumerate(images) if data is None]
+        if missing:
+            with self.metrics.stage("bulk_render"):
+                rendered = render_many(
+                    [texts[i] for i in missing], self.fmt, self.base_image, self.font_path,
+                    qrs=[qrs[i] for i in missing], pool=self.render_pool,
+                )
+            for i, data in zip(missing, rendered):
+                images[i] = data
+                if keys[i] is not None:
+                    self.image_cache.put(keys[i], data)
+        return images
+
+    # まとめて再送する。{整理券番号: 送信キューのID か エラーメッセージ} を返す
+    def resend_many(self, numbers, on_progress=None):
+        numbers = [int(n) for n in numbers]
+        found = self.tickets(numbers)
+        results = {}
+        targets = []
+        for number in numbers:
+            fields = found.get(number)
+            if fields is None:
+                results[number] = f"整理券番号 {number} は発行されていません"
+            elif not self._mailable(fields):
+                results[number] = f"整理券番号 {number} はメールで送る整理券ではありません"
+            else:
+                targets.append((number, fields))
+        images = self._render_cached(targets)
+        for i, ((number, fields), data) in enumerate(zip(targets, images)):
+            results[number] = self._enqueue(number, fields, data)
+            if on_progress:
+                on_progress(len(numbers) - len(targets) + i + 1, len(numbers))
+        return {number: results[number] for number in numbers}
+
+    # ------------------------
+    # メンテナンス
+    # ------------------------
+    def reset(self):
+        self.store.reset()
+
+    def restart_from(self, number):
+        self.store.restart_from(number)
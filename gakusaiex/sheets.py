@@ -0,0 +1,231 @@
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from .store import LOG_COLUMNS, COLUMN_FIELDS, PAPER_EMAIL, normalize_email, normalize_student_id
+
+# ------------------------
+# ローカルの台帳（SQLiteTicketStore）→ Google Sheets への複製
+# 発行はまずローカルの SQLite に記録し（重複の確認・番号の割り当てもここで行う。画面の再実行ごとにシートを読むことはない）、
+# シートへはバックグラウンドでまとめて書き込む。シートが遅い・つながらない間も
+# 発行は止まらず、番号も重複しない。
+# 未送信の行は sheet_pending に入る（history への INSERT トリガーで同じトランザクション内に記録）。
+# 起動時に reconcile() でシートと台帳を突き合わせ、足りない側を補う。
+# 一度も突き合わせていない台帳では番号の続きが分からないので、ready() が False の間は発行しないこと。
+# worksheet にはシートを開く関数を渡してもよい（認証・シートを開くのは同期のスレッドが最初に行う。
+# 画面の起動を待たせず、Google につながらなくても台帳への発行は始められる）
+# ------------------------
+class SheetsReplicator:
+    def __init__(self, store, worksheet, columns=LOG_COLUMNS, batch_size=50, interval=2.0):
+        self.store = store
+        self.worksheet = worksheet
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.interval = interval
+        self._sync_error = None
+        self._synced_at = None
+        self._header_missing = False
+        self._sync_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS sheet_pending (history_id INTEGER PRIMARY KEY);
+                CREATE TRIGGER IF NOT EXISTS history_to_sheet AFTER INSERT ON history
+                BEGIN
+                    INSERT OR IGNORE INTO sheet_pending (history_id) VALUES (NEW.id);
+                END;
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.store.path, timeout=30)
+        conn.execute("PRAGMA busy_timeout = 30000")
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _sheet(self):
+        if callable(self.worksheet):
+            self.worksheet = self.worksheet()
+        return self.worksheet
+
+    def _row_key(self, number, gakuseki, email):
+        return (str(number), normalize_student_id(gakuseki) or "", normalize_email(email) or str(email or ""))
+
+    # ------------------------
+    # 起動時の突き合わせ
+    # ------------------------
+    def reconcile(self):
+        with self._sync_lock:
+            values = self._sheet().get_all_values()
+            header, rows = (values[0], values[1:]) if values else (list(self.columns), [])
+            position = {c: header.index(c) for c in COLUMN_FIELDS if c in header}
+
+            def cell(row, column):
+                i = position.get(column)
+                return row[i] if i is not None and i < len(row) and row[i] != "" else None
+
+            sheet_rows = [
+                (cell(r, "整理券番号"), cell(r, "学籍番号"), cell(r, "氏名"), cell(r, "メール")) for r in rows
+            ]
+            sheet_keys = {self._row_key(n, g, e) for n, g, _, e in sheet_rows}
+            with self._connect() as conn:
+                journal = conn.execute("SELECT id, number, gakuseki, email FROM history").fetchall()
+                journal_keys = {self._row_key(n, g, e): i for i, n, g, e in journal}
+                # 台帳にあってシートにない行 → 送信待ちにする（シートにある行は送信待ちから外す）
+                conn.executemany(
+                    "INSERT OR IGNORE INTO sheet_pending (history_id) VALUES (?)",
+                    [(i,) for key, i in journal_keys.items() if key not in sheet_keys],
+                )
+                conn.executemany(
+                    "DELETE FROM sheet_pending WHERE history_id = ?",
+                    [(i,) for key, i in journal_keys.items() if key in sheet_keys],
+                )
+                # シートにあって台帳にない行 → 台帳に取り込む（番号の続きを正しくするため）
+                imported = 0
+                for number, gakuseki, name, email in sheet_rows:
+                    if self._row_key(number, gakuseki, email) in journal_keys or number is None:
+                        continue
+                    gakuseki = normalize_student_id(gakuseki)
+                    email = email if email == PAPER_EMAIL else normalize_email(email)
+                    cur = conn.execute(
+                        "INSERT INTO history (number, gakuseki, name, email) VALUES (?, ?, ?, ?)",
+                        (number, gakuseki, name, email),
+                    )
+                    conn.execute("DELETE FROM sheet_pending WHERE history_id = ?", (cur.lastrowid,))
+                    conn.execute(
+                        "INSERT OR IGNORE INTO tickets (number, gakuseki, name, email) VALUES (?, ?, ?, ?)",
+                        (number, gakuseki, name, email),
+                    )
+                    imported += 1
+                conn.execute(
+                    "UPDATE meta SET value = MAX(value, (SELECT COALESCE(MAX(number), 0) + 1 FROM tickets))"
+                    " WHERE key = 'next_number'"
+                )
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('sheet_reconciled', ?)", (int(time.time()),))
+            self._header_missing = not values
+        self._wake.set()
+        return imported
+
+    # ------------------------
+    # 送信
+    # ------------------------
+    def pending_count(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM sheet_pending").fetchone()[0]
+
+    def ready(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM meta WHERE key = 'sheet_reconciled'").fetchone() is not None
+
+    def last_error(self):
+        return self._sync_error
+
+    def last_synced(self):
+        return self._synced_at
+
+    def sync_once(self):
+        with self._sync_lock:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    "SELECT h.id, h.number, h.gakuseki, h.name, h.email FROM sheet_pending p"
+                    " JOIN history h ON h.id = p.history_id ORDER BY p.history_id LIMIT ?",
+                    (self.batch_size,),
+                ).fetchall()
+            if not rows:
+                return 0
+            cells = []
+            for _, number, gakuseki, name, email in rows:
+                values = {"number": number, "gakuseki": gakuseki, "name": name, "email": email}
+                cells.append(["" if values[COLUMN_FIELDS[c]] is None else values[COLUMN_FIELDS[c]] for c in self.columns])
+            if self._header_missing:
+                cells.insert(0, list(self.columns))
+            try:
+                self._sheet().append_rows(cells, value_input_option="RAW")
+            except Exception as e:
+                self._sync_error = e
+                raise
+            self._header_missing = False
+            with self._connect() as conn:
+                conn.executemany("DELETE FROM sheet_pending WHERE history_id = ?", [(r[0],) for r in rows])
+            self._sync_error = None
+            self._synced_at = time.time()
+            return len(rows)
+
+    def notify(self):
+        self._wake.set()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sheets-sync", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        reconciled = False
+        delay = self.interval
+        while not self._stop.is_set():
+            try:
+                if not reconciled:
+                    self.reconcile()
+                    reconciled = True
+                    self._sync_error = None
+                while self.sync_once() >= self.batch_size:
+                    pass
+                delay = self.interval
+            except Exception as e:
+                # シートにつながらない間は間隔を伸ばしながら再試行する（台帳には残っている）
+                self._sync_error = e
+                delay = min(delay * 2, 60.0)
+            self._wake.wait(delay)
+            self._wake.clear()
+
+
+# ------------------------
+# ローカル検証・ベンチマーク用のメモリ上のワークシート（gspread の代わり）
+# ------------------------
+class FakeWorksheet:
+    def __init__(self, header=LOG_COLUMNS, latency=0.0):
+        self.values = [list(header)] if header else []
+        self.latency = latency
+        self.calls = {"get_all_values": 0, "get_all_records": 0, "append_row": 0, "append_rows": 0}
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_all_values(self):
+        self._call("get_all_values")
+        with self._lock:
+            return [list(map(str, row)) for row in self.values]
+
+    def get_all_records(self):
+        self._call("get_all_records")
+        with self._lock:
+            header, rows = self.values[0], self.values[1:]
+            return [dict(zip(header, row)) for row in rows]
+
+    def append_row(self, values, value_input_option="RAW"):
+        self._call("append_row")
+        with self._lock:
+            self.values.append(list(values))
+
+    def append_rows(self, values, value_input_option="RAW"):
+        self._call("append_rows")
+        with self._lock:
+            self.values.extend(list(row) for row in values)
@@ -0,0 +1,906 @@
+import os
+import io
+import csv
+import sqlite3
+import threading
+import unicodedata
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# pandas は DataFrame を扱う関数の中で import する（CLI の起動を軽くするため）
+
+# ------------------------
+# 追記専用の整理券ログ（CSV）
+# 1件ごとに1行だけ追記して fsync する。ファイル全体の書き直しはしないので
+# 発行のコストはログの長さに関係なく一定。
+# 書き込み途中で落ちて最終行が欠けた場合は、次に開いたときに切り詰めて修復する。
+# 表示用の DataFrame はプロセス内で1つだけ持ち、ファイルの (inode, サイズ, 更新時刻) を
+# 版として覚えておく。版が変わっていなければそのまま返し、追記されていれば
+# 前回読んだ位置から後ろのバイトだけを読んで足す（他の端末・プロセスの追記も拾える）。
+# 返す DataFrame は共有なので書き換えないこと。
+# ------------------------
+LOG_COLUMNS = ["整理券番号", "学籍番号", "氏名", "メール"]
+
+
+class TicketLog:
+    def __init__(self, path, columns=LOG_COLUMNS, compact_every=1000):
+        self.path = path
+        self.columns = list(columns)
+        self.compact_every = compact_every
+        self._lock = threading.RLock()
+        self._df = None
+        self._offset = 0
+        self._version = None
+        self._appends = 0
+        self._max_number = None
+        self._repair()
+
+    # ------------------------
+    # 読み込み
+    # ------------------------
+    def _repair(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            # 最終行が途中で切れている → 直前の改行まで戻す
+            pos = size
+            while pos > 0:
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                chunk = f.read(step)
+                idx = chunk.rfind(b"\n")
+                if idx != -1:
+                    pos += idx + 1
+                    break
+            f.truncate(pos)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _read_all(self):
+        import pandas as pd
+
+        with open(self.path, "rb") as f:
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return pd.DataFrame(columns=self.columns), 0
+        return pd.read_csv(io.BytesIO(data[:end]), dtype={"学籍番号": str}), end
+
+    def _read_tail(self):
+        import pandas as pd
+
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return None, 0
+        tail = pd.read_csv(io.BytesIO(data[:end]), header=None, names=list(self._df.columns), dtype={"学籍番号": str})
+        return tail, end
+
+    def version(self):
+        with self._lock:
+            self._refresh()
+            return self._version
+
+    def _refresh(self):
+        import pandas as pd
+
+        version = self._stat()
+        if self._df is not None and version == self._version:
+            return
+        if version is None or version[1] == 0:
+            self._df, self._offset = pd.DataFrame(columns=self.columns), 0
+        elif (
+            self._df is None or self._version is None or self._offset == 0
+            or version[0] != self._version[0] or version[1] < self._offset
+        ):
+            # 初回・置き換え（compact/reset）・切り詰め → 全体を読み直す
+            self._df, self._offset = self._read_all()
+            self._max_number = None
+        elif version[1] > self._offset:
+            tail, size = self._read_tail()
+            if tail is not None:
+                self._df = tail if self._df.empty else pd.concat([self._df, tail], ignore_index=True)
+                self._offset += size
+                self._track_numbers(tail.iloc[:, 0] if "整理券番号" in tail.columns else ())
+        self._version = version
+
+    def _track_numbers(self, numbers):
+        if self._max_number is None:
+            return
+        for value in numbers:
+            try:
+                self._max_number = max(self._max_number, int(value))
+            except (TypeError, ValueError):
+                pass
+
+    def frame(self):
+        with self._lock:
+            self._refresh()
+            return self._df
+
+    def next_number(self):
+        import pandas as pd
+
+        with self._lock:
+            cached = self._max_number
+        if cached is None:
+            df = self.frame()
+            max_num = None
+            if "整理券番号" in df.columns and not df["整理券番号"].isnull().all():
+                max_num = pd.to_numeric(df["整理券番号"], errors="coerce").max()
+            cached = 0 if max_num is None or pd.isna(max_num) else int(max_num)
+            with self._lock:
+                if self._max_number is None:
+                    self._max_number = cached
+                cached = self._max_number
+        return cached + 1
+
+    # ------------------------
+    # 追記
+    # ------------------------
+    def append(self, rows):
+        rows = [list(row) for row in rows]
+        if not rows:
+            return
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        with self._lock:
+            new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            if new_file:
+                writer.writerow(self.columns)
+            writer.writerows(rows)
+            with open(self.path, "a", encoding="utf-8", newline="") as f:
+                f.write(buffer.getvalue())
+                f.flush()
+                os.fsync(f.fileno())
+            self._track_numbers(row[0] for row in rows)
+            self._appends += len(rows)
+            due = self.compact_every and self._appends >= self.compact_every
+        if due:
+            self.compact()
+
+    # ------------------------
+    # 書き直し（一時ファイルに書いてから置き換えるので途中で落ちても壊れない）
+    # ------------------------
+    def _replace(self, df):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
+            df.to_csv(f, index=False, lineterminator="\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    # 空行や整理券番号の読めない壊れた行を取り除いて詰め直す
+    def compact(self):
+        import pandas as pd
+
+        with self._lock:
+            df = self.frame()
+            compacted = df.dropna(how="all")
+            if "整理券番号" in compacted.columns:
+                compacted = compacted[pd.to_numeric(compacted["整理券番号"], errors="coerce").notna()]
+            compacted = compacted.reset_index(drop=True)
+            self._replace(compacted)
+            self._appends = 0
+
+    def reset(self):
+        import pandas as pd
+
+        with self._lock:
+            empty = pd.DataFrame(columns=self.columns)
+            self._replace(empty)
+            self._max_number = 0
+            self._appends = 0
+
+
+# ------------------------
+# 整理券ストア（差し替え可能）
+# issue() が番号の割り当てと記録を一度に行うので、複数の画面・端末から
+# 同時に発行しても番号が重複しない。
+#   sqlite : SQLite（WALモード）。番号の割り当てと重複チェックを1トランザクションで行う（既定）
+#   csv    : 追記専用CSV（tickets.csv / tickets_all.csv）。ロックファイルでプロセス間も排他する
+# 端末ごとに番号をまとめて予約して発行することもできる（DeskIssuer）。
+# ------------------------
+PAPER_EMAIL = "紙"
+COLUMN_FIELDS = {"整理券番号": "number", "学籍番号": "gakuseki", "氏名": "name", "メール": "email"}
+FIELD_LABELS = {"email": "メール", "gakuseki": "学籍番号", "number": "整理券番号"}
+
+
+# 予約した番号の範囲が、リセット・番号の指定再開の後で使えなくなった
+class StaleBlockError(RuntimeError):
+    pass
+
+
+# event: 保管庫の過去のイベントで発行済みのとき、そのイベント名
+class DuplicateTicketError(ValueError):
+    def __init__(self, field, value, event=None):
+        self.field = field
+        self.value = value
+        self.event = event
+        if field == "number":
+            super().__init__(f"整理券番号 {value} はすでに使われています")
+        elif event is not None:
+            super().__init__(f"この{FIELD_LABELS.get(field, field)}には{event}で整理券が発行されています: {value}")
+        else:
+            super().__init__(f"この{FIELD_LABELS.get(field, field)}にはすでに整理券が発行されています: {value}")
+
+
+def _blank(value):
+    if value is None:
+        return True
+    if isinstance(value, str):
+        return value.strip() == ""
+    if isinstance(value, int):
+        return False
+    import pandas as pd
+
+    return bool(pd.isna(value)) or str(value).strip() == ""
+
+
+# ------------------------
+# 重複チェック用の正規化
+# 全角英数字・前後の空白・大文字小文字の違いを吸収する。紙の整理券はメールの重複対象外。
+# ------------------------
+def normalize_email(value):
+    if _blank(value) or value == PAPER_EMAIL:
+        return None
+    return unicodedata.normalize("NFKC", str(value)).strip().lower()
+
+
+def normalize_student_id(value):
+    if _blank(value):
+        return None
+    text = unicodedata.normalize("NFKC", str(value))
+    return "".join(ch for ch in text if not ch.isspace() and ch != "-")
+
+
+def normalize_fields(fields):
+    fields = dict(fields)
+    if "email" in fields and fields["email"] != PAPER_EMAIL:
+        fields["email"] = normalize_email(fields["email"])
+    if "gakuseki" in fields:
+        fields["gakuseki"] = normalize_student_id(fields["gakuseki"])
+    return fields
+
+
+# ------------------------
+# メール・学籍番号 → 整理券番号 のハッシュ索引
+# ログを読み込んだときに一度だけ作り、以降は発行のたびに追加する
+# ------------------------
+class TicketIndex:
+    def __init__(self):
+        self.by_email = {}
+        self.by_student = {}
+        self.numbers = set()
+
+    @classmethod
+    def from_rows(cls, rows):
+        index = cls()
+        for number, gakuseki, email in rows:
+            index.add(number, gakuseki, email)
+        return index
+
+    def add(self, number, gakuseki=None, email=None):
+        email_key = normalize_email(email)
+        student_key = normalize_student_id(gakuseki)
+        if number is not None:
+            self.numbers.add(number)
+        if email_key is not None:
+            self.by_email.setdefault(email_key, number)
+        if student_key is not None:
+            self.by_student.setdefault(student_key, number)
+
+    # 見つかったら ("email" or "gakuseki", 整理券番号) を返す
+    def lookup(self, email=None, gakuseki=None):
+        email_key = normalize_email(email)
+        if email_key is not None and email_key in self.by_email:
+            return "email", self.by_email[email_key]
+        student_key = normalize_student_id(gakuseki)
+        if student_key is not None and student_key in self.by_student:
+            return "gakuseki", self.by_student[student_key]
+        return None
+
+    def clear(self):
+        self.by_email.clear()
+        self.by_student.clear()
+        self.numbers.clear()
+
+
+def index_rows(df):
+    import pandas as pd
+
+    numbers = df["整理券番号"] if "整理券番号" in df.columns else pd.Series([None] * len(df))
+    ids = df["学籍番号"] if "学籍番号" in df.columns else pd.Series([None] * len(df))
+    emails = df["メール"] if "メール" in df.columns else pd.Series([None] * len(df))
+    for number, gakuseki, email in zip(numbers, ids, emails):
+        yield (None if pd.isna(number) else int(number)), gakuseki, email
+
+
+# ------------------------
+# プロセス間のロック（ロックファイルを flock する）
+# 同じプロセス内では入れ子にできる
+# ------------------------
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            f = open(self.path, "a+b")
+            try:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            except BaseException:
+                f.close()
+                self._lock.release()
+                raise
+            self._file = f
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            f, self._file = self._file, None
+            try:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            finally:
+                f.close()
+        self._lock.release()
+
+
+# 予約範囲の後ろの使わなかった番号（連続している末尾の部分）を返す
+def _unused_tail(numbers):
+    numbers = sorted(numbers)
+    if not numbers:
+        return None
+    start = end = numbers[-1]
+    for n in reversed(numbers[:-1]):
+        if n != start - 1:
+            break
+        start = n
+    return start, end + 1
+
+
+class CSVTicketStore:
+    def __init__(self, path, all_path, columns=LOG_COLUMNS):
+        self.columns = list(columns)
+        self.log = TicketLog(path, self.columns)
+        self.all_log = TicketLog(all_path, self.columns)
+        # 次の番号と世代（リセット・番号指定で増える）は別ファイルに置き、全プロセスで共有する
+        self.counter_path = f"{path}.next"
+        self._lock = FileLock(f"{path}.lock")
+        self._index = None
+        self._indexed = (None, 0)  # (索引に入れたログの inode, 行数)
+
+    # 他のプロセスが追記した行も拾うため、ログが伸びていればその分だけ索引に足す
+    def _get_index(self):
+        df = self.log.frame()
+        version = self.log.version()
+        inode = version[0] if version else None
+        if self._index is None or inode != self._indexed[0] or len(df) < self._indexed[1]:
+            self._index = TicketIndex.from_rows(index_rows(df))
+        elif len(df) > self._indexed[1]:
+            for number, gakuseki, email in index_rows(df.iloc[self._indexed[1]:]):
+                self._index.add(number, gakuseki, email)
+        self._indexed = (inode, len(df))
+        return self._index
+
+    def _read_counter(self):
+        try:
+            with open(self.counter_path, encoding="utf-8") as f:
+                number, generation = f.read().split()
+            return int(number), int(generation)
+        except (FileNotFoundError, ValueError):
+            return self.log.next_number(), 0
+
+    def _write_counter(self, number, generation):
+        tmp = f"{self.counter_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(f"{number} {generation}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.counter_path)
+
+    def next_number(self):
+        return self._read_counter()[0]
+
+    def restart_from(self, number):
+        with self._lock:
+            self._write_counter(int(number), self._read_counter()[1] + 1)
+
+    # 番号を count 個まとめて予約する。(世代, 番号のリスト) を返す
+    def reserve(self, count):
+        with self._lock:
+            start, generation = self._read_counter()
+            self._write_counter(start + count, generation)
+            return generation, list(range(start, start + count))
+
+    # 使わなかった予約番号を返す（ほかに予約・発行されていなければ番号を戻す）
+    def release(self, numbers, generation=None):
+        tail = _unused_tail(numbers)
+        if tail is None:
+            return False
+        with self._lock:
+            current, current_generation = self._read_counter()
+            if current != tail[1] or (generation is not None and generation != current_generation):
+                return False
+            self._write_counter(tail[0], current_generation)
+            return True
+
+    def _row(self, number, fields):
+        values = dict(fields, number=number)
+        return [values.get(COLUMN_FIELDS[c]) for c in self.columns]
+
+    # 整理券番号・メール・学籍番号の重複（ログ内・今回の発行分どうし）を調べる
+    def _find_duplicate(self, index, numbers, rows):
+        batch = TicketIndex()
+        for number, fields in zip(numbers, rows):
+            if number in index.numbers:
+                return "number", number
+            for found in (index.lookup(fields.get("email"), fields.get("gakuseki")),
+                          batch.lookup(fields.get("email"), fields.get("gakuseki"))):
+                if found is not None:
+                    return found[0], fields.get(found[0])
+            batch.add(number, fields.get("gakuseki"), fields.get("email"))
+        return None
+
+    def issue(self, **fields):
+        return self.issue_many([fields])[0]
+
+    # numbers を渡すと予約済みの番号で発行する（generation は予約したときの世代）
+    def issue_many(self, rows, numbers=None, generation=None):
+        rows = [normalize_fields(fields) for fields in rows]
+        with self._lock:
+            index = self._get_index()
+            start, current_generation = self._read_counter()
+            allocate = numbers is None
+            if allocate:
+                numbers = list(range(start, start + len(rows)))
+            elif generation is not None and generation != current_generation:
+                raise StaleBlockError("予約した整理券番号はリセット後のため使えません")
+            else:
+                numbers = list(numbers)
+            dup = self._find_duplicate(index, numbers, rows)
+            if dup is not None:
+                raise DuplicateTicketError(*dup)
+            records = [self._row(n, fields) for n, fields in zip(numbers, rows)]
+            self.log.append(records)
+            self.all_log.append(records)
+            for number, fields in zip(numbers, rows):
+                index.add(number, fields.get("gakuseki"), fields.get("email"))
+            if allocate:
+                self._write_counter(start + len(rows), current_generation)
+            return numbers
+
+    # すでに整理券を持っているか。見つかれば ("email" or "gakuseki", 整理券番号)
+    def lookup(self, email=None, gakuseki=None):
+        with self._lock:
+            return self._get_index().lookup(email, gakuseki)
+
+    def has_email(self, email):
+        return self.lookup(email=email) is not None
+
+    def emails(self):
+        with self._lock:
+            return list(self._get_index().by_email)
+
+    def student_ids(self):
+        with self._lock:
+            return list(self._get_index().by_student)
+
+    # 内容が変わったら変わる値（表示用のキャッシュのキーに使う）
+    def version(self):
+        return self.log.version(), self.all_log.version()
+
+    def frame(self):
+        return self.log.frame()
+
+    def history(self):
+        return self.all_log.frame()
+
+    def reset(self):
+        with self._lock:
+            self.log.reset()
+            self._write_counter(1, self._read_counter()[1] + 1)
+            self._index = None
+
+
+class SQLiteTicketStore:
+    def __init__(self, path, columns=LOG_COLUMNS):
+        self.path = path
+        self.columns = list(columns)
+        self._local = threading.local()
+        self._index = None
+        self._index_lock = threading.Lock()
+        self._generation = None
+        self._last_history_id = 0
+        self._frames = {}  # table -> ((generation, 最後の history id), DataFrame)
+        self._frames_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tickets (
+                number INTEGER PRIMARY KEY,
+                gakuseki TEXT,
+                name TEXT,
+                email TEXT,
+                issued_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS tickets_email ON tickets (email)
+                WHERE email IS NOT NULL AND email != '紙';
+            CREATE UNIQUE INDEX IF NOT EXISTS tickets_gakuseki ON tickets (gakuseki)
+                WHERE gakuseki IS NOT NULL AND gakuseki != '';
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                number INTEGER,
+                gakuseki TEXT,
+                name TEXT,
+                email TEXT,
+                issued_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+            );
+            CREATE INDEX IF NOT EXISTS history_email ON history (email);
+            CREATE INDEX IF NOT EXISTS history_gakuseki ON history (gakuseki);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('next_number', 1);
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('counter_generation', 0);
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('log_id', random() & 9223372036854775807);
+            """
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout = 30000")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def next_number(self):
+        return self._conn().execute("SELECT value FROM meta WHERE key = 'next_number'").fetchone()[0]
+
+    # ファイルを作ったときに決まる値（保管庫 gakusaiex.archive で、どのログから取り込んだ行かの目印にする）
+    def log_id(self):
+        return self._conn().execute("SELECT value FROM meta WHERE key = 'log_id'").fetchone()[0]
+
+    def restart_from(self, number):
+        with self._transaction() as conn:
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'next_number'", (int(number),))
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'counter_generation'")
+
+    # 番号を count 個まとめて予約する。(世代, 番号のリスト) を返す
+    def reserve(self, count):
+        with self._transaction() as conn:
+            start, generation = self._counter(conn)
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'next_number'", (start + count,))
+            return generation, list(range(start, start + count))
+
+    # 使わなかった予約番号を返す（ほかに予約・発行されていなければ番号を戻す）
+    def release(self, numbers, generation=None):
+        tail = _unused_tail(numbers)
+        if tail is None:
+            return False
+        with self._transaction() as conn:
+            current, current_generation = self._counter(conn)
+            if current != tail[1] or (generation is not None and generation != current_generation):
+                return False
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'next_number'", (tail[0],))
+            return True
+
+    def _counter(self, conn):
+        return conn.execute(
+            "SELECT (SELECT value FROM meta WHERE key = 'next_number'),"
+            " (SELECT value FROM meta WHERE key = 'counter_generation')"
+        ).fetchone()
+
+    def issue(self, **fields):
+        return self.issue_many([fields])[0]
+
+    # 番号の割り当て・重複チェック・記録を1トランザクションで行う
+    # numbers を渡すと予約済みの番号で発行する（generation は予約したときの世代）
+    def issue_many(self, rows, numbers=None, generation=None):
+        rows = [normalize_fields(fields) for fields in rows]
+        with self._transaction() as conn:
+            start, current_generation = self._counter(conn)
+            allocate = numbers is None
+            if allocate:
+                numbers = list(range(start, start + len(rows)))
+            elif generation is not None and generation != current_generation:
+                raise StaleBlockError("予約した整理券番号はリセット後のため使えません")
+            else:
+                numbers = list(numbers)
+            records = [
+                (n, _text(f.get("gakuseki")), _text(f.get("name")), _text(f.get("email")))
+                for n, f in zip(numbers, rows)
+            ]
+            try:
+                conn.executemany("INSERT INTO tickets (number, gakuseki, name, email) VALUES (?, ?, ?, ?)", records)
+            except sqlite3.IntegrityError as e:
+                raise self._duplicate(conn, records, e) from e
+            conn.executemany(
+                "INSERT INTO history (number, gakuseki, name, email, issued_at)"
+                " SELECT number, gakuseki, name, email, issued_at FROM tickets WHERE number = ?",
+                [(n,) for n in numbers],
+            )
+            if allocate:
+                conn.execute("UPDATE meta SET value = ? WHERE key = 'next_number'", (start + len(rows),))
+        self._refresh_index(self._conn())
+        return numbers
+
+    def _duplicate(self, conn, records, error):
+        message = str(error)
+        for field in ("email", "gakuseki", "number"):
+            if f"tickets.{field}" in message:
+                index = {"number": 0, "gakuseki": 1, "email": 3}[field]
+                values = [r[index] for r in records]
+                seen = set()
+                for value in values:
+                    if value in seen:
+                        return DuplicateTicketError(field, value)
+                    seen.add(value)
+                row = conn.execute(
+                    f"SELECT {field} FROM tickets WHERE {field} IN ({','.join('?' * len(values))}) LIMIT 1", values
+                ).fetchone()
+                return DuplicateTicketError(field, row[0] if row else values[0])
+        return error
+
+    # ------------------------
+    # 重複チェック用の索引
+    # 他のプロセス・スレッドが書き込んだときだけ（PRAGMA data_version で検知）
+    # history の増えた分を読み足す。リセットされていたら作り直す。
+    # ------------------------
+    def _refresh_index(self, conn):
+        with self._index_lock:
+            conn.execute("BEGIN")
+            try:
+                generation = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+                if self._index is None or generation != self._generation:
+                    self._index = TicketIndex.from_rows(conn.execute("SELECT number, gakuseki, email FROM tickets"))
+                    self._last_history_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM history").fetchone()[0]
+                    self._generation = generation
+                else:
+                    for row_id, number, gakuseki, email in conn.execute(
+                        "SELECT id, number, gakuseki, email FROM history WHERE id > ? ORDER BY id", (self._last_history_id,)
+                    ):
+                        self._index.add(number, gakuseki, email)
+                        self._last_history_id = row_id
+            finally:
+                conn.execute("COMMIT")
+
+    def _get_index(self):
+        conn = self._conn()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._index is None or getattr(self._local, "data_version", None) != version:
+            self._refresh_index(conn)
+            self._local.data_version = version
+        return self._index
+
+    # すでに整理券を持っているか。見つかれば ("email" or "gakuseki", 整理券番号)
+    def lookup(self, email=None, gakuseki=None):
+        return self._get_index().lookup(email, gakuseki)
+
+    def has_email(self, email):
+        return self.lookup(email=email) is not None
+
+    def emails(self):
+        return list(self._get_index().by_email)
+
+    def student_ids(self):
+        return list(self._get_index().by_student)
+
+    # 発行日時は検索用に最後の列として付ける（CSV 版のログにはない）
+    def _select(self, table, where="", params=()):
+        import pandas as pd
+
+        fields = [COLUMN_FIELDS[c] for c in self.columns] + ["issued_at"]
+        rows = self._conn().execute(
+            f"SELECT {', '.join(fields)} FROM {table} {where} ORDER BY {'number' if table == 'tickets' else 'id'}", params
+        ).fetchall()
+        df = pd.DataFrame(rows, columns=self.columns + ["発行日時"])
+        if "整理券番号" in df.columns:
+            df["整理券番号"] = df["整理券番号"].astype("Int64")
+        return df
+
+    # 内容が変わったら変わる値。tickets は history と同じトランザクションでしか増えないので
+    # (世代, history の最後の id) で足りる
+    def version(self):
+        return self._conn().execute(
+            "SELECT (SELECT value FROM meta WHERE key = 'generation'), (SELECT COALESCE(MAX(id), 0) FROM history)"
+        ).fetchone()
+
+    # ------------------------
+    # 表示用の DataFrame（プロセス内で共有）
+    # 版が同じならそのまま返し、history が伸びただけなら増えた行だけを読んで足す。
+    # 返す DataFrame は共有なので書き換えないこと。
+    # ------------------------
+    def _cached(self, table):
+        import pandas as pd
+
+        with self._frames_lock:
+            version = self.version()
+            cached = self._frames.get(table)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            if cached is None or cached[0][0] != version[0]:
+                df = self._select(table)
+            else:
+                last_id = cached[0][1]
+                if table == "history":
+                    new = self._select("history", "WHERE id > ?", (last_id,))
+                else:
+                    new = self._select("tickets", "WHERE number IN (SELECT number FROM history WHERE id > ?)", (last_id,))
+                    new = new[~new["整理券番号"].isin(cached[1]["整理券番号"])] if "整理券番号" in new.columns else new
+                df = pd.concat([cached[1], new], ignore_index=True) if not cached[1].empty else new
+                if table == "tickets" and "整理券番号" in df.columns and not df["整理券番号"].is_monotonic_increasing:
+                    df = df.sort_values("整理券番号", ignore_index=True)
+            self._frames[table] = (tuple(version), df)
+            return df
+
+    def frame(self):
+        return self._cached("tickets")
+
+    def history(self):
+        return self._cached("history")
+
+    def reset(self):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM tickets")
+            conn.execute("UPDATE meta SET value = 1 WHERE key = 'next_number'")
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key IN ('generation', 'counter_generation')")
+        # 自分の接続の書き込みは data_version が変わらないので、索引はここで作り直す
+        self._refresh_index(self._conn())
+
+    # 既存の tickets.csv / tickets_all.csv を取り込む（DBが空のときだけ。CSV がなければ pandas は読み込まない）
+    def import_csv(self, path=None, all_path=None):
+        with self._transaction() as conn:
+            if conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]:
+                return False
+            imported = False
+            for csv_path, table in ((all_path, "history"), (path, "tickets")):
+                if not csv_path or not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0:
+                    continue
+                import pandas as pd
+
+                df = pd.read_csv(csv_path, dtype=str)
+                records = [
+                    (
+                        _text(row.get("整理券番号")),
+                        normalize_student_id(row.get("学籍番号")),
+                        _text(row.get("氏名")),
+                        row.get("メール") if row.get("メール") == PAPER_EMAIL else normalize_email(row.get("メール")),
+                    )
+                    for row in df.to_dict("records")
+                ]
+                verb = "INSERT" if table == "history" else "INSERT OR IGNORE"
+                conn.executemany(f"{verb} INTO {table} (number, gakuseki, name, email) VALUES (?, ?, ?, ?)", records)
+                imported = True
+            if not imported:
+                return False
+            conn.execute(
+                "UPDATE meta SET value = (SELECT COALESCE(MAX(number), 0) + 1 FROM tickets) WHERE key = 'next_number'"
+            )
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+            return True
+
+
+def _text(value):
+    if _blank(value):
+        return None
+    return str(value).strip()
+
+
+# ------------------------
+# 番号をまとめて予約して発行する（受付の端末ごとに1つ）
+# 発行のたびに共有の番号カウンタを取り合わずに済む。
+# 端末を閉じるときは release() で使わなかった番号を返す（返せなかった分は欠番になる）。
+# リセット・番号指定の再開があったら予約を捨てて取り直す。
+# ------------------------
+class DeskIssuer:
+    def __init__(self, store, block_size=20):
+        self.store = store
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._generation = None
+        self._free = []
+
+    def _take(self, count):
+        while len(self._free) < count:
+            generation, numbers = self.store.reserve(max(self.block_size, count - len(self._free)))
+            if generation != self._generation:
+                self._free = []
+                self._generation = generation
+            self._free += numbers
+        taken, self._free = self._free[:count], self._free[count:]
+        return taken
+
+    def next_number(self):
+        with self._lock:
+            return self._free[0] if self._free else self.store.next_number()
+
+    def issue(self, **fields):
+        return self.issue_many([fields])[0]
+
+    def issue_many(self, rows):
+        rows = list(rows)
+        with self._lock:
+            for _ in range(2):
+                numbers = self._take(len(rows))
+                try:
+                    return self.store.issue_many(rows, numbers, self._generation)
+                except StaleBlockError:
+                    self._free = []
+                    self._generation = None
+                except Exception:
+                    self._free = numbers + self._free
+                    raise
+            raise StaleBlockError("整理券番号を予約し直せませんでした")
+
+    # 返せなかった（欠番になる）番号のリストを返す
+    def release(self):
+        with self._lock:
+            free, self._free = self._free, []
+            tail = _unused_tail(free)
+            if tail is None or not self.store.release(free, self._generation):
+                return free
+            return [n for n in free if not tail[0] <= n < tail[1]]
+
+
+def open_store(kind="sqlite", path="tickets.db", csv_path="tickets.csv", all_csv_path="tickets_all.csv", columns=LOG_COLUMNS):
+    if kind == "csv":
+        return CSVTicketStore(csv_path, all_csv_path, columns)
+    if kind == "sqlite":
+        store = SQLiteTicketStore(path, columns)
+        store.import_csv(csv_path, all_csv_path)
+        return store
+    raise ValueError(f"未対応のストアです: {kind}")
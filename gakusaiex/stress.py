@@ -0,0 +1,114 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from collections import Counter
+from .store import open_store, DeskIssuer
+
+# ------------------------
+# 同時発行の負荷試験
+# 複数のプロセス × スレッドから同じストアに発行し続け、
+# 整理券番号の重複・欠番がないことを確かめる。
+#   python -m gakusaiex.stress --store sqlite --processes 4 --threads 4 --count 200
+#   python -m gakusaiex.stress --store csv --block 20      # 端末ごとに20番ずつ予約する
+# 予約ありの場合、返しきれなかった予約番号は欠番になるので、欠番がそれと一致するかを確かめる。
+# ------------------------
+def _open(kind, directory):
+    return open_store(
+        kind,
+        path=os.path.join(directory, "tickets.db"),
+        csv_path=os.path.join(directory, "tickets.csv"),
+        all_csv_path=os.path.join(directory, "tickets_all.csv"),
+    )
+
+
+def _desk(store, worker, count, block, errors):
+    issuer = DeskIssuer(store, block) if block else store
+    unreturned = []
+    try:
+        for i in range(count):
+            key = f"{worker:03d}{i:07d}"
+            issuer.issue(gakuseki=key, name=f"desk{worker}", email=f"{key}@example.com")
+    except Exception as e:
+        errors.append(f"desk {worker}: {e!r}")
+    if block:
+        unreturned = issuer.release()
+    return unreturned
+
+
+def _process(args):
+    kind, directory, process, threads, count, block = args
+    store = _open(kind, directory)
+    errors = []
+    unreturned = []
+    lock = threading.Lock()
+
+    def run(worker):
+        numbers = _desk(store, worker, count, block, errors)
+        with lock:
+            unreturned.extend(numbers)
+
+    workers = [threading.Thread(target=run, args=(process * threads + t,)) for t in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return unreturned, errors
+
+
+def check(store, expected, unreturned=()):
+    df = store.frame()
+    numbers = [int(n) for n in df["整理券番号"]]
+    duplicated = sorted(n for n, c in Counter(numbers).items() if c > 1)
+    gaps = sorted(set(range(1, max(numbers, default=0) + 1)) - set(numbers))
+    problems = []
+    if len(numbers) != expected:
+        problems.append(f"発行数が合いません: {len(numbers)} / {expected}")
+    if duplicated:
+        problems.append(f"重複した番号: {duplicated[:20]}")
+    unexplained = sorted(set(gaps) - set(unreturned))
+    if unexplained:
+        problems.append(f"欠番: {unexplained[:20]}")
+    if len(store.history()) != expected:
+        problems.append(f"全体ログの件数が合いません: {len(store.history())} / {expected}")
+    return problems, gaps
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="整理券の同時発行テスト")
+    parser.add_argument("--store", choices=["sqlite", "csv"], default="sqlite")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--count", type=int, default=100, help="1端末（スレッド）あたりの発行数")
+    parser.add_argument("--block", type=int, default=0, help="端末ごとに予約する番号の数（0なら予約しない）")
+    parser.add_argument("--dir", help="ストアを置くディレクトリ（省略時は一時ディレクトリ）")
+    args = parser.parse_args(argv)
+
+    directory = args.dir or tempfile.mkdtemp(prefix="ticket_stress_")
+    _open(args.store, directory)  # テーブル・ファイルを先に作っておく
+    jobs = [(args.store, directory, p, args.threads, args.count, args.block) for p in range(args.processes)]
+    start = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+        results = pool.map(_process, jobs)
+    elapsed = time.perf_counter() - start
+
+    unreturned = [n for numbers, _ in results for n in numbers]
+    errors = [e for _, errs in results for e in errs]
+    expected = args.processes * args.threads * args.count
+    problems, gaps = check(_open(args.store, directory), expected, unreturned)
+    problems = errors + problems
+
+    print(f"store={args.store} processes={args.processes} threads={args.threads} count={args.count} block={args.block}")
+    print(f"{expected} 件 / {elapsed:.2f} 秒（{expected / elapsed:.0f} 件/秒）  欠番（返却できなかった予約）: {len(gaps)}")
+    for problem in problems:
+        print("NG:", problem)
+    if not problems:
+        print("OK: 重複・欠番なし")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+import base64
+import random
+import sys
+from string import Formatter
+from email import policy
+from email.utils import formataddr
+
+# ------------------------
+# 整理券の文面・画像レイアウト
+# texts: [((x, y), 書式, フォントサイズ), ...]  書式・件名・本文では
+# {number}（整理券番号）と {gakuseki} {name} {email} が使える
+# qr: ((x, y), 一辺の大きさ)。署名の鍵（ticket_secret）があれば受付で読み取る QR コードを描く
+# イベントごとの文面・レイアウトは events/*.toml に書く（gakusaiex.events が読み込む）
+# ------------------------
+class TicketTemplate:
+    def __init__(self, subject, body, texts, sender_name=None, stem="整理券", qr=None):
+        self.subject = subject
+        self.body = body
+        self.layout = [(tuple(xy), text, size) for xy, text, size in texts]
+        self.sender_name = sender_name
+        self.stem = stem
+        self.qr = None if qr is None else (tuple(qr[0]), qr[1])
+
+    def _values(self, number, fields):
+        values = {"gakuseki": "", "name": "", "email": ""}
+        values.update({k: "" if v is None else v for k, v in fields.items()})
+        values["number"] = number
+        return values
+
+    def texts(self, number, fields):
+        values = self._values(number, fields)
+        return [(xy, text.format(**values), size) for xy, text, size in self.layout]
+
+    # 書式に使えない {キー} があれば KeyError（起動時に確かめる）
+    def check(self):
+        values = self._values(0, {})
+        self.subject.format(**values)
+        self.body.format(**values)
+        self.texts(0, {})
+
+    # 送信キューに積むバイト列を組み立てるもの（一括発行・再送のようにたくさん送るとき）
+    def builder(self, sender, image_subtype, image_name):
+        return MessageBuilder(self, sender, image_subtype, image_name)
+
+    def message(self, sender, number, fields, image_data, image_subtype, image_name):
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.image import MIMEImage
+        from email.mime.text import MIMEText
+
+        values = self._values(number, fields)
+        msg = MIMEMultipart()
+        msg["From"] = formataddr((self.sender_name, sender)) if self.sender_name else sender
+        msg["To"] = values["email"]
+        msg["Subject"] = self.subject.format(**values)
+        msg.attach(MIMEText(self.body.format(**values), "plain"))
+        image_part = MIMEImage(image_data, _subtype=image_subtype, name=image_name)
+        image_part.add_header("Content-Disposition", "attachment", filename=image_name)
+        msg.attach(image_part)
+        return msg
+
+
+# ------------------------
+# メールのバイト列を直接組み立てる（message() と同じ構成・同じヘッダー）
+# 件名（書式がなければ）・差出人・MIME の区切り・各パートのヘッダーはイベントごとに1回だけ作り、
+# メールごとには宛先・本文と添付画像の base64 だけを作る。
+# 添付画像はエンコードしたバッファ（BytesIO.getbuffer() など）から少しずつ base64 にして、
+# 最終的な大きさで確保した1つの bytearray に直接書き込む（画像の途中コピーを作らない）。
+# 本文も base64 にするので、行頭が "." になる行はなく、そのまま SMTP に流せる（SMTPPool.send_raw）。
+# ------------------------
+WIRE_POLICY = policy.compat32.clone(linesep="\r\n")
+BASE64_CHUNK = 57 * 64  # base64 で 76文字×64行になる大きさずつエンコードする
+
+
+def _fold(name, value):
+    return WIRE_POLICY.fold(name, value).encode("ascii")
+
+
+def _headers(part):
+    return b"".join(_fold(name, value) for name, value in part.items())
+
+
+def _base64_size(n):
+    encoded = 4 * ((n + 2) // 3)
+    return encoded + 2 * ((encoded + 75) // 76)
+
+
+class MessageBuilder:
+    def __init__(self, template, sender, image_subtype, image_name):
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.image import MIMEImage
+        from email.mime.text import MIMEText
+
+        self.template = template
+        self.sender = sender
+        boundary = f"==============={random.randrange(sys.maxsize):019d}=="
+        outer = MIMEMultipart(boundary=boundary)
+        outer["From"] = formataddr((template.sender_name, sender)) if template.sender_name else sender
+        self._head = _headers(outer)
+        has_fields = any(field for _, field, _, _ in Formatter().parse(template.subject))
+        self._subject = None if has_fields else _fold("Subject", template.subject)
+        self._text = b"--" + boundary.encode() + b"\r\n" + _headers(MIMEText("", "plain", "utf-8")) + b"\r\n"
+        image = MIMEImage(b"", _subtype=image_subtype, name=image_name)
+        image.add_header("Content-Disposition", "attachment", filename=image_name)
+        self._image = b"\r\n--" + boundary.encode() + b"\r\n" + _headers(image) + b"\r\n"
+        self._tail = b"\r\n--" + boundary.encode() + b"--\r\n"
+
+    # 送信キューにそのまま積めるバイト列（改行は CRLF）
+    def build(self, number, fields, image):
+        values = self.template._values(number, fields)
+        subject = self._subject or _fold("Subject", self.template.subject.format(**values))
+        body = base64.encodebytes(self.template.body.format(**values).encode("utf-8")).replace(b"\n", b"\r\n")
+        head = b"".join((self._head, _fold("To", values["email"]), subject, b"\r\n", self._text, body, self._image))
+        view = memoryview(image)
+        out = bytearray(len(head) + _base64_size(len(view)) + len(self._tail))
+        out[:len(head)] = head
+        pos = len(head)
+        for i in range(0, len(view), BASE64_CHUNK):
+            chunk = base64.encodebytes(view[i:i + BASE64_CHUNK]).replace(b"\n", b"\r\n")
+            out[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+        out[pos:] = self._tail
+        return out
+
@@ -0,0 +1,56 @@
+import os
+import shutil
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    shutil.copytree(os.path.join(ROOT, "events"), tmp_path / "events")
+    shutil.copy(os.path.join(ROOT, "template.png"), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+# 照会だけなら PIL（描画）を読み込まない
+def test_lookup_does_not_import_pil(workdir):
+    code = (
+        "import sys\n"
+        "from gakusaiex.cli import main\n"
+        "main(['--secrets', 'none.toml', 'lookup', '--gakuseki', '0123456789'])\n"
+        "print('PIL' in sys.modules)\n"
+    )
+    env = {**os.environ, "PYTHONPATH": ROOT}
+    result = subprocess.run([sys.executable, "-c", code], cwd=workdir, env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.splitlines() == ["未発行です", "False"]
+
+
+def _issue(*argv):
+    from gakusaiex.cli import main
+
+    return main(["--secrets", "none.toml", "issue", *argv])
+
+
+# 入力された項目は、組み合わせによらず確かめる
+@pytest.mark.parametrize("argv, error", [
+    (["--name", "山田", "--gakuseki", "12345", "--email", "a@example.com"], "学籍番号は10桁の数字で入力してください"),
+    (["--name", "山田", "--gakuseki", "12345", "--paper"], "学籍番号は10桁の数字で入力してください"),
+    (["--name", "山田", "--gakuseki", "0123456789", "--email-id", "abc"], "メールIDは英数字7桁で入力してください"),
+    (["--name", "山田", "--email", "yamada"], "メールアドレスを正しく入力してください"),
+    (["--name", "山田", "--email", "yamada@localhost"], "メールアドレスを正しく入力してください"),
+    (["--name", " ", "--email", "a@example.com"], "氏名を入力してください"),
+    (["--name", " ", "--paper"], "氏名を入力してください"),
+])
+def test_issue_rejects_invalid_fields(workdir, capsys, argv, error):
+    assert _issue(*argv) == 1
+    assert capsys.readouterr().err.strip() == error
+    assert not os.path.exists(workdir / "tickets.db")
+
+
+def test_issue_without_student_id(workdir, capsys):
+    assert _issue("--name", "来場者", "--paper") == 0
+    assert _issue("--name", "学生", "--gakuseki", "0123456789", "--paper") == 0
+    assert capsys.readouterr().out.splitlines() == ["整理券番号 1 を発行しました", "整理券番号 2 を発行しました"]
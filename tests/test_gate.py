@@ -0,0 +1,74 @@
+import pytest
+from gakusaiex.gate import GateChecker, InvalidTicket, sign, verify
+from gakusaiex.store import SQLiteTicketStore
+
+SECRET = "test-secret"
+
+
+@pytest.fixture
+def checker(tmp_path):
+    store = SQLiteTicketStore(str(tmp_path / "tickets.db"))
+    store.issue(gakuseki="0123456789", name="山田", email="a123456@example.com")
+    store.issue(gakuseki=None, name="佐藤", email="b@example.com")
+    checker = GateChecker(SECRET, store.path, str(tmp_path / "gate.db"))
+    yield checker
+    checker.close()
+
+
+def test_sign_and_verify_round_trip():
+    assert verify(SECRET, sign(SECRET, 12, "0123456789")) == (12, "0123456789")
+    assert verify(SECRET, sign(SECRET, 3)) == (3, None)
+
+
+@pytest.mark.parametrize("payload", [
+    sign(SECRET, 13, "0123456789").replace(":13:", ":14:"),  # 番号の書き換え
+    sign(SECRET, 12, "0123456789").replace("0123456789", "0123456788"),  # 学籍番号の書き換え
+    sign(SECRET, 12, "0123456789")[:-1] + ("B" if sign(SECRET, 12, "0123456789").endswith("A") else "A"),  # 署名の書き換え
+    sign("other-secret", 12, "0123456789"),  # 別の鍵
+    "GX1:12:0123456789",
+    "hello",
+])
+def test_verify_rejects_tampered_codes(payload):
+    with pytest.raises(InvalidTicket):
+        verify(SECRET, payload)
+
+
+def test_admitted_then_already(checker):
+    result, number, gakuseki, name, at = checker.check(sign(SECRET, 1, "0123456789"))
+    assert (result, number, gakuseki, name) == ("admitted", 1, "0123456789", "山田")
+    result, number, _, _, again_at = checker.check(sign(SECRET, 1, "0123456789"))
+    assert (result, number, again_at) == ("already", 1, at)
+    assert checker.admitted_count() == 1
+
+
+def test_ticket_without_student_id(checker):
+    assert checker.check(sign(SECRET, 2))[0] == "admitted"
+
+
+def test_rejects_tampered_wrong_key_and_unknown(checker):
+    assert checker.check(sign(SECRET, 1, "0123456789").replace(":1:", ":2:"))[0] == "invalid"
+    assert checker.check(sign("other-secret", 1, "0123456789"))[0] == "invalid"
+    assert checker.check(sign(SECRET, 1, "9999999999"))[0] == "mismatch"
+    assert checker.check(sign(SECRET, 99))[0] == "unknown"
+    assert checker.admitted_count() == 0
+
+
+# 番号の手入力は allow_manual のときだけ
+def test_manual_entry_is_opt_in(checker, tmp_path):
+    assert checker.check("1")[0] == "invalid"
+    manual = GateChecker(SECRET, checker.log_path, str(tmp_path / "manual.db"), allow_manual=True)
+    try:
+        assert manual.check("1")[0] == "manual"
+        assert manual.check("1")[0] == "already"
+    finally:
+        manual.close()
+
+
+# 入場記録は閉じて開き直しても残る
+def test_admissions_persist(checker, tmp_path):
+    checker.check(sign(SECRET, 1, "0123456789"))
+    reopened = GateChecker(SECRET, checker.log_path, str(tmp_path / "gate.db"))
+    try:
+        assert reopened.check(sign(SECRET, 1, "0123456789"))[0] == "already"
+    finally:
+        reopened.close()
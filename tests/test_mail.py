@@ -0,0 +1,262 @@
+import email
+import smtplib
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+from email import policy
+import pytest
+from gakusaiex.mail import MailOutbox, SMTPPool, TokenBucket, classify_error
+from gakusaiex.templates import TicketTemplate
+
+
+# ------------------------
+# 宛先で応答を変えるローカルの SMTP サーバー
+#   refuse@  RCPT に 550（宛先不明）   busy@  RCPT に 451（一時的）   slow@  RCPT に 421 4.7.0（送りすぎ）
+#   drop@    DATA の本文を受け取ったあと、応答せずに切る
+# ------------------------
+class _Handler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self._reply("220 localhost test")
+        recipient = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                self._reply("250 localhost")
+            elif command == b"RCPT":
+                recipient = line.decode().split("<", 1)[1].split(">", 1)[0]
+                local = recipient.split("@")[0]
+                self._reply({"refuse": "550 5.1.1 no such user", "busy": "451 4.3.0 try later",
+                             "slow": "421 4.7.0 rate limited"}.get(local, "250 OK"))
+            elif command == b"DATA":
+                self._reply("354 go ahead")
+                lines = []
+                while (data := self.rfile.readline()) not in (b".\r\n", b""):
+                    lines.append(data)
+                server.data_count += 1
+                if recipient.startswith("drop@"):
+                    return
+                server.messages.append((recipient, b"".join(lines)))
+                self._reply("250 queued")
+            elif command == b"QUIT":
+                self._reply("221 bye")
+                return
+            else:
+                self._reply("250 OK")
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+@pytest.fixture
+def smtp():
+    server = _Server(("127.0.0.1", 0), _Handler)
+    server.connections = 0
+    server.data_count = 0
+    server.messages = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _pool(smtp, **kwargs):
+    return SMTPPool("127.0.0.1", smtp.server_address[1], use_ssl=False, timeout=5, **kwargs)
+
+
+RAW = b"From: a@example.com\r\nTo: b@example.com\r\nSubject: test\r\n\r\nhello\r\n"
+
+
+# ------------------------
+# 送信エラーの分類
+# ------------------------
+@pytest.mark.parametrize("error, kind", [
+    (smtplib.SMTPRecipientsRefused({"a@example.com": (550, b"5.1.1 no such user")}), "permanent"),
+    (smtplib.SMTPRecipientsRefused({"a@example.com": (451, b"4.3.0 try later")}), "transient"),
+    (smtplib.SMTPDataError(554, b"5.6.0 message rejected"), "permanent"),
+    (smtplib.SMTPDataError(450, b"mailbox busy"), "transient"),
+    (smtplib.SMTPDataError(421, b"service not available"), "throttled"),
+    (smtplib.SMTPDataError(450, b"4.7.0 too many messages"), "throttled"),
+    (smtplib.SMTPDataError(550, b"5.4.5 Daily user sending quota exceeded"), "throttled"),
+    (smtplib.SMTPAuthenticationError(535, b"bad credentials"), "account"),
+    (smtplib.SMTPSenderRefused(553, b"not allowed", "a@example.com"), "account"),
+    (smtplib.SMTPResponseException(530, b"authentication required"), "account"),
+    (smtplib.SMTPServerDisconnected("closed"), "transient"),
+    (ConnectionResetError(104, "reset"), "transient"),
+    (TimeoutError("timed out"), "transient"),
+])
+def test_classify_error(error, kind):
+    assert classify_error(error) == kind
+
+
+# ------------------------
+# 接続プール
+# ------------------------
+def test_error_reply_keeps_the_session(smtp):
+    pool = _pool(smtp)
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        pool.send_raw("a@example.com", ["refuse@example.com"], RAW)
+    pool.send_raw("a@example.com", ["b@example.com"], RAW)
+    pool.close()
+    assert smtp.connections == 1
+    assert [recipient for recipient, _ in smtp.messages] == ["b@example.com"]
+
+
+# DATA の後で切れたら送り直さない（二重に届かないように）
+def test_disconnect_after_data_is_not_retried(smtp):
+    pool = _pool(smtp)
+    with pytest.raises(smtplib.SMTPServerDisconnected):
+        pool.send_raw("a@example.com", ["drop@example.com"], RAW)
+    pool.close()
+    assert smtp.data_count == 1
+
+
+# 切れた接続は捨てて、次の送信は新しい接続で送る
+def test_dead_session_is_replaced(smtp):
+    pool = _pool(smtp)
+    pool.send_raw("a@example.com", ["b@example.com"], RAW)
+    with pool._lock:
+        pool._idle[0].sock.shutdown(socket.SHUT_RDWR)
+    pool.send_raw("a@example.com", ["c@example.com"], RAW)
+    pool.close()
+    assert smtp.connections == 2
+    assert len(smtp.messages) == 2
+
+
+def test_dot_lines_are_escaped(smtp):
+    pool = _pool(smtp)
+    pool.send_raw("a@example.com", ["b@example.com"], b"Subject: dots\r\n\r\n.\r\n..x\r\n")
+    pool.close()
+    assert smtp.messages[0][1].endswith(b"\r\n..\r\n...x\r\n")
+
+
+# ------------------------
+# 送信数の制限
+# ------------------------
+def test_token_bucket_limits_burst_and_day():
+    bucket = TokenBucket(per_minute=60, per_day=3, burst=2)
+    assert [bucket.take() for _ in range(2)] == [0.0, 0.0]
+    assert 0 < bucket.take() <= 1.0
+    time.sleep(1.05)
+    assert bucket.take() == 0.0
+    assert bucket.sent_today() == 3
+    assert bucket.take() > 60
+
+
+# ------------------------
+# 送信キュー
+# ------------------------
+def _outbox(tmp_path, smtp, **kwargs):
+    return MailOutbox(str(tmp_path / "outbox.db"), _pool(smtp), **kwargs)
+
+
+def _row(outbox, outbox_id):
+    conn = sqlite3.connect(outbox.path)
+    try:
+        return conn.execute(
+            "SELECT status, attempts, next_attempt, length(message) FROM outbox WHERE id = ?", (outbox_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+
+
+def _due_now(outbox):
+    conn = sqlite3.connect(outbox.path)
+    with conn:
+        conn.execute("UPDATE outbox SET next_attempt = 0 WHERE status = 'queued'")
+    conn.close()
+
+
+def test_sent_message_body_is_cleared(tmp_path, smtp):
+    outbox = _outbox(tmp_path, smtp)
+    outbox_id = outbox.enqueue(RAW, ticket=1, sender="a@example.com", recipient="b@example.com")
+    assert _row(outbox, outbox_id)[3] == len(RAW)
+    assert outbox.drain() is None
+    assert _row(outbox, outbox_id)[:2] == ("sent", 1)
+    assert _row(outbox, outbox_id)[3] == 0
+    assert outbox.status_of(1) == "sent"
+    assert smtp.messages[0][1] == RAW
+
+
+def test_transient_error_backs_off_then_fails(tmp_path, smtp):
+    outbox = _outbox(tmp_path, smtp, max_attempts=3, base_delay=10.0)
+    outbox_id = outbox.enqueue(RAW, ticket=2, sender="a@example.com", recipient="busy@example.com")
+    before = time.time()
+    wait = outbox.drain()
+    status, attempts, next_attempt, size = _row(outbox, outbox_id)
+    assert (status, attempts, size) == ("queued", 1, len(RAW))
+    assert before + 5.0 <= next_attempt <= time.time() + 10.0
+    assert 0 < wait <= 10.0
+    _due_now(outbox)
+    outbox.drain()
+    assert _row(outbox, outbox_id)[:2] == ("queued", 2)
+    _due_now(outbox)
+    assert outbox.drain() is None
+    assert _row(outbox, outbox_id)[:2] == ("failed", 3)
+    # 送信失敗のメールは本文を残しておき、retry_failed で送り直せる
+    assert _row(outbox, outbox_id)[3] == len(RAW)
+    assert outbox.retry_failed() == 1
+    assert _row(outbox, outbox_id)[:2] == ("queued", 0)
+
+
+def test_backoff_grows_and_is_capped(tmp_path, smtp):
+    outbox = _outbox(tmp_path, smtp, base_delay=2.0, max_delay=30.0)
+    for attempts, delay in ((1, 2.0), (2, 4.0), (3, 8.0), (10, 30.0)):
+        assert all(delay / 2 <= outbox._delay(attempts) <= delay for _ in range(20))
+
+
+def test_permanent_error_fails_at_once(tmp_path, smtp):
+    outbox = _outbox(tmp_path, smtp)
+    outbox_id = outbox.enqueue(RAW, ticket=3, sender="a@example.com", recipient="refuse@example.com")
+    assert outbox.drain() is None
+    assert _row(outbox, outbox_id)[:2] == ("failed", 1)
+
+
+# 送りすぎの応答は試行回数に数えず、アカウントを休ませる
+def test_throttled_error_pauses_the_account(tmp_path, smtp):
+    pool = _pool(smtp, limiter=TokenBucket(per_minute=600, per_day=100))
+    outbox = MailOutbox(str(tmp_path / "outbox.db"), pool)
+    outbox_id = outbox.enqueue(RAW, ticket=4, sender="a@example.com", recipient="slow@example.com")
+    outbox.drain()
+    assert _row(outbox, outbox_id)[:2] == ("queued", 0)
+    assert pool.limiter.take() > 60
+
+
+# ------------------------
+# 組み立てたメール（templates.MessageBuilder）が MIME として読める
+# ------------------------
+def test_message_builder_round_trip():
+    template = TicketTemplate(
+        subject="【学祭】アーティストライブ 整理券（{number}番）のご案内",
+        body="{name} さん\n整理券番号 {number}\n学籍番号 {gakuseki}\n",
+        texts=[((0, 0), "{number}", 10)],
+        sender_name="第80回医学祭実行委員",
+    )
+    image = bytes(range(256)) * 1200
+    raw = bytes(template.builder("sender@example.com", "png", "整理券.png").build(
+        12, {"gakuseki": "0123456789", "name": "山田 太郎", "email": "taro@example.com"}, image,
+    ))
+    assert b"\r\n" in raw and b"\n" not in raw.replace(b"\r\n", b"")
+    assert max(len(line) for line in raw.split(b"\r\n")) <= 998
+    message = email.message_from_bytes(raw, policy=policy.default)
+    assert message["Subject"] == "【学祭】アーティストライブ 整理券（12番）のご案内"
+    assert message["From"].addresses[0].display_name == "第80回医学祭実行委員"
+    assert message["From"].addresses[0].addr_spec == "sender@example.com"
+    assert message["To"] == "taro@example.com"
+    assert message.get_body(("plain",)).get_content() == "山田 太郎 さん\n整理券番号 12\n学籍番号 0123456789\n"
+    attachment = next(message.iter_attachments())
+    assert attachment.get_content_type() == "image/png"
+    assert attachment.get_filename() == "整理券.png"
+    assert attachment.get_content() == image
+    assert not message.defects
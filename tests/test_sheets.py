@@ -0,0 +1,135 @@
+import time
+import pytest
+from gakusaiex.sheets import SheetsReplicator, FakeWorksheet
+from gakusaiex.store import SQLiteTicketStore, DuplicateTicketError
+
+COLUMNS = ["整理券番号", "学籍番号", "氏名", "メール"]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteTicketStore(str(tmp_path / "journal.db"), COLUMNS)
+
+
+def _fields(i):
+    return {"gakuseki": f"{i:010d}", "name": f"学生{i}", "email": f"s{i:06d}@example.com"}
+
+
+# 発行ではシートを読まず、書き込みは append_rows でまとめて行う
+def test_issue_does_not_touch_the_sheet_and_rows_are_batched(store):
+    sheet = FakeWorksheet(COLUMNS)
+    replicator = SheetsReplicator(store, sheet, COLUMNS, batch_size=50)
+    replicator.reconcile()
+    for i in range(1, 8):
+        assert store.issue(**_fields(i)) == i
+        assert store.lookup(email=f"s{i:06d}@example.com") == ("email", i)
+    assert sheet.calls == {"get_all_values": 1, "get_all_records": 0, "append_row": 0, "append_rows": 0}
+    assert replicator.pending_count() == 7
+    assert replicator.sync_once() == 7
+    assert sheet.calls["append_rows"] == 1
+    assert replicator.pending_count() == 0
+    assert sheet.values[1:] == [[i, f"{i:010d}", f"学生{i}", f"s{i:06d}@example.com"] for i in range(1, 8)]
+
+
+def test_sync_sends_in_batches(store):
+    sheet = FakeWorksheet(COLUMNS)
+    replicator = SheetsReplicator(store, sheet, COLUMNS, batch_size=3)
+    replicator.reconcile()
+    for i in range(1, 8):
+        store.issue(**_fields(i))
+    assert [replicator.sync_once() for _ in range(4)] == [3, 3, 1, 0]
+    assert sheet.calls["append_rows"] == 3
+    assert [row[0] for row in sheet.values[1:]] == list(range(1, 8))
+
+
+# 突き合わせるまでは番号の続きが分からないので発行できない
+def test_ready_only_after_reconcile(store):
+    replicator = SheetsReplicator(store, FakeWorksheet(COLUMNS), COLUMNS)
+    assert not replicator.ready()
+    replicator.reconcile()
+    assert replicator.ready()
+
+
+# シートにだけある行は台帳に取り込み、番号はその続きから。台帳にだけある行はシートへ送る
+def test_reconcile_merges_both_sides(store):
+    store.issue(**_fields(1))
+    sheet = FakeWorksheet(COLUMNS)
+    sheet.values += [[2, f"{2:010d}", "学生2", "s000002@example.com"], [3, "", "紙", "紙"]]
+    replicator = SheetsReplicator(store, sheet, COLUMNS)
+    assert replicator.reconcile() == 2
+    assert replicator.pending_count() == 1
+    assert store.lookup(gakuseki=f"{2:010d}") == ("gakuseki", 2)
+    with pytest.raises(DuplicateTicketError):
+        store.issue(**_fields(2))
+    assert store.issue(**_fields(4)) == 4
+    assert replicator.sync_once() == 2
+    assert sorted(int(row[0]) for row in sheet.values[1:]) == [1, 2, 3, 4]
+    # もう一度突き合わせても、同じ行を二重に送ったり取り込んだりしない
+    assert replicator.reconcile() == 0
+    assert replicator.pending_count() == 0
+
+
+# 空のシートには見出しを付けてから書き込む
+def test_header_is_written_to_an_empty_sheet(store):
+    sheet = FakeWorksheet(header=None)
+    replicator = SheetsReplicator(store, sheet, COLUMNS)
+    replicator.reconcile()
+    store.issue(**_fields(1))
+    replicator.sync_once()
+    assert sheet.values == [COLUMNS, [1, f"{1:010d}", "学生1", "s000001@example.com"]]
+
+
+# シートへの書き込みに失敗しても行は台帳に残り、次の同期で送られる
+def test_failed_append_keeps_rows_pending(store):
+    class Flaky(FakeWorksheet):
+        fail = True
+
+        def append_rows(self, values, value_input_option="RAW"):
+            if self.fail:
+                raise ConnectionError("quota exceeded")
+            super().append_rows(values, value_input_option)
+
+    sheet = Flaky(COLUMNS)
+    replicator = SheetsReplicator(store, sheet, COLUMNS)
+    replicator.reconcile()
+    store.issue(**_fields(1))
+    with pytest.raises(ConnectionError):
+        replicator.sync_once()
+    assert isinstance(replicator.last_error(), ConnectionError)
+    assert replicator.pending_count() == 1
+    sheet.fail = False
+    assert replicator.sync_once() == 1
+    assert replicator.last_error() is None
+    assert replicator.pending_count() == 0
+
+
+# シートを開く関数を渡した場合、開くのは最初に使うとき（同期のスレッド）の1回だけ
+def test_worksheet_opener_is_called_once(store):
+    opened = []
+
+    def open_sheet():
+        opened.append(FakeWorksheet(COLUMNS))
+        return opened[-1]
+
+    replicator = SheetsReplicator(store, open_sheet, COLUMNS)
+    assert opened == []
+    replicator.reconcile()
+    store.issue(**_fields(1))
+    replicator.sync_once()
+    assert len(opened) == 1
+    assert opened[0].values[1:] == [[1, f"{1:010d}", "学生1", "s000001@example.com"]]
+
+
+def test_background_thread_syncs(store):
+    sheet = FakeWorksheet(COLUMNS)
+    replicator = SheetsReplicator(store, sheet, COLUMNS, interval=0.05).start()
+    try:
+        store.issue(**_fields(1))
+        replicator.notify()
+        for _ in range(100):
+            if len(sheet.values) == 2:
+                break
+            time.sleep(0.02)
+    finally:
+        replicator.stop(timeout=5)
+    assert sheet.values[1:] == [[1, f"{1:010d}", "学生1", "s000001@example.com"]]
@@ -0,0 +1,125 @@
+import threading
+import pytest
+from gakusaiex.store import open_store, DeskIssuer, DuplicateTicketError
+
+
+@pytest.fixture(params=["sqlite", "csv"])
+def store(request, tmp_path):
+    return open_store(
+        request.param, str(tmp_path / "tickets.db"), str(tmp_path / "tickets.csv"), str(tmp_path / "tickets_all.csv")
+    )
+
+
+def _fields(i):
+    return {"gakuseki": f"{i:010d}", "name": f"学生{i}", "email": f"s{i:06d}@example.com"}
+
+
+# リセットした端末（同じスレッド・同じ接続）でも、リセット前の整理券は重複にならない
+def test_reset_then_lookup_and_issue(store):
+    assert store.issue(**_fields(1)) == 1
+    assert store.lookup(email="s000001@example.com") == ("email", 1)
+    store.reset()
+    assert store.lookup(email="s000001@example.com") is None
+    assert store.issue(**_fields(1)) == 1
+    with pytest.raises(DuplicateTicketError):
+        store.issue(**_fields(1))
+
+
+# ------------------------
+# 複数の受付（別々のストアのインスタンス＝別プロセスと同じ）から同時に発行する
+# ------------------------
+def _open_same(store, tmp_path):
+    kind = "csv" if hasattr(store, "all_log") else "sqlite"
+    return open_store(kind, str(tmp_path / "tickets.db"), str(tmp_path / "tickets.csv"), str(tmp_path / "tickets_all.csv"))
+
+
+def _run(workers):
+    errors = []
+
+    def wrap(fn):
+        try:
+            fn()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=wrap, args=(fn,)) for fn in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_concurrent_issue_gives_unique_numbers(store, tmp_path):
+    desks, per_desk = 4, 15
+    numbers = []
+
+    def desk(d):
+        local = _open_same(store, tmp_path)
+        for i in range(per_desk):
+            numbers.append(local.issue(**_fields(d * 1000 + i)))
+
+    assert _run([lambda d=d: desk(d) for d in range(desks)]) == []
+    assert sorted(numbers) == list(range(1, desks * per_desk + 1))
+    assert len(_open_same(store, tmp_path).frame()) == desks * per_desk
+
+
+def test_concurrent_duplicate_is_issued_once(store, tmp_path):
+    issued = []
+    errors = _run([lambda: issued.append(_open_same(store, tmp_path).issue(**_fields(7))) for _ in range(4)])
+    assert len(issued) == 1
+    assert len(errors) == 3 and all(isinstance(e, DuplicateTicketError) for e in errors)
+
+
+# ------------------------
+# 番号の予約（DeskIssuer）
+# ------------------------
+def test_desk_blocks_do_not_overlap(store, tmp_path):
+    first, second = DeskIssuer(store, 5), DeskIssuer(_open_same(store, tmp_path), 5)
+    numbers = [issuer.issue(**_fields(i)) for i, issuer in enumerate([first, second] * 6)]
+    assert numbers == [1, 6, 2, 7, 3, 8, 4, 9, 5, 10, 11, 16]
+    assert len(set(numbers)) == len(numbers)
+
+
+def test_release_returns_the_unused_tail(store, tmp_path):
+    desk = DeskIssuer(store, 5)
+    assert desk.issue(**_fields(1)) == 1
+    assert desk.release() == []
+    assert store.next_number() == 2
+    assert _open_same(store, tmp_path).issue(**_fields(2)) == 2
+
+
+def test_release_after_another_reservation_leaves_gaps(store, tmp_path):
+    first, second = DeskIssuer(store, 5), DeskIssuer(_open_same(store, tmp_path), 5)
+    assert first.issue(**_fields(1)) == 1
+    assert second.issue(**_fields(2)) == 6
+    assert first.release() == [2, 3, 4, 5]
+    assert second.release() == []
+    assert store.next_number() == 7
+
+
+def test_block_is_dropped_after_reset(store, tmp_path):
+    desk = DeskIssuer(store, 5)
+    assert [desk.issue(**_fields(i)) for i in range(2)] == [1, 2]
+    _open_same(store, tmp_path).reset()
+    assert desk.issue(**_fields(10)) == 1
+    assert store.lookup(email=_fields(0)["email"]) is None
+
+
+def test_block_is_dropped_after_restart_from(store, tmp_path):
+    desk = DeskIssuer(store, 5)
+    assert desk.issue(**_fields(1)) == 1
+    _open_same(store, tmp_path).restart_from(100)
+    assert desk.issue(**_fields(2)) == 100
+    with pytest.raises(DuplicateTicketError):
+        desk.issue(**_fields(1))
+
+
+# 予約したまま落ちた受付の番号は欠番になり、次に起動したストアはその後から続ける
+def test_unreleased_block_survives_restart(store, tmp_path):
+    desk = DeskIssuer(store, 5)
+    assert desk.issue(**_fields(1)) == 1
+    reopened = _open_same(store, tmp_path)
+    assert reopened.next_number() == 6
+    assert reopened.issue(**_fields(2)) == 6
+    assert reopened.lookup(email=_fields(1)["email"]) == ("email", 1)
@@ -1,14 +1,15 @@
 import streamlit as st
-import pandas as pd
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.image import MIMEImage
-from email.mime.text import MIMEText
-import os
+import atexit
 import io
+import os
 import re
-from PIL import Image, ImageDraw, ImageFont
-from email.utils import formataddr
+from gakusaiex import preload
+from gakusaiex.mail import MailOutbox, STATUS_LABELS, GMAIL_PER_MINUTE, GMAIL_PER_DAY, sender_pools
+from gakusaiex.metrics import Metrics, STAGE_LABELS
+from gakusaiex.store import open_store, DeskIssuer, DuplicateTicketError, PAPER_EMAIL
+from gakusaiex.service import TicketService, check_student, duplicate_message
+from gakusaiex.events import load_events
+from gakusaiex.renderpool import RenderPool, event_preload
 
 
 # ------------------------
@@ -18,44 +19,127 @@ EMAIL_FROM = st.secrets["email_from"]
 APP_PASSWORD = st.secrets["app_password"]
 PASSWORD = st.secrets["admin_password"]
 
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 465
-BASE_IMAGE = "template.png"
-LOG_FILE = "tickets.csv"
-ALL_LOG_FILE = "tickets_all.csv"
-FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
-
-# ------------------------
-# ログ読み込み or 初期化
-# ------------------------
-def load_log():
-    if os.path.exists(LOG_FILE):
-        df = pd.read_csv(LOG_FILE)
-        if "整理券番号" in df.columns and not df["整理券番号"].isnull().all():
-            max_num = pd.to_numeric(df["整理券番号"], errors='coerce').max()
-            if pd.isna(max_num):
-                next_num = 1
-            else:
-                next_num = int(max_num) + 1
-        else:
-            next_num = 1
-        return df, next_num
-    else:
-        df = pd.DataFrame(columns=["整理券番号", "学籍番号", "氏名", "メール"])
-        return df, 1
+SMTP_SERVER = st.secrets.get("smtp_server", "smtp.gmail.com")
+SMTP_PORT = int(st.secrets.get("smtp_port", 465))
+SMTP_SSL = st.secrets.get("smtp_ssl", True)  # false: 平文で接続する（ローカルの検証用）
+EVENTS_DIR = "events"  # イベントごとの設定（テンプレート・レイアウト・入力欄・メール・ログの保存先）
+STORE_KIND = st.secrets.get("ticket_store")  # sqlite / csv（指定があればイベントの設定より優先）
+TICKET_FORMAT = st.secrets.get("ticket_format")  # png / png8 / jpeg / webp（同上）
+# 0: 1枚ずつ採番 / n: 受付端末（URL の ?desk=名前。省略時は全画面で1つ）ごとに n 番ずつ予約。
+# 予約は再読み込み・タブを閉じても端末に残る。サーバーを止めると使わなかった番号は返すが、落ちたときは最大 n-1 番が欠番になる
+NUMBER_BLOCK = int(st.secrets.get("number_block", 0))
+TICKET_SECRET = st.secrets.get("ticket_secret")  # 整理券の QR コードの署名の鍵（受付の照合 python -m gakusaiex gate と同じもの）
+CACHE_DIR = "ticket_cache"  # 再送する整理券画像のキャッシュ（消してもよい）
+ARCHIVE_LIMIT = 1000  # 保管庫の検索で表示する件数の上限
+RENDER_WORKERS = int(st.secrets.get("render_workers", 0))  # 整理券画像を描くワーカープロセスの数（0: CPU の数）
+# 送信数の上限（アカウントごと）。Gmail の制限を超えると送れなくなるので、それ以下に抑えて送る
+MAIL_PER_MINUTE = int(st.secrets.get("mail_per_minute", GMAIL_PER_MINUTE))
+MAIL_PER_DAY = int(st.secrets.get("mail_per_day", GMAIL_PER_DAY))
+# 送信元アカウント。[[senders]]（email_from / app_password）を追加すると、上限に余裕のあるアカウントから順に使う
+SENDERS = [(EMAIL_FROM, APP_PASSWORD)] + [(s["email_from"], s["app_password"]) for s in st.secrets.get("senders", [])]
+
+# ------------------------
+# イベント（events/*.toml）。設定の読み込みと画像・フォントの準備は起動時に1回だけ
+# どのイベントの画面にするかは URL の ?event=guest、環境変数 GAKUSAIEX_EVENT、secrets の event の順
+# （ticket_app_out.py のように、このファイルを runpy で実行するときは FIXED_EVENT を渡すとそれに固定する）
+# 1つのサーバーで複数のイベントを同時に受け付けられる（ストア・送信キューはイベントごと）
+# ------------------------
+@st.cache_resource
+def get_events():
+    return load_events(EVENTS_DIR)
+
+EVENT_NAME = globals().get("FIXED_EVENT") or st.query_params.get("event") or os.environ.get("GAKUSAIEX_EVENT") or st.secrets.get("event", "live")
+if EVENT_NAME not in get_events():
+    st.error(f"イベント「{EVENT_NAME}」の設定がありません（{EVENTS_DIR}/{EVENT_NAME}.toml）")
+    st.stop()
+event = get_events()[EVENT_NAME]
+FORM = event.form
 
-if "next_number" not in st.session_state:
-    df, next_number = load_log()
-    st.session_state.df = df
-    st.session_state.next_number = next_number
-else:
-    df = st.session_state.df
-    next_number = st.session_state.next_number
+# ------------------------
+# 処理時間の記録（全セッションで共有するリングバッファ）
+# ------------------------
+@st.cache_resource
+def get_metrics():
+    return Metrics()
+
+# ------------------------
+# SMTP接続・送信キュー（再実行をまたいで使い回す）
+# ------------------------
+@st.cache_resource
+def get_smtp_pools():
+    return sender_pools(SMTP_SERVER, SMTP_PORT, SENDERS, MAIL_PER_MINUTE, MAIL_PER_DAY, get_metrics(), use_ssl=SMTP_SSL)
+
+@st.cache_resource
+def get_outbox(path):
+    # 送信はバックグラウンドのワーカーが行う（発行処理はキューに積むだけ）
+    return MailOutbox(path, get_smtp_pools()).start()
+
+# ------------------------
+# 画像生成のワーカープロセス（全イベントのテンプレート・フォントを読み込んで常駐）
+# 描画は画面のスレッドではなくワーカーで行い、一括発行・再送は全コアで描く
+# ワーカーの起動は裏で進める（ログイン画面を待たせない。最初の描画は起動を待つ）
+# ------------------------
+@st.cache_resource
+def get_render_pool():
+    return RenderPool(RENDER_WORKERS or None, event_preload(get_events().values())).start(wait=False)
+
+# ------------------------
+# 整理券ストア（番号の割り当てとログ）
+# イベントごとに1つを全セッションで共有し、番号は発行時にストアが割り当てる
+# ------------------------
+@st.cache_resource
+def get_store(name):
+    log = get_events()[name].log
+    return open_store(STORE_KIND or log["store"], log["db"], log["csv"], log["all_csv"], log["columns"])
+
+store = get_store(EVENT_NAME)
+
+# 番号をまとめて予約する設定なら、受付端末ごとに予約した範囲から発行する
+# 予約はセッションではなく端末ごとに持つ（セッションごとだと再読み込みのたびに予約の残りが欠番になる）
+@st.cache_resource
+def get_desk(name, desk):
+    issuer = DeskIssuer(get_store(name), NUMBER_BLOCK)
+    atexit.register(issuer.release)
+    return issuer
+
+def get_issuer():
+    if not NUMBER_BLOCK:
+        return store
+    return get_desk(EVENT_NAME, st.query_params.get("desk", ""))
+
+# ------------------------
+# 発行処理（番号の割り当て → 画像生成 → メール作成 → 送信キュー）
+# ------------------------
+# これまでの整理券の保管庫（過去のイベントの重複チェック・検索。ファイルごとに1つ）
+@st.cache_resource
+def get_archive(path):
+    from gakusaiex.archive import HistoryArchive
+
+    return HistoryArchive(path)
+
+@st.cache_resource
+def get_service(name):
+    from gakusaiex.renderer import ImageCache
+
+    event = get_events()[name]
+    past_events = event.form["past_events"]
+    return TicketService(
+        get_store(name), event.template, EMAIL_FROM, get_outbox(event.log["outbox"]), TICKET_FORMAT or event.fmt,
+        event.base_image, event.font, get_metrics(), TICKET_SECRET, ImageCache(os.path.join(CACHE_DIR, name)),
+        get_render_pool(), get_archive(event.log["archive"]) if past_events else None, past_events,
+    )
+
+service = get_service(EVENT_NAME)
 
 # ------------------------
 # ログイン画面
+# ログイン後の画面で使う pandas（読み込みに約0.5秒）は、ログイン画面を出し終えてから裏で読み込んでおく
 # ------------------------
-st.title("学祭アーティストライブ 整理券発行アプリ")
+@st.cache_resource
+def preload_modules():
+    return preload("pandas", "gakusaiex.logview")
+
+st.title(event.title)
 
 if "authenticated" not in st.session_state:
     st.session_state.authenticated = False
@@ -66,8 +150,13 @@ if not st.session_state.authenticated:
         st.session_state.authenticated = True
         st.success("ログイン成功！")
     else:
+        preload_modules()
         st.stop()
 
+# ログイン後の画面で使うもの（ログイン画面では読み込まない）
+import pandas as pd
+from gakusaiex.logview import log_viewer
+
 # ------------------------
 # メンテナンス機能
 # ------------------------
@@ -87,134 +176,226 @@ with st.expander("ログと整理券番号のメンテナンス"):
             st.warning("確認にチェックが入っていません")
         else:
             if option == "ログをリセット":
-                df = pd.DataFrame(columns=["整理券番号", "学籍番号", "氏名", "メール"])
-                df.to_csv(LOG_FILE, index=False)
-                st.session_state.df = df
-                st.session_state.next_number = 1
+                service.reset()
                 st.success("ログと整理券番号をリセットしました")
             elif option == "途中から整理券番号を指定して再開":
-                st.session_state.next_number = new_start
+                service.restart_from(new_start)
                 st.success(f"整理券番号を {new_start} から再開します")
 
+with st.expander("処理時間・送信状況"):
+    metrics = get_metrics()
+    window = st.selectbox("集計する期間", (60, 300, 900, 3600), index=1, format_func=lambda s: f"直近 {s // 60} 分")
+    summary = metrics.summary(window)
+    counts = summary["counts"]
+    col1, col2, col3, col4, col5 = st.columns(5)
+    col1.metric("発行（枚/分）", summary["per_minute"])
+    col2.metric("SMTPの失敗", sum(summary["stages"].get(s, {}).get("errors", 0) for s in ("smtp_connect", "smtp_login", "smtp_send")))
+    col3.metric("再送待ちにした数", counts.get("mail_retry", 0))
+    col4.metric("送信失敗にした数", counts.get("mail_failed", 0))
+    col5.metric("送りすぎで待機", counts.get("mail_throttled", 0))
+    if summary["stages"]:
+        stage_df = pd.DataFrame.from_dict(summary["stages"], orient="index")
+        stage_df = stage_df.reindex([s for s in STAGE_LABELS if s in stage_df.index])
+        stage_df.index = stage_df.index.map(STAGE_LABELS)
+        stage_df.columns = ["件数", "失敗", "p50（ms）", "p95（ms）", "最大（ms）"]
+        st.dataframe(stage_df)
+    else:
+        st.caption("まだ記録がありません")
+    col1, col2 = st.columns(2)
+    col1.download_button(
+        "Prometheus 形式でダウンロード", data=lambda: metrics.prometheus(window), file_name="gakusaiex.prom", mime="text/plain"
+    )
+    col2.download_button(
+        "JSON Lines でダウンロード", data=metrics.jsonl, file_name="gakusaiex_metrics.jsonl", mime="application/json"
+    )
+
 # ------------------------
-# 入力フォーム
+# 入力フォーム（入力欄はイベントの設定 [form] の fields）
 # ------------------------
 st.subheader("整理券情報入力")
 
+FIELDS = FORM["fields"]
+
 with st.form("ticket_form"):
-    gakuseki = st.text_input("学籍番号（10桁）", max_chars=10)
+    gakuseki = st.text_input("学籍番号（10桁）", max_chars=10) if "gakuseki" in FIELDS else ""
     name = st.text_input("氏名")
-    email_prefix = st.text_input("学内メールID（英数字7桁）", max_chars=7)
+    email_prefix = local_part = selected_domain = full_email_manual = ""
+    if "email_id" in FIELDS:
+        email_prefix = st.text_input("学内メールID（英数字7桁）", max_chars=7)
+    if "email" in FIELDS:
+        local_part = st.text_input("メールアドレスの＠より前")
+        selected_domain = st.selectbox("ドメインを選んでください（その他を選んだ場合は全体を入力）", FORM["domains"])
+        if selected_domain == "その他":
+            full_email_manual = st.text_input("メールアドレスを全て入力してください（例: abc@example.com）")
+    skip_email = FORM["paper"] and st.checkbox("メールアドレスを持っていない、または紙で整理券を受け取る")
     submitted = st.form_submit_button("整理券を発行して送信")
 
+# 入力チェック。(エラーメッセージ, メールアドレス) を返す
+def check_form():
+    if "email_id" in FIELDS:
+        return check_student(gakuseki, name, email_prefix), f"{email_prefix}@{FORM['email_domain']}"
+    if not name.strip():
+        return "氏名を入力してください", None
+    if skip_email:
+        return None, PAPER_EMAIL
+    if selected_domain == "その他":
+        if not full_email_manual or "@" not in full_email_manual:
+            return "メールアドレスを正しく入力してください", None
+        return None, full_email_manual
+    if not local_part or not re.fullmatch(r"[A-Za-z0-9._%+-]+", local_part):
+        return "＠より前を正しく入力してください", None
+    return None, f"{local_part}@{selected_domain}"
+
 if submitted:
-    email = f"{email_prefix}@yamaguchi-u.ac.jp"
-
-    if len(gakuseki) != 10 or not gakuseki.isdigit():
-        st.error("学籍番号は10桁の数字で入力してください")
-    elif not re.fullmatch(r"[A-Za-z0-9]{7}", email_prefix):
-        st.error("メールIDは英数字7桁で入力してください")
-    elif not name.strip():
-        st.error("氏名を入力してください")
-    elif email in df["メール"].values:
-        st.warning("このメールにはすでに整理券が発行されています")
+    with service.metrics.stage("validate"):
+        error, email = check_form()
+        found = None if error else service.lookup(email=email, gakuseki=gakuseki or None)
+
+    if error is not None:
+        st.error(error)
+    elif found is not None:
+        st.warning(duplicate_message(found))
     else:
         try:
-            # 画像生成（氏名は入れない）
-            image = Image.open(BASE_IMAGE).convert("RGB")
-            draw = ImageDraw.Draw(image)
-            font = ImageFont.truetype(FONT_PATH, 90)
-            draw.text((680, 300), f"{next_number}", font=font, fill="black")
-            font = ImageFont.truetype(FONT_PATH, 36)
-            draw.text((660, 500), f"{gakuseki}", font=font, fill="black")
-            img_buffer = io.BytesIO()
-            image.save(img_buffer, format="PNG")
-            img_buffer.seek(0)
-
-            # メール作成（氏名入り）
-            msg = MIMEMultipart()
-            msg["From"] = formataddr(("第80回医学祭実行委員", EMAIL_FROM))
-            msg["To"] = email
-            msg["Subject"] = "【学祭】アーティストライブ 整理券のご案内"
-            body = f"""{name} さん
-
-第80回山口大学医学祭
-KANA-BOON Rolling University TOURの整理券を発行しました。
-
-集合時間　16時30分
-集合場所　講義棟B入口付近
-
-当日は係員の指示に従って学生証と一緒に、この添付画像を提示してください。
-
-なにか問題があれば
-c052ebw@yamaguchi-u.ac.jp
-にご連絡ください。
-
-"""
-            msg.attach(MIMEText(body, "plain"))
-
-            image_part = MIMEImage(img_buffer.read(), _subtype="png", name="整理券.png")
-            image_part.add_header("Content-Disposition", "attachment", filename="整理券.png")
-            msg.attach(image_part)
-
-            with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) as server:
-                server.login(EMAIL_FROM, APP_PASSWORD)
-                server.send_message(msg)
-
-            # ログ保存
-            new_row = pd.DataFrame([[next_number, gakuseki, name, email]], columns=df.columns)
-            df = pd.concat([df, new_row], ignore_index=True)
-            df.to_csv(LOG_FILE, index=False)
-            # 蓄積ログにも保存
-            if os.path.exists(ALL_LOG_FILE):
-                df_all = pd.read_csv(ALL_LOG_FILE)
-                df_all = pd.concat([df_all, new_row], ignore_index=True)
-            else:
-                df_all = new_row
-            df_all.to_csv(ALL_LOG_FILE, index=False)
-
-            st.session_state.df = df
-            st.session_state.next_number += 1
-
-            st.success(f"整理券番号 {next_number} を送信しました🎉")
+            # 番号の割り当てとログ保存（重複があればここで弾かれる）→ 画像生成 → メールは送信キューへ
+            next_number = service.issue(get_issuer(), gakuseki=gakuseki or None, name=name, email=email)
+            st.success(f"整理券番号 {next_number} を発行しました🎉{'' if email == PAPER_EMAIL else '（メールは順次送信されます）'}")
 
+        except DuplicateTicketError as e:
+            st.warning(str(e))
         except Exception as e:
-            st.error(f"送信失敗: {e}")
+            st.error(f"発行失敗: {e}")
+
+# ------------------------
+# 名簿から一括発行
+# ------------------------
+if FORM["bulk"]:
+    st.subheader("📂 一括発行")
+    with st.expander("名簿（CSV / Excel）から一括で整理券を発行"):
+        st.caption("列: 学籍番号, 氏名, メールID（学内メールの＠より前の7桁）")
+        roster_file = st.file_uploader("名簿ファイル", type=["csv", "xlsx", "xls"], key="roster_file")
+        if roster_file is not None:
+            from gakusaiex.bulk import read_roster, validate_roster
+
+            try:
+                roster = validate_roster(
+                    read_roster(roster_file), store.emails(), store.student_ids(), FORM["email_domain"], *service.past_keys()
+                )
+            except Exception as e:
+                st.error(f"名簿の読み込みに失敗しました: {e}")
+                st.stop()
+            valid = roster[roster["エラー"] == ""]
+            st.write(f"発行可能: {len(valid)} 件　エラー: {len(roster) - len(valid)} 件")
+            st.dataframe(roster)
+
+            if len(valid) and st.button(f"{len(valid)} 件を一括発行して送信", key="bulk_submit"):
+                # 番号の割り当てとログ保存（連番をまとめて確保）→ 画像生成 → 送信キューへ（送信数の上限を守って順に送信）
+                progress = st.progress(0.0, text="整理券画像を生成中…")
+                try:
+                    numbers, results = service.bulk_issue(
+                        [
+                            {"gakuseki": row.学籍番号, "name": row.氏名, "email": row.メール}
+                            for row in valid.itertuples(index=False)
+                        ],
+                        get_issuer(),
+                        on_render=lambda done, total: progress.progress(done / total, text=f"整理券画像を生成中… {done}/{total}"),
+                        on_send=lambda done, total: progress.progress(done / total, text=f"送信キューに追加中… {done}/{total}"),
+                    )
+                except DuplicateTicketError as e:
+                    st.error(f"一括発行を中止しました: {e}")
+                    st.stop()
+
+                report = roster.copy()
+                report["整理券番号"] = pd.Series(numbers, index=valid.index, dtype="Int64")
+                report["結果"] = report["エラー"]
+                report.loc[valid.index, "結果"] = results
+                st.success(f"整理券番号 {numbers[0]}〜{numbers[-1]} を発行しました🎉（メールは順次送信されます）")
+                st.dataframe(report[["整理券番号", "学籍番号", "氏名", "メール", "結果"]])
+                report_buffer = io.BytesIO()
+                report.to_csv(report_buffer, sep="\t", index=False, encoding="utf-8")
+                report_buffer.seek(0)
+                st.download_button(
+                    label="一括発行の結果をダウンロード（タブ区切り）",
+                    data=report_buffer,
+                    file_name="一括発行結果.txt",
+                    mime="text/plain"
+                )
+
+# ------------------------
+# メール送信状況
+# ------------------------
+st.subheader("メール送信状況")
+outbox = service.outbox
+counts = outbox.counts()
+st.write("　".join(f"{label}: {counts.get(status, 0)}" for status, label in STATUS_LABELS.items()))
+st.caption("直近24時間の送信数　" + "　".join(f"{pool.user}: {pool.limiter.sent_today()}/{pool.limiter.per_day}" for pool in outbox.pools))
+if counts.get("failed"):
+    if st.button("送信失敗したメールを再送する"):
+        st.success(f"{outbox.retry_failed()} 件を再送キューに戻しました")
+if st.checkbox("送信状況を表示する"):
+    status_df = pd.DataFrame(outbox.statuses(limit=500), columns=["ticket", "recipient", "status", "attempts", "last_error"])
+    status_df["status"] = status_df["status"].map(STATUS_LABELS)
+    status_df.columns = ["整理券番号", "メール", "状態", "試行回数", "エラー"]
+    st.dataframe(status_df)
+
+# 発行済みの内容から整理券画像とメールを作り直して送る（番号は変わらない）
+with st.expander("整理券の再送（ログから作り直す）"):
+    with st.form("resend_one_form"):
+        resend_number = st.number_input("整理券番号", min_value=1, step=1, value=1, key="resend_number")
+        resend_one = st.form_submit_button("この整理券を再送する")
+    if resend_one:
+        try:
+            service.resend(resend_number)
+            st.success(f"整理券番号 {resend_number} を送信キューに積みました")
+        except (KeyError, ValueError) as e:
+            st.warning(e.args[0])
+
+    with st.form("resend_many_form"):
+        col1, col2 = st.columns(2)
+        resend_from = col1.number_input("整理券番号（から）", min_value=1, step=1, value=1, key="resend_from")
+        resend_to = col2.number_input("整理券番号（まで）", min_value=0, step=1, value=0, key="resend_to", help="0 なら最後まで")
+        include_queued = st.checkbox("送信待ちのものも作り直す", key="resend_queued")
+        resend_many = st.form_submit_button("未送信・送信失敗の整理券をまとめて再送する")
+    if resend_many:
+        targets = service.undelivered(resend_from, resend_to or None, include_queued)
+        if not targets:
+            st.info("再送する整理券はありません")
+        else:
+            progress = st.progress(0.0, text="整理券を作り直しています…")
+            service.resend_many(targets, on_progress=lambda done, total: progress.progress(done / total, text=f"整理券を作り直しています… {done}/{total}"))
+            st.success(f"{len(targets)} 件（整理券番号 {targets[0]}〜{targets[-1]}）を送信キューに積みました")
 
 # ------------------------
 # CSV確認・ダウンロード (.txt形式)
 # ------------------------
 st.subheader("整理券ログ")
+version = store.version()
+log_viewer(store.frame(), version, f"{EVENT_NAME}_log", "ログを表示する", "整理券ログをダウンロード（タブ区切り）", "整理券ログ.txt")
 
-if st.checkbox("ログを表示する"):
-    st.dataframe(df)
-
-if not df.empty:
-    txt_buffer = io.BytesIO()
-    df.to_csv(txt_buffer, sep='\t', index=False, encoding="utf-8")
-    txt_buffer.seek(0)
-    st.download_button(
-        label="整理券ログをダウンロード（タブ区切り）",
-        data=txt_buffer,
-        file_name="整理券ログ.txt",
-        mime="text/plain"
-    )
-
-if os.path.exists(ALL_LOG_FILE):
-    df_all = pd.read_csv(ALL_LOG_FILE)
+df_all = store.history()
+if not df_all.empty:
     st.subheader("全体ログ（リセットされずに保存され続ける）")
-    if st.checkbox("全体ログを表示する"):
-        st.dataframe(df_all)
-    if not df_all.empty:
-        txt_all_buffer = io.BytesIO()
-        df_all.to_csv(txt_all_buffer, sep='\t', index=False, encoding="utf-8")
-        txt_all_buffer.seek(0)
-        st.download_button(
-            label="全体ログをダウンロード（タブ区切り）",
-            data=txt_all_buffer,
-            file_name="整理券全体ログ.txt",
-            mime="text/plain"
+    log_viewer(df_all, version, f"{EVENT_NAME}_log_all", "全体ログを表示する", "全体ログをダウンロード（タブ区切り）", "整理券全体ログ.txt")
+
+# 過去のイベントも含めて、条件に合う整理券だけを保管庫から読む（全体ログを全部読まない）
+# 検索の前にこのイベントのログの増えた行を取り込む（2回目からは増えた分だけ）
+with st.expander("過去の整理券を検索（保管庫）"):
+    with st.form("archive_form"):
+        col1, col2 = st.columns(2)
+        archive_email = col1.text_input("メールアドレス", key="archive_email")
+        archive_gakuseki = col2.text_input("学籍番号", key="archive_gakuseki")
+        archive_since = col1.date_input("発行日（から）", value=None, key="archive_since")
+        archive_until = col2.date_input("発行日（まで）", value=None, key="archive_until")
+        archive_search = st.form_submit_button("検索")
+    if archive_search:
+        archive = get_archive(event.log["archive"])
+        archive.sync(store, EVENT_NAME)
+        found_df = archive.query(
+            email=archive_email or None, gakuseki=archive_gakuseki or None, since=archive_since, until=archive_until,
+            limit=ARCHIVE_LIMIT,
         )
+        st.caption(f"{len(found_df)} 件" + ("（先頭のみ表示）" if len(found_df) == ARCHIVE_LIMIT else ""))
+        st.dataframe(found_df, hide_index=True)
 
 
 
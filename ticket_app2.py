@@ -1,14 +1,11 @@
 import streamlit as st
-import pandas as pd
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.image import MIMEImage
-from email.mime.text import MIMEText
-import io
-import re
-from PIL import Image, ImageDraw, ImageFont
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from gakusaiex import preload
+from gakusaiex.mail import MailOutbox, STATUS_LABELS, GMAIL_PER_MINUTE, GMAIL_PER_DAY, sender_pools
+from gakusaiex.store import DuplicateTicketError, SQLiteTicketStore
+from gakusaiex.sheets import SheetsReplicator
+from gakusaiex.service import TicketService, check_student, duplicate_message
+from gakusaiex.events import load_event
+from gakusaiex.renderpool import RenderPool, event_preload
 
 # ------------------------
 # 設定（Secretsから取得）
@@ -17,38 +14,93 @@ EMAIL_FROM = st.secrets["config"]["email_from"]
 APP_PASSWORD = st.secrets["config"]["app_password"]
 PASSWORD = st.secrets["config"]["admin_password"]
 SPREADSHEET_URL = st.secrets["config"]["spreadsheet_url"]
-FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
-BASE_IMAGE = "template.png"
+GCP_SERVICE_ACCOUNT = st.secrets["gcp_service_account"]
+SMTP_SERVER = st.secrets["config"].get("smtp_server", "smtp.gmail.com")
+SMTP_PORT = int(st.secrets["config"].get("smtp_port", 465))
+SMTP_SSL = st.secrets["config"].get("smtp_ssl", True)  # false: 平文で接続する（ローカルの検証用）
+OUTBOX_FILE = "outbox.db"
+EVENT_FILE = "events/sheets.toml"  # テンプレート・レイアウト・メールの文面
+RENDER_WORKERS = int(st.secrets["config"].get("render_workers", 0))  # 整理券画像を描くワーカープロセスの数（0: CPU の数）
+TICKET_FORMAT = st.secrets["config"].get("ticket_format")  # png / png8 / jpeg / webp（指定があればイベントの設定より優先）
+JOURNAL_FILE = "sheets_journal.db"  # 発行記録の控え（スプレッドシートへはここから送る）
+# 送信数の上限（アカウントごと）。Gmail の制限を超えると送れなくなるので、それ以下に抑えて送る
+MAIL_PER_MINUTE = int(st.secrets["config"].get("mail_per_minute", GMAIL_PER_MINUTE))
+MAIL_PER_DAY = int(st.secrets["config"].get("mail_per_day", GMAIL_PER_DAY))
+# 送信元アカウント。[[senders]]（email_from / app_password）を追加すると、上限に余裕のあるアカウントから順に使う
+SENDERS = [(EMAIL_FROM, APP_PASSWORD)] + [(s["email_from"], s["app_password"]) for s in st.secrets["config"].get("senders", [])]
+
+# ------------------------
+# SMTP接続・送信キュー（再実行をまたいで使い回す）
+# ------------------------
+@st.cache_resource
+def get_smtp_pools():
+    return sender_pools(SMTP_SERVER, SMTP_PORT, SENDERS, MAIL_PER_MINUTE, MAIL_PER_DAY, use_ssl=SMTP_SSL)
+
+@st.cache_resource
+def get_outbox():
+    # 送信はバックグラウンドのワーカーが行う（発行処理はキューに積むだけ）
+    return MailOutbox(OUTBOX_FILE, get_smtp_pools()).start()
 
 # ------------------------
 # Google Sheets接続
+# 認証とシートを開くのは、シートと同期するスレッド（get_replicator）が最初に1回だけ行う。
+# gspread の読み込み・認証で画面の起動を待たせない
 # ------------------------
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scope)
-client = gspread.authorize(creds)
-sheet = client.open_by_url(SPREADSHEET_URL).sheet1
+def open_sheet():
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(GCP_SERVICE_ACCOUNT, scope)
+    client = gspread.authorize(creds)
+    return client.open_by_url(SPREADSHEET_URL).sheet1
 
 # ------------------------
 # ログ取得 & 整理券番号決定
+# 発行はまずローカルの台帳（SQLite）に記録して番号もそこで決める。
+# スプレッドシートへはバックグラウンドでまとめて書き込む（つながらない間は台帳に貯めておく）
 # ------------------------
-def load_data():
-    try:
-        data = sheet.get_all_records()
-        df = pd.DataFrame(data)
-        if not df.empty:
-            max_number = pd.to_numeric(df["整理券番号"], errors='coerce').max()
-            return df, int(max_number) + 1
-        else:
-            return pd.DataFrame(columns=["整理券番号", "学籍番号", "氏名", "メール"]), 1
-    except:
-        return pd.DataFrame(columns=["整理券番号", "学籍番号", "氏名", "メール"]), 1
+LOG_COLUMNS = ["整理券番号", "学籍番号", "氏名", "メール"]
+
+@st.cache_resource
+def get_store():
+    return SQLiteTicketStore(JOURNAL_FILE, LOG_COLUMNS)
+
+@st.cache_resource
+def get_replicator():
+    return SheetsReplicator(get_store(), open_sheet, LOG_COLUMNS).start()
+
+@st.cache_resource
+def get_event():
+    # 設定の読み込みと画像・フォントの準備は起動時に1回だけ
+    return load_event(EVENT_FILE).precompile()
 
-df, next_number = load_data()
+@st.cache_resource
+def get_render_pool():
+    # 描画は画面のスレッドではなく、テンプレート・フォントを読み込んで常駐するワーカーで行う（起動は裏で進める）
+    return RenderPool(RENDER_WORKERS or None, event_preload([get_event()])).start(wait=False)
+
+@st.cache_resource
+def get_service():
+    event = get_event()
+    return TicketService(
+        get_store(), event.template, EMAIL_FROM, get_outbox(), TICKET_FORMAT or event.fmt, event.base_image, event.font,
+        render_pool=get_render_pool(),
+    )
+
+store = get_store()
+replicator = get_replicator()
+service = get_service()
 
 # ------------------------
 # 認証
+# ログイン後の画面で使う pandas（読み込みに約0.5秒）は、ログイン画面を出し終えてから裏で読み込んでおく
 # ------------------------
-st.title("🎫 学祭アーティストライブ 整理券発行アプリ")
+@st.cache_resource
+def preload_modules():
+    return preload("pandas", "gakusaiex.logview")
+
+st.title(get_event().title)
 if "authenticated" not in st.session_state:
     st.session_state.authenticated = False
 if not st.session_state.authenticated:
@@ -57,8 +109,13 @@ if not st.session_state.authenticated:
         st.session_state.authenticated = True
         st.success("ログイン成功！")
     else:
+        preload_modules()
         st.stop()
 
+# ログイン後の画面で使うもの（ログイン画面では読み込まない）
+import pandas as pd
+from gakusaiex.logview import log_viewer
+
 # ------------------------
 # フォーム
 # ------------------------
@@ -70,58 +127,49 @@ with st.form("ticket_form"):
     submitted = st.form_submit_button("整理券を発行して送信")
 
 if submitted:
-    email = f"{email_prefix}@yamaguchi-u.ac.jp"
-    if len(gakuseki) != 10 or not gakuseki.isdigit():
-        st.error("学籍番号は10桁の数字で入力してください")
-    elif not re.fullmatch(r"[A-Za-z0-9]{7}", email_prefix):
-        st.error("メールIDは英数字7桁で入力してください")
-    elif not name.strip():
-        st.error("氏名を入力してください")
-    elif email in df["メール"].values:
-        st.warning("このメールにはすでに整理券が発行されています")
+    email = f"{email_prefix}@{get_event().form['email_domain']}"
+    if (error := check_student(gakuseki, name, email_prefix)) is not None:
+        st.error(error)
+    elif not replicator.ready():
+        st.error("スプレッドシートとの照合がまだ終わっていないため発行できません。しばらくしてから再度お試しください")
+    elif (found := service.lookup(email=email, gakuseki=gakuseki)) is not None:
+        st.warning(duplicate_message(found))
     else:
         try:
-            # 画像生成
-            image = Image.open(BASE_IMAGE).convert("RGB")
-            draw = ImageDraw.Draw(image)
-            font = ImageFont.truetype(FONT_PATH, 36)
-            draw.text((50, 60), f"id: {gakuseki}", font=font, fill="black")
-            draw.text((50, 130), f"number: {next_number}", font=font, fill="black")
-            img_buffer = io.BytesIO()
-            image.save(img_buffer, format="PNG")
-            img_buffer.seek(0)
-
-            # メール送信
-            msg = MIMEMultipart()
-            msg["From"] = EMAIL_FROM
-            msg["To"] = email
-            msg["Subject"] = "【テストメール】アーティストライブ 整理券のご案内"
-            body = f"""{name} さん\n\n学祭アーティストライブの整理券を発行しました。\n整理券番号は「{next_number}」です。\n\n当日はこの添付画像を提示してください。\n"""
-            msg.attach(MIMEText(body, "plain"))
-            image_part = MIMEImage(img_buffer.read(), _subtype="png", name="整理券.png")
-            image_part.add_header("Content-Disposition", "attachment", filename="整理券.png")
-            msg.attach(image_part)
-
-            with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-                server.login(EMAIL_FROM, APP_PASSWORD)
-                server.send_message(msg)
-
-            # スプレッドシートに保存
-            sheet.append_row([next_number, gakuseki, name, email])
-
-            st.success(f"整理券番号 {next_number} を送信しました🎉")
+            # 番号の割り当てと記録 → 画像生成 → メールは送信キューへ（シートへの保存はまとめて行う）
+            next_number = service.issue(gakuseki=gakuseki, name=name, email=email)
+            replicator.notify()
+
+            st.success(f"整理券番号 {next_number} を発行しました🎉（メールは順次送信されます）")
+        except DuplicateTicketError as e:
+            st.warning(str(e))
         except Exception as e:
-            st.error(f"送信失敗: {e}")
+            st.error(f"発行失敗: {e}")
 
 # ------------------------
 # ログ表示＆ダウンロード
 # ------------------------
 st.subheader("📋 整理券ログ")
-if st.checkbox("ログを表示する"):
-    st.dataframe(df)
-
-if not df.empty:
-    buffer = io.BytesIO()
-    df.to_csv(buffer, sep="\t", index=False)
-    buffer.seek(0)
-    st.download_button("📥 ログをダウンロード（タブ区切り）", data=buffer, file_name="整理券ログ.txt", mime="text/plain")
+pending = replicator.pending_count()
+if pending:
+    st.caption(f"スプレッドシートへの保存待ち: {pending} 件")
+if replicator.last_error() is not None:
+    st.warning(f"スプレッドシートへの保存に失敗しています（自動で再試行します）: {replicator.last_error()}")
+log_viewer(store.history(), store.version(), f"{get_event().name}_log", "ログを表示する", "📥 ログをダウンロード（タブ区切り）", "整理券ログ.txt")
+
+# ------------------------
+# メール送信状況
+# ------------------------
+st.subheader("📨 メール送信状況")
+outbox = get_outbox()
+counts = outbox.counts()
+st.write("　".join(f"{label}: {counts.get(status, 0)}" for status, label in STATUS_LABELS.items()))
+st.caption("直近24時間の送信数　" + "　".join(f"{pool.user}: {pool.limiter.sent_today()}/{pool.limiter.per_day}" for pool in outbox.pools))
+if counts.get("failed"):
+    if st.button("送信失敗したメールを再送する"):
+        st.success(f"{outbox.retry_failed()} 件を再送キューに戻しました")
+if st.checkbox("送信状況を表示する"):
+    status_df = pd.DataFrame(outbox.statuses(limit=500), columns=["ticket", "recipient", "status", "attempts", "last_error"])
+    status_df["status"] = status_df["status"].map(STATUS_LABELS)
+    status_df.columns = ["整理券番号", "メール", "状態", "試行回数", "エラー"]
+    st.dataframe(status_df)